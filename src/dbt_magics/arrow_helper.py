@@ -0,0 +1,59 @@
+"""
+Arrow Helper Module for dbt-magics
+
+pyarrow is an optional dependency (pip install dbt_magics[arrow]).
+This module imports it once and provides the shared conversions used by
+the adapters' typed and Arrow-based result paths.
+
+Configuration:
+- MAGICS_NULLABLE_DTYPES: convert results to nullable pandas dtypes (Int64, boolean,
+  Arrow-backed strings) instead of pandas' defaults (int64/float64, bool, object)
+"""
+
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pacsv = pq = None
+
+import pandas as pd
+
+
+def require_pyarrow(feature):
+    """Raise a helpful error if pyarrow is not installed"""
+    if pa is None:
+        raise BaseException(f"{feature} requires pyarrow. Please install it with: pip install pyarrow")
+
+
+def nullable_dtypes():
+    """Nullable pandas dtypes are opt-in via MAGICS_NULLABLE_DTYPES"""
+    return os.environ.get('MAGICS_NULLABLE_DTYPES', 'false').lower() in ('true', '1', 'yes')
+
+
+def _types_mapper():
+    # Nullable pandas dtypes keep bigints and booleans with NULLs intact,
+    # and Arrow-backed strings avoid one Python object per value
+    return {
+        pa.int8(): pd.Int8Dtype(),
+        pa.int16(): pd.Int16Dtype(),
+        pa.int32(): pd.Int32Dtype(),
+        pa.int64(): pd.Int64Dtype(),
+        pa.bool_(): pd.BooleanDtype(),
+        pa.string(): pd.StringDtype("pyarrow"),
+        pa.large_string(): pd.StringDtype("pyarrow"),
+    }.get
+
+
+def arrow_to_pandas(table, **kwargs):
+    """
+    Convert an Arrow table to a DataFrame with pandas' default dtypes, or nullable ones
+    if MAGICS_NULLABLE_DTYPES is set.
+    kwargs are passed to pyarrow.Table.to_pandas, e.g. self_destruct=True to release
+    Arrow memory during the conversion when the table is not used afterwards.
+    """
+    if nullable_dtypes():
+        kwargs.setdefault('types_mapper', _types_mapper())
+    return table.to_pandas(**kwargs)
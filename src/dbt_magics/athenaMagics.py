@@ -1,17 +1,32 @@
 import io
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from time import sleep, time
+from types import SimpleNamespace
+from uuid import uuid4
 
 import boto3
+from botocore.exceptions import ClientError, ParamValidationError
+import ipywidgets as widgets
 import pandas as pd
 from IPython import get_ipython
 from IPython.core import display, magic_arguments
 from IPython.core.magic import Magics, line_cell_magic, magics_class
-from jinja2 import Environment, Template, meta
 
+from dbt_magics.arrow_helper import arrow_to_pandas, pa, pacsv, pq, require_pyarrow
+from dbt_magics.background import background_jobs, current_job
+from dbt_magics.connections import connection_manager
 from dbt_magics.datacontroller import DataController, prStyle
 from dbt_magics.dbt_helper import dbtHelper
 from dbt_magics.duckdb_helper import DuckDBHelper
+from dbt_magics.query_history import query_history
+from dbt_magics.result_cache import ResultCacheMagics, get_result_cache
+from dbt_magics.sql_helper import execute_statements, is_read_only, split_statements
+from dbt_magics.sync import DbtSyncMagics, register_sync_adapter
+
+logger = logging.getLogger('dbt_magics')
 
 """
 Implementation of the AthenaDataContoller class.
@@ -19,11 +34,15 @@ Implement abstract methods from DataController class.
 """
 class AthenaDataController(DataController):
     def __init__(self, target=None):
-        dbth = dbtHelperAdapter(adapter_name='athena', target=target)
-        session = boto3.Session(profile_name=dbth.profile_config['aws_profile_name'])
-        self.client = session.client('athena')
+        dbth = dbtHelperAdapter.get_or_create(adapter_name='athena', target=target)
+        connection = dbth.connections(dbth.profile_config['aws_profile_name']).shared()
+        self.client = connection.athena
+        # Table names of the default catalog are listed with Glue, which can leave out the column definitions
+        self.glue = connection.session.client('glue')
+        # (CatalogName, DatabaseName) -> {table name: TableMetadata}, filled as tables are selected
+        self.table_metadata = {}
 
-        super().__init__(r"%%athena")
+        super().__init__(r"%%athena", cache_namespace=f"athena/{dbth.profile_name}/{dbth.target}")
 
     """
     Implemented Abstract methods
@@ -40,21 +59,17 @@ class AthenaDataController(DataController):
     
     def get_tables(self, database):
         if database:
-            self.TableMetadataList = self.list_table_metadata(CatalogName=self.wg_project.value, DatabaseName=database)
-            return [i['Name'] for i in self.TableMetadataList]
+            return self.get_project_tables(self.wg_project.value, database)
         else: 
             return []
+
+    def get_project_tables(self, project, dataset):
+        return self.list_table_names(CatalogName=project, DatabaseName=dataset)
     
     def get_columns(self, table):
-        columns = []
-        for i in self.TableMetadataList:
-            if i['Name']==table:
-                cols = [(i['Name'], i['Type']) for i in i['Columns']]
-                # self.check_boxes = [f(f"{i['Name']} -- {i['Type']}") for i in i['Columns']]
-                partition_columns = [(i['Name'], i['Type']+'(Part.)') for i in i.get('PartitionKeys', [])]
-                columns = [(i['Name'], i['Type']) for i in i['Columns']] + partition_columns
-
-        return columns
+        metadata = self.get_table_metadata(CatalogName=self.wg_project.value, DatabaseName=self.wg_database.value, TableName=table)
+        partition_columns = [(i['Name'], i['Type']+'(Part.)') for i in metadata.get('PartitionKeys', [])]
+        return [(i['Name'], i['Type']) for i in metadata.get('Columns', [])] + partition_columns
 
     """ 
     Additional methods 
@@ -68,40 +83,142 @@ class AthenaDataController(DataController):
             DatabaseList += response['DatabaseList']        
         return DatabaseList
 
+    def list_table_names(self, CatalogName, DatabaseName):
+        """Names of the tables of a database, without fetching their columns where the catalog allows it"""
+        if CatalogName == 'AwsDataCatalog':
+            try:
+                pages = self.glue.get_paginator('get_tables').paginate(
+                    DatabaseName=DatabaseName, AttributesToGet=['NAME'], PaginationConfig={'PageSize': 100})
+                return [table['Name'] for page in pages for table in page['TableList']]
+            except (ClientError, ParamValidationError):
+                # No Glue permission, or a botocore release without AttributesToGet
+                pass
+        return [i['Name'] for i in self.list_table_metadata(CatalogName=CatalogName, DatabaseName=DatabaseName)]
+
     def list_table_metadata(self, CatalogName, DatabaseName):
-        response = self.client.list_table_metadata(
-            CatalogName=CatalogName,
-            DatabaseName=DatabaseName,
-            MaxResults=50
-        )
-        TableMetadataList = response['TableMetadataList']
-        while 'NextToken' in response:
-            response = self.client.list_table_metadata(
-                            CatalogName=CatalogName,
-                            DatabaseName=DatabaseName,
-                            MaxResults=50,
-                            NextToken=response["NextToken"]
-            )
-            TableMetadataList += response['TableMetadataList']        
+        """TableMetadata of all tables of a database (including their columns), added to the table_metadata index"""
+        pages = self.client.get_paginator('list_table_metadata').paginate(
+            CatalogName=CatalogName, DatabaseName=DatabaseName, PaginationConfig={'PageSize': 50})
+        TableMetadataList = [i for page in pages for i in page['TableMetadataList']]
+        self.table_metadata.setdefault((CatalogName, DatabaseName), {}).update((i['Name'], i) for i in TableMetadataList)
         return TableMetadataList
 
+    def get_table_metadata(self, CatalogName, DatabaseName, TableName):
+        """TableMetadata of one table from the table_metadata index, fetched from Athena on first use"""
+        index = self.table_metadata.setdefault((CatalogName, DatabaseName), {})
+        if TableName not in index:
+            index[TableName] = self.client.get_table_metadata(CatalogName=CatalogName, DatabaseName=DatabaseName, TableName=TableName)['TableMetadata']
+        return index[TableName]
+
+def split_s3_url(s3_url):
+    """Split s3://bucket/key into (bucket, key)"""
+    file_location = s3_url.replace("s3://","").split("/")
+    return file_location[0], "/".join(file_location[1:])
+
+
+def athena_arrow_type(column):
+    """Arrow type of an Athena ResultSetMetadata column, complex types are kept as strings"""
+    athena_type = column['Type'].lower()
+    if athena_type == 'decimal':
+        return pa.decimal128(column.get('Precision', 38), column.get('Scale', 0))
+    return {
+        'boolean': pa.bool_(),
+        'tinyint': pa.int8(),
+        'smallint': pa.int16(),
+        'integer': pa.int32(),
+        'int': pa.int32(),
+        'bigint': pa.int64(),
+        'float': pa.float32(),
+        'real': pa.float32(),
+        'double': pa.float64(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('ms'),
+    }.get(athena_type, pa.string())
+
+
+def athena_price(DataScannedInBytes):
+    """Return (MB scanned, estimated price in $) of an Athena query"""
+    DataScannedInMB = DataScannedInBytes*0.00000095367432
+    PriceInDollar = (DataScannedInMB*0.000085, 0.00085)[DataScannedInMB<=10]
+    return DataScannedInMB, PriceInDollar
+
+
+class AthenaQueryMonitor:
+    """
+    Waits for an Athena query to finish.
+    Polls get_query_execution with adaptive backoff and shows state, runtime,
+    data scanned and estimated cost in a live status widget.
+    """
+    FINAL_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+
+    def __init__(self, client, query_execution_id, initial_delay=0.1, max_delay=2.0, backoff=1.5, show_widget=True):
+        """
+        Parameters:
+        - client: boto3 athena client
+        - query_execution_id: id returned by start_query_execution
+        - initial_delay: seconds before the second poll
+        - max_delay: upper bound of the delay between polls
+        - backoff: factor the delay grows with after every poll
+        - show_widget: display the live status widget
+        """
+        self.client = client
+        self.query_execution_id = query_execution_id
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.widget = widgets.HTML() if show_widget else None
+        self.polls = 0
+
+    def _update(self, execution, elapsed):
+        if self.widget is None:
+            return
+        statistics = execution.get("Statistics", {})
+        DataScannedInMB, PriceInDollar = athena_price(statistics.get("DataScannedInBytes", 0))
+        state = execution["Status"]["State"]
+        color = {'SUCCEEDED': 'green', 'FAILED': 'red', 'CANCELLED': 'red'}.get(state, '#1a73e8')
+        self.widget.value = (f'<span style="font-family:monospace">'
+                             f'<b style="color:{color}">{state}</b> | {elapsed:.1f} sec. '
+                             f'| {DataScannedInMB:.3f} MB scanned | {PriceInDollar:3.5f} $</span>')
+
+    def wait(self):
+        """
+        Block until the query reaches SUCCEEDED, FAILED or CANCELLED
+
+        Returns:
+        - the last get_query_execution response
+        """
+        if self.widget is not None:
+            # display() isn't redirected like print, a background job shows the widget itself
+            job = current_job()
+            if job is not None:
+                job.show(self.widget)
+            else:
+                display.display(self.widget)
+        start = time()
+        delay = self.initial_delay
+        try:
+            while True:
+                status = self.client.get_query_execution(QueryExecutionId=self.query_execution_id)
+                self.polls += 1
+                execution = status["QueryExecution"]
+                self._update(execution, time() - start)
+                if execution["Status"]["State"] in self.FINAL_STATES:
+                    return status
+                sleep(delay)
+                delay = min(delay*self.backoff, self.max_delay)
+        except KeyboardInterrupt:
+            # An interrupted cell would otherwise leave the query running (and billing) in Athena
+            self.stop()
+            raise
+
+    def stop(self):
+        """Cancel the query in Athena"""
+        try:
+            self.client.stop_query_execution(QueryExecutionId=self.query_execution_id)
+            print(f"{prStyle.YELLOW}Query {self.query_execution_id} cancelled.{prStyle.RESET}")
+        except Exception as e:
+            logger.debug(f'Stopping query {self.query_execution_id} failed: {e}')
 
-    def list_dataset_metadata(self, CatalogName, DatabaseName):
-        response = self.client.list_table_metadata(
-            CatalogName=CatalogName,
-            DatabaseName=DatabaseName,
-            MaxResults=50
-        )
-        TableMetadataList = response['TableMetadataList']
-        while 'NextToken' in response:
-            response = self.client.list_table_metadata(
-                            CatalogName=CatalogName,
-                            DatabaseName=DatabaseName,
-                            MaxResults=50,
-                            NextToken=response["NextToken"]
-            )
-            TableMetadataList += response['TableMetadataList']        
-        return TableMetadataList    
 
 class dbtHelperAdapter(dbtHelper):
     def __init__(self, adapter_name='athena', profile_name=None, target=None):
@@ -109,12 +226,18 @@ class dbtHelperAdapter(dbtHelper):
         self.duckdb_helper = DuckDBHelper(self)
         
     def source(self, schema, table):
-        SOURCES, _ = self._sources_and_models()
+        relation = self._manifest_source(schema, table)
+        if relation:
+            return '"{database}"."{schema}"."{identifier}"'.format(**relation)
         default_database = [i for i in map(self.profile_config.get, ['dbname', 'database', 'dataset']) if i][0]
-        source = self._search_for_source_table(SOURCES, target_schema=schema, target_table=table, default_database=default_database)
+        source = self._find_source(target_schema=schema, target_table=table, default_database=default_database)
         return '"{database}"."{schema}"."{table}"'.format(database=source['database'], schema=source['schema'], table=source['table'])
 
-    def ref(self, table_name):
+    def ref(self, *args):
+        package_name, table_name = self._split_ref_args(args)
+        relation = self._manifest_ref(package_name, table_name)
+        if relation:
+            return '"{schema}"."{identifier}"'.format(**relation)
         custom_schema = self._get_custom_schema(table_name)
         default_schema = self.profile_config.get("schema")
         return (f'"{default_schema}_{custom_schema}"."{table_name}"', f'"{default_schema}"."{table_name}"')[self.target=='dev']
@@ -136,15 +259,158 @@ class dbtHelperAdapter(dbtHelper):
         """Extract table name from dbt ref() function in SQL statement"""
         return self.duckdb_helper.extract_ref_table_name(sql_statement)
     
-    def export_to_duckdb(self, df, table_name, if_exists='replace'):
+    def export_to_duckdb(self, df, table_name, if_exists='replace', unique_key=None):
         """Export DataFrame to DuckDB using dbt naming conventions"""
-        return self.duckdb_helper.export_to_duckdb(df, table_name, if_exists)
+        return self.duckdb_helper.export_to_duckdb(df, table_name, if_exists, unique_key)
+
+    def export_stream_to_duckdb(self, batches, table_name, if_exists='replace', memory_limit=None, preview_rows=5, unique_key=None):
+        """Stream Arrow record batches into DuckDB using dbt naming conventions"""
+        return self.duckdb_helper.export_stream(batches, table_name, if_exists, memory_limit, preview_rows, unique_key)
+
+    @property
+    def query_parameters(self):
+        """Profile settings run_query() and iter_arrow_batches() need besides the statement"""
+        return dict(profile_name=self.profile_config.get("aws_profile_name"),
+                    schema=self.profile_config.get("schema"),
+                    database=self.profile_config.get("database"),
+                    output_location=self.profile_config.get("OutputLocation"),
+                    work_group=[i for i in map(self.profile_config.get, ['work_group', 'WorkGroup']) if i][0])
+
+    def connections(self, profile_name):
+        """Pool of boto3 sessions with athena and s3 clients for this profile and target"""
+        def connect():
+            session = boto3.Session(profile_name=profile_name)
+            return SimpleNamespace(session=session, athena=session.client('athena'), s3=session.client('s3'))
+        return connection_manager.pool(
+            ('athena', self.profile_name, self.target),
+            factory=connect,
+            signature=profile_name,
+            expired_pattern=r'ExpiredToken|expired|InvalidClientTokenId|UnrecognizedClient|security token',
+        )
+
+    def unload_location(self, output_location):
+        """Empty S3 prefix for the Parquet files of one UNLOAD query"""
+        base = self.profile_config.get("unload_location") or f"{output_location.rstrip('/')}/dbt_magics_unload"
+        return f"{base.rstrip('/')}/{uuid4().hex}/"
+
+    def fetch_unload_results(self, s3, location, max_workers=8):
+        """
+        Download the Parquet files written by UNLOAD concurrently
+
+        Parameters:
+        - s3: boto3 s3 client
+        - location: S3 prefix the UNLOAD query wrote to
+        - max_workers: number of parallel downloads
+
+        Returns:
+        - pyarrow Table with all parts, or None if the query wrote no files
+        """
+        bucket, prefix = split_s3_url(location)
+        keys = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            keys += [obj['Key'] for obj in page.get('Contents', []) if obj['Size'] > 0]
+
+        def read_part(key):
+            return pq.read_table(io.BytesIO(s3.get_object(Bucket=bucket, Key=key)['Body'].read()))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tables = list(executor.map(read_part, sorted(keys)))
+        return pa.concat_tables(tables) if tables else None
+
+    def fetch_results(self, connection, status, page_size=1000):
+        """
+        Fetch the results of a finished query with the column types from ResultSetMetadata.
+        Results that fit into one GetQueryResults page skip S3, larger results are
+        streamed from S3 into a multithreaded Arrow CSV reader.
+
+        Returns:
+        - DataFrame, or None if the statement returned no result set
+        """
+        execution = status["QueryExecution"]
+        first_page = connection.athena.get_query_results(QueryExecutionId=execution["QueryExecutionId"], MaxResults=page_size)
+        columns = first_page['ResultSet']['ResultSetMetadata']['ColumnInfo']
+        if not columns:
+            return None
+
+        if 'NextToken' not in first_page:
+            rows = first_page['ResultSet']['Rows']
+            # SELECT results repeat the header as the first row
+            if execution.get("StatementType") == 'DML':
+                rows = rows[1:]
+            values = [[data.get('VarCharValue') for data in row['Data']] for row in rows]
+            return self._typed_dataframe(columns, values)
+
+        bucket, key = split_s3_url(execution["ResultConfiguration"]["OutputLocation"])
+        body = connection.s3.get_object(Bucket=bucket, Key=key)['Body']
+        if pa is None:
+            return pd.read_csv(body)
+        table = pacsv.read_csv(
+            body,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=16 << 20),
+            convert_options=self._csv_convert_options(columns),
+        )
+        return arrow_to_pandas(table)
+
+    def _csv_convert_options(self, columns):
+        column_types = {c['Name']: athena_arrow_type(c) for c in columns}
+        return pacsv.ConvertOptions(column_types=column_types, strings_can_be_null=True, quoted_strings_can_be_null=False)
 
-    def run_query(self, sql_statement, profile_name, schema, database, output_location, work_group):
-        session = boto3.Session(profile_name=profile_name)
-        client = session.client('athena')
-        s3 = session.client('s3')
+    def iter_arrow_batches(self, sql_statement, profile_name, schema, database, output_location, work_group, block_size=16 << 20):
+        """
+        Run a query and yield its result as Arrow record batches while the result file is read from S3.
+        Only about block_size bytes of CSV are held and decoded at a time.
+        """
+        require_pyarrow("Streaming")
+        with self.connections(profile_name).connection() as connection:
+            status = self._start_query(connection.athena, sql_statement, profile_name, schema, database, output_location, work_group)
+            self._print_execution(status)
+            execution = status["QueryExecution"]
+            metadata = connection.athena.get_query_results(QueryExecutionId=execution["QueryExecutionId"], MaxResults=1)
+            columns = metadata['ResultSet']['ResultSetMetadata']['ColumnInfo']
+            if not columns:
+                return
+            bucket, key = split_s3_url(execution["ResultConfiguration"]["OutputLocation"])
+            body = connection.s3.get_object(Bucket=bucket, Key=key)['Body']
+            reader = pacsv.open_csv(body, read_options=pacsv.ReadOptions(block_size=block_size), convert_options=self._csv_convert_options(columns))
+            empty = True
+            for batch in reader:
+                empty = False
+                yield batch
+            if empty:
+                # Empty result: the header still gives the schema
+                yield pa.RecordBatch.from_pylist([], schema=reader.schema)
+
+    def _typed_dataframe(self, columns, values):
+        names = [c['Name'] for c in columns]
+        if pa is None:
+            return pd.DataFrame(values, columns=names)
+        arrays = []
+        for i, column in enumerate(columns):
+            array = pa.array([row[i] for row in values], pa.string())
+            try:
+                array = array.cast(athena_arrow_type(column))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                pass
+            arrays.append(array)
+        return arrow_to_pandas(pa.Table.from_arrays(arrays, names=names))
+
+    def run_query(self, sql_statement, profile_name, schema, database, output_location, work_group, unload=False, reuse=None):
+        return self.connections(profile_name).run(
+            lambda connection: self._execute_query(connection, sql_statement, profile_name, schema, database, output_location, work_group, unload, reuse),
+            retry=is_read_only(sql_statement))
+
+    def run_statements(self, statements, profile_name, schema, database, output_location, work_group, unload=False, reuse=None, concurrent=None):
+        """
+        Run the statements of a cell in order, or concurrently on up to `concurrent` pooled clients.
+        Athena has no sessions, dependent statements (e.g. CREATE TABLE AS and a SELECT from it) only rely on the order.
+        """
+        return execute_statements(
+            self.connections(profile_name), statements,
+            lambda connection, statement: self._execute_query(connection, statement, profile_name, schema, database, output_location, work_group, unload, reuse),
+            concurrent)
 
+    def _start_query(self, client, sql_statement, profile_name, schema, database, output_location, work_group, **kwargs):
+        """Start a query, wait for it to finish and return its status. Raises if the query didn't succeed."""
         ########### START QUERY ###########
         start_response = client.start_query_execution(
             QueryString=sql_statement,
@@ -153,33 +419,78 @@ class dbtHelperAdapter(dbtHelper):
                 'Catalog': database
             },
             ResultConfiguration={'OutputLocation': output_location},
-            WorkGroup=work_group
+            WorkGroup=work_group,
+            **kwargs
         )
 
         ########### STATUS - WAIT FOR RESULTS ###########
-        state = ""
-        while state!='SUCCEEDED':
-            status = client.get_query_execution(QueryExecutionId=start_response["QueryExecutionId"])
-            state = status['QueryExecution']["Status"]["State"]
-            TotalExecutionTimeInMillis = status["QueryExecution"]["Statistics"]["TotalExecutionTimeInMillis"]
-            print(f"{TotalExecutionTimeInMillis/1000:3.3f} sec.", end="\r")
-            if state=="FAILED":
-                raise BaseException(f"SQL statement FAILED for AWS Profile '{profile_name}' & Catalog '{database}' & Database '{schema}'.\nSQL: {sql_statement}\n\n{status['QueryExecution']['Status']}")
-
-        DataScannedInBytes = status["QueryExecution"]["Statistics"]["DataScannedInBytes"]*0.00000095367432
-        PriceInDollar = (DataScannedInBytes*0.000085, 0.00085)[DataScannedInBytes<=10]
-        print(f"{prStyle.GREEN}{TotalExecutionTimeInMillis/1000:.3f} sec. {prStyle.RESET}| {prStyle.MAGENTA}{DataScannedInBytes:.3f} MB scanned {prStyle.RESET}| {prStyle.RED}{PriceInDollar:3.5f} ${prStyle.RESET}")
+        status = AthenaQueryMonitor(client, start_response["QueryExecutionId"]).wait()
+        state = status['QueryExecution']["Status"]["State"]
+        if state!="SUCCEEDED":
+            raise BaseException(f"SQL statement {state} for AWS Profile '{profile_name}' & Catalog '{database}' & Database '{schema}'.\nSQL: {sql_statement}\n\n{status['QueryExecution']['Status']}")
+        return status
+
+    def _print_execution(self, status, reused=False):
+        TotalExecutionTimeInMillis = status["QueryExecution"]["Statistics"]["TotalExecutionTimeInMillis"]
+        DataScannedInMB, PriceInDollar = athena_price(status["QueryExecution"]["Statistics"]["DataScannedInBytes"])
+        reused_info = f" | {prStyle.BLUE}reused {status['QueryExecution']['QueryExecutionId']}{prStyle.RESET}" if reused else ""
+        print(f"{prStyle.GREEN}{TotalExecutionTimeInMillis/1000:.3f} sec. {prStyle.RESET}| {prStyle.MAGENTA}{DataScannedInMB:.3f} MB scanned {prStyle.RESET}| {prStyle.RED}{PriceInDollar:3.5f} ${prStyle.RESET}{reused_info}")
+
+    def _previous_execution(self, client, reuse_key, reuse):
+        """Status of the last successful run of the same statement within reuse minutes, or None"""
+        previous = query_history.lookup(reuse_key, reuse)
+        if previous is None:
+            return None, None
+        try:
+            status = client.get_query_execution(QueryExecutionId=previous['query_id'])
+        except Exception:
+            status = None
+        if status is None or status['QueryExecution']["Status"]["State"] != "SUCCEEDED":
+            query_history.forget(reuse_key)
+            return None, None
+        return status, previous.get('location')
+
+    def _execute_query(self, connection, sql_statement, profile_name, schema, database, output_location, work_group, unload=False, reuse=None):
+        client = connection.athena
+        s3 = connection.s3
+
+        status = location = None
+        if reuse:
+            reuse_key = query_history.key(self.adapter_name, self.profile_name, self.target, ('UNLOAD ' if unload else '') + sql_statement)
+            status, location = self._previous_execution(client, reuse_key, reuse)
+        reused = status is not None
+
+        if status is None:
+            if unload:
+                require_pyarrow("--unload")
+                location = self.unload_location(output_location)
+                sql_statement = f"UNLOAD ({sql_statement.strip().rstrip(';')}) TO '{location}' WITH (format = 'PARQUET')"
+
+            kwargs = {}
+            if reuse and not unload:
+                # Athena engine v3 serves identical queries from its own result reuse
+                kwargs['ResultReuseConfiguration'] = {'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': int(reuse)}}
+            status = self._start_query(client, sql_statement, profile_name, schema, database, output_location, work_group, **kwargs)
+            reused = status["QueryExecution"]["Statistics"].get("ResultReuseInformation", {}).get("ReusedPreviousResult", False)
+            if reuse:
+                query_history.record(reuse_key, status["QueryExecution"]["QueryExecutionId"], location=location)
+
+        self._print_execution(status, reused)
 
         ########### DOWNLOAD RESULTS ###########
+        if unload:
+            start = time()
+            table = self.fetch_unload_results(s3, location)
+            df = arrow_to_pandas(table) if table is not None else pd.DataFrame()
+            print(f"{prStyle.GREEN}{time()-start:.3f} sec. download {prStyle.RESET}| {prStyle.MAGENTA}{len(df)} rows from {location}{prStyle.RESET}")
+            return df
         try:
-            s3_file_url = status["QueryExecution"]["ResultConfiguration"]["OutputLocation"]
-            file_location = s3_file_url.replace("s3://","").split("/")
-            bucket, key = file_location[0], "/".join(file_location[1:])
-            obj = s3.get_object(Bucket=bucket, Key=key)
-            df = pd.read_csv(io.BytesIO(obj['Body'].read()))
-        except:
+            df = self.fetch_results(connection, status)
+        except Exception as e:
+            print(f"Not a SELECT statement.\n{e}")
+            return None
+        if df is None:
             print("Not a SELECT statement.")
-            df = None
         return df
 
 
@@ -195,7 +506,15 @@ class AthenaSQLMagics(Magics):
     @magic_arguments.argument('--profile', default=None, help='')
     @magic_arguments.argument('--target', default='prod', help='')
     @magic_arguments.argument('--export_duckdb', '-ddb', action='store_true', help='Export DataFrame to DuckDB using table name from dbt ref().')
-    @magic_arguments.argument('--duckdb_mode', '-mode', default='replace', choices=['replace', 'append'], help='DuckDB export mode: replace (default) or append.')
+    @magic_arguments.argument('--duckdb_mode', '-mode', default='replace', choices=['replace', 'append', 'merge'], help='DuckDB export mode: replace (default), append or merge (upsert by --unique_key).')
+    @magic_arguments.argument('--unique_key', default=None, help='Comma separated key column(s) for --duckdb_mode merge, e.g. id or col1,col2.')
+    @magic_arguments.argument('--unload', action='store_true', help='Fetch results via UNLOAD to Parquet with parallel S3 reads (requires pyarrow).')
+    @magic_arguments.argument('--reuse', nargs='?', const=60, default=None, type=int, help='Reuse the results of the same statement run within the last N minutes (default 60).')
+    @magic_arguments.argument('--cache', nargs='?', const=60, default=None, type=int, help='Cache the result locally for N minutes (default 60, 0 never expires). See %%dbt_cache.')
+    @magic_arguments.argument('--stream', action='store_true', help='With --export_duckdb: stream record batches into DuckDB without building a DataFrame (requires pyarrow).')
+    @magic_arguments.argument('--memory_limit', default=None, type=int, help='DuckDB memory limit in MB for --stream.')
+    @magic_arguments.argument('--concurrent', nargs='?', const=4, default=None, type=int, help='Run the statements of a multi-statement cell concurrently on up to N pooled connections (default 4). By default they run in order on one connection.')
+    @magic_arguments.argument('--background', '-bg', action='store_true', help='Run the query on a worker thread and return immediately. The result is stored in --dataframe when it finishes.')
     def athena(self, line, cell=None):
         """
 ---------------------------------------------------------------------------
@@ -212,6 +531,46 @@ SELECT * FROM {{ ref('my_table') }}
 %%athena --export_duckdb --duckdb_mode append  
 SELECT * FROM {{ ref('my_table') }}
 
+%%athena --export_duckdb --duckdb_mode merge --unique_key id
+SELECT * FROM {{ ref('my_table') }}  # Upserts changed and new rows by id, unchanged rows are kept
+
+%%athena --export_duckdb --stream --memory_limit 2048
+SELECT * FROM {{ ref('my_table') }}  # Streamed into DuckDB batch by batch, df is not created
+
+Large Results:
+
+%%athena --unload
+SELECT * FROM {{ ref('my_big_table') }}  # UNLOAD to Parquet, parts are fetched in parallel
+
+Result Reuse:
+
+%%athena --reuse
+SELECT * FROM {{ ref('my_model') }}  # Reuses results of the same statement from the last 60 minutes
+
+%%athena --reuse 15
+SELECT * FROM {{ ref('my_model') }}  # Reuses results from the last 15 minutes
+
+Local Cache:
+
+%%athena --cache
+SELECT * FROM {{ ref('my_model') }}  # Result is cached as Parquet for 60 minutes, see %dbt_cache
+
+Multiple Statements:
+
+%%athena
+DROP TABLE IF EXISTS tmp.recent;
+CREATE TABLE tmp.recent AS SELECT * FROM {{ ref('orders') }};
+SELECT count(*) FROM tmp.recent;  # Runs in order, results in df_1 ... df_3 and df (the last)
+
+%%athena --concurrent
+SELECT * FROM {{ ref('orders') }};
+SELECT * FROM {{ ref('customers') }};  # Independent statements run at the same time
+
+Background Execution:
+
+%%athena --background -df orders
+SELECT * FROM {{ ref('my_big_table') }}  # Returns a job handle at once, orders is set when the query finishes
+
 Output Control:
 
 %%athena -n 10
@@ -240,50 +599,109 @@ SELECT * FROM {{ ref('table_in_dbt_project') }}
             return dc()
         else:        
             args = magic_arguments.parse_argstring(self.athena, line)
-            self.dbt_helper = dbtHelperAdapter(profile_name=args.profile, target=args.target)
-            env = Environment()
+            self.dbt_helper = dbtHelperAdapter.get_or_create(profile_name=args.profile, target=args.target)
             def ipython(variable):
                 try: result = get_ipython().ev(variable)
                 except: result = False
                 return result
 
-            kwargs = {i:ipython(i) for i in meta.find_undeclared_variables(env.parse(cell)) if ipython(i)}
+            kwargs = {i:ipython(i) for i in self.dbt_helper.undeclared_variables(cell) if ipython(i)}
 
-            macros_txt = self.dbt_helper.macros_txt
-            jinja_statement = macros_txt+cell
-            statement = Template(jinja_statement).render(source=self.dbt_helper.source, ref=self.dbt_helper.ref, var=self.dbt_helper.var, **kwargs).strip()
+            statement = self.dbt_helper.render(cell, **kwargs)
 
             if args.parser:
+                macros = self.dbt_helper.required_macros(cell)
+                if macros:
+                    print(f"-- macros: {', '.join(macros)}")
                 print(statement)
             else:
+                if args.export_duckdb and args.duckdb_mode == 'merge' and not args.unique_key:
+                    print(f"{prStyle.RED}--duckdb_mode merge requires --unique_key, e.g. --unique_key id or --unique_key col1,col2{prStyle.RESET}")
+                    return None
+
                 # Check DuckDB availability before executing query if export is requested
                 if args.export_duckdb:
                     if not self.dbt_helper.check_duckdb_availability():
                         print(f"{prStyle.RED}Aborting query execution due to DuckDB unavailability.{prStyle.RESET}")
                         return None
-                
-                #--------------------------------------------- Start
-                df = self.dbt_helper.run_query(
-                    sql_statement=statement,
-                    profile_name=self.dbt_helper.profile_config.get("aws_profile_name"),
-                    schema=self.dbt_helper.profile_config.get("schema"),
-                    database=self.dbt_helper.profile_config.get("database"),
-                    output_location=self.dbt_helper.profile_config.get("OutputLocation"),
-                    work_group=[i for i in map(self.dbt_helper.profile_config.get, ['work_group', 'WorkGroup']) if i][0]
-                    )  
-                #--------------------------------------------- End
-
-                self.shell.user_ns[args.dataframe] = df
-                
-                # Export to DuckDB if requested
-                if args.export_duckdb and df is not None:
-                    # Extract table name from ref() in the original cell content
+
+                # Background jobs keep their own reference, later cells may switch self.dbt_helper
+                dbt_helper = self.dbt_helper
+                statements = split_statements(statement)
+
+                # Stream straight into DuckDB without building a DataFrame
+                if args.stream:
                     table_name = self.dbt_helper.extract_ref_table_name(cell)
-                    
-                    if table_name:
-                        self.dbt_helper.export_to_duckdb(df, table_name, args.duckdb_mode)
+                    if not args.export_duckdb or not table_name:
+                        print(f"{prStyle.RED}--stream requires --export_duckdb and a ref() to name the DuckDB table.{prStyle.RESET}")
+                        return None
+                    if len(statements) > 1:
+                        print(f"{prStyle.RED}--stream runs a single statement, this cell contains {len(statements)}.{prStyle.RESET}")
+                        return None
+                    batches = self.dbt_helper.iter_arrow_batches(
+                        sql_statement=statement,
+                        profile_name=self.dbt_helper.profile_config.get("aws_profile_name"),
+                        schema=self.dbt_helper.profile_config.get("schema"),
+                        database=self.dbt_helper.profile_config.get("database"),
+                        output_location=self.dbt_helper.profile_config.get("OutputLocation"),
+                        work_group=[i for i in map(self.dbt_helper.profile_config.get, ['work_group', 'WorkGroup']) if i][0],
+                        )
+                    export = lambda: dbt_helper.export_stream_to_duckdb(batches, table_name, args.duckdb_mode, args.memory_limit, preview_rows=int(args.n_output), unique_key=args.unique_key)
+                    if args.background:
+                        return background_jobs.submit(f'%%athena --stream -> {table_name}', export)
+                    df = export()
+                    return df if int(args.n_output) else None
+                
+                def execute():
+                    #--------------------------------------------- Start
+                    run = lambda: dbt_helper.run_query(
+                        sql_statement=statement,
+                        profile_name=dbt_helper.profile_config.get("aws_profile_name"),
+                        schema=dbt_helper.profile_config.get("schema"),
+                        database=dbt_helper.profile_config.get("database"),
+                        output_location=dbt_helper.profile_config.get("OutputLocation"),
+                        work_group=[i for i in map(dbt_helper.profile_config.get, ['work_group', 'WorkGroup']) if i][0],
+                        unload=args.unload,
+                        reuse=args.reuse
+                        )  
+                    if len(statements) > 1:
+                        results = dbt_helper.run_statements(
+                            statements,
+                            profile_name=dbt_helper.profile_config.get("aws_profile_name"),
+                            schema=dbt_helper.profile_config.get("schema"),
+                            database=dbt_helper.profile_config.get("database"),
+                            output_location=dbt_helper.profile_config.get("OutputLocation"),
+                            work_group=[i for i in map(dbt_helper.profile_config.get, ['work_group', 'WorkGroup']) if i][0],
+                            unload=args.unload,
+                            reuse=args.reuse,
+                            concurrent=args.concurrent,
+                            )
+                        for index, result in enumerate(results, 1):
+                            self.shell.user_ns[f'{args.dataframe}_{index}'] = result
+                        df = results[-1]
+                        print(f"{prStyle.BLUE}{len(results)} statements{prStyle.RESET} | results in {args.dataframe}_1 ... {args.dataframe}_{len(results)}, {args.dataframe} is the last one")
+                    elif args.cache is not None:
+                        df = get_result_cache().cached(statement, dbt_helper.adapter_name, dbt_helper.profile_name, dbt_helper.target, args.cache, run)
                     else:
-                        print(f"{prStyle.RED}No ref() function found in SQL. Please use ref('table_name') to specify the table for DuckDB export.{prStyle.RESET}")
+                        df = run()
+                    #--------------------------------------------- End
+
+                    self.shell.user_ns[args.dataframe] = df
+                    
+                    # Export to DuckDB if requested
+                    if args.export_duckdb and df is not None:
+                        # Extract table name from ref() in the original cell content
+                        table_name = dbt_helper.extract_ref_table_name(cell)
+                        
+                        if table_name:
+                            dbt_helper.export_to_duckdb(df, table_name, args.duckdb_mode, args.unique_key)
+                        else:
+                            print(f"{prStyle.RED}No ref() function found in SQL. Please use ref('table_name') to specify the table for DuckDB export.{prStyle.RESET}")
+                    return df
+
+                if args.background:
+                    return background_jobs.submit(f'%%athena -> {args.dataframe}', execute)
+                df = execute()
                 
                 # Handle n_output behavior: if 0, don't display dataframe
                 if int(args.n_output) == 0:
@@ -292,7 +710,7 @@ SELECT * FROM {{ ref('table_in_dbt_project') }}
                     df = df.head(int(args.n_output)) if type(df)==pd.DataFrame else None
                     return df
 
-def export_dataframe_to_duckdb_athena(df, table_name, profile_name=None, target=None, if_exists='replace'):
+def export_dataframe_to_duckdb_athena(df, table_name, profile_name=None, target=None, if_exists='replace', unique_key=None):
     """
     Standalone function to export any DataFrame to DuckDB using dbt profile configuration (Athena version)
     
@@ -301,14 +719,16 @@ def export_dataframe_to_duckdb_athena(df, table_name, profile_name=None, target=
     - table_name: name of the table in DuckDB
     - profile_name: dbt profile name (optional)
     - target: dbt target (optional) 
-    - if_exists: 'replace' (default) or 'append'
+    - if_exists: 'replace' (default), 'append' or 'merge'
+    - unique_key: key column(s) for merge, e.g. 'id' or 'col1,col2'
     
     Usage:
     export_dataframe_to_duckdb_athena(my_df, 'my_table')
     export_dataframe_to_duckdb_athena(my_df, 'my_table', if_exists='append')
+    export_dataframe_to_duckdb_athena(my_df, 'my_table', if_exists='merge', unique_key='id')
     """
-    helper = dbtHelperAdapter('athena', profile_name, target)
-    helper.export_to_duckdb(df, table_name, if_exists)
+    helper = dbtHelperAdapter.get_or_create('athena', profile_name, target)
+    helper.export_to_duckdb(df, table_name, if_exists, unique_key)
 
 def load_ipython_extension(ipython):
     js = """IPython.CodeCell.options_default.highlight_modes['magic_sql'] = {'reg':[/^%%(athena)/]};
@@ -318,4 +738,7 @@ def load_ipython_extension(ipython):
     });
     """
     display.display_javascript(js, raw=True)
-    ipython.register_magics(AthenaSQLMagics)
\ No newline at end of file
+    ipython.register_magics(AthenaSQLMagics)
+    ipython.register_magics(ResultCacheMagics)
+    register_sync_adapter('athena', dbtHelperAdapter)
+    ipython.register_magics(DbtSyncMagics)
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""
+Background Jobs Module for dbt-magics
+
+Runs magic cells with --background on a worker thread, so long warehouse queries
+don't block the kernel. The magic returns a BackgroundJob handle that displays a
+status widget, and the result is written to the requested user_ns variable when
+the query finishes. Output printed by the job (execution time, costs, DuckDB
+export) goes to the job's widget instead of whichever cell is running.
+
+Configuration:
+- MAGICS_BACKGROUND_WORKERS: number of cells running at the same time (default 4)
+"""
+
+import html
+import logging
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import sleep, time
+
+import pandas as pd
+
+logger = logging.getLogger('dbt_magics')
+
+try:
+    import ipywidgets as widgets
+except ImportError:  # pragma: no cover - ipywidgets is a dependency, but keep plain terminals working
+    widgets = None
+
+STATUS_ICONS = {'pending': '&#9203;', 'running': '&#9203;', 'done': '&#9989;', 'failed': '&#10060;', 'cancelled': '&#9940;'}
+
+
+class _JobOutput:
+    """sys.stdout/sys.stderr proxy that sends writes of job threads to their job"""
+
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+        self.local = threading.local()
+
+    def write(self, text):
+        job = getattr(self.local, 'job', None)
+        if job is None:
+            return self.stream.write(text)
+        job._log(text, self.name)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def current_job():
+    """BackgroundJob running on the current thread, None outside of background jobs"""
+    stdout = sys.stdout
+    return getattr(stdout.local, 'job', None) if isinstance(stdout, _JobOutput) else None
+
+
+def _install_output_proxies():
+    for name in ('stdout', 'stderr'):
+        if not isinstance(getattr(sys, name), _JobOutput):
+            setattr(sys, name, _JobOutput(getattr(sys, name), name))
+    return sys.stdout, sys.stderr
+
+
+class BackgroundJob:
+    """Handle of a magic cell running in the background"""
+
+    def __init__(self, label):
+        self.label = label
+        self.status = 'pending'
+        self.error = None
+        self.submitted = time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.value = None
+        self.output = []
+        self.widget = self._build_widget() if widgets is not None else None
+
+    def _build_widget(self):
+        self._status_html = widgets.HTML()
+        self._log_output = widgets.Output(layout=widgets.Layout(max_height='200px', overflow='auto'))
+        widget = widgets.VBox([self._status_html, self._log_output])
+        self._refresh()
+        return widget
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time()) - self.started
+
+    def _summary(self):
+        if self.status == 'done':
+            if isinstance(self.value, pd.DataFrame):
+                return f'{len(self.value):,} rows x {len(self.value.columns)} columns in {self.elapsed:.1f} sec.'
+            return f'finished in {self.elapsed:.1f} sec.'
+        if self.status == 'failed':
+            return f'failed after {self.elapsed:.1f} sec.: {self.error}'
+        if self.status == 'running':
+            return f'running for {self.elapsed:.0f} sec.'
+        return self.status
+
+    def _refresh(self):
+        if not hasattr(self, '_status_html'):
+            return
+        color = {'done': 'green', 'failed': 'red'}.get(self.status, 'inherit')
+        self._status_html.value = (f"{STATUS_ICONS[self.status]} <code>{html.escape(self.label)}</code> | "
+                                   f"<span style='color:{color}'>{html.escape(self._summary())}</span>")
+
+    def _log(self, text, name='stdout'):
+        self.output.append(text)
+        if self.widget is not None:
+            if name == 'stderr':
+                self._log_output.append_stderr(text)
+            else:
+                self._log_output.append_stdout(text)
+
+    def show(self, widget):
+        """Show a widget of the job, e.g. the live status of its query, in the job's widget instead of the running cell"""
+        if self.widget is not None:
+            self.widget.children += (widget,)
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def result(self, timeout=None):
+        """Wait for the job and return its result (re-raises the error of a failed job)"""
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """Cancel the job if it hasn't started yet. Running queries can't be interrupted."""
+        cancelled = self.future.cancel()
+        if cancelled:
+            self.status = 'cancelled'
+            self._refresh()
+        return cancelled
+
+    def __repr__(self):
+        return f'<BackgroundJob {self.label} | {self._summary()}>'
+
+    def _repr_mimebundle_(self, **kwargs):
+        if self.widget is None:
+            return {'text/plain': repr(self)}
+        return self.widget._repr_mimebundle_(**kwargs)
+
+
+class BackgroundJobs:
+    """Thread pool running magic cells in the background"""
+
+    def __init__(self, max_workers=None, refresh_interval=1.0):
+        """
+        Parameters:
+        - max_workers: number of jobs running at the same time (default MAGICS_BACKGROUND_WORKERS or 4)
+        - refresh_interval: seconds between updates of the elapsed time in the status widgets
+        """
+        self.max_workers = max_workers or int(os.getenv('MAGICS_BACKGROUND_WORKERS', 4))
+        self.refresh_interval = refresh_interval
+        self.jobs = []
+        self._executor = None
+        self._ticker = None
+        self._lock = threading.Lock()
+
+    def submit(self, label, fn):
+        """
+        Run fn() on a worker thread and return its BackgroundJob
+
+        Parameters:
+        - label: shown in the status widget, e.g. '%%athena -> df'
+        - fn: callable running the query; it is responsible for writing the result to user_ns
+        """
+        stdout, stderr = _install_output_proxies()
+        job = BackgroundJob(label)
+
+        def run():
+            job.status, job.started = 'running', time()
+            job._refresh()
+            stdout.local.job = stderr.local.job = job
+            try:
+                job.value = fn()
+                job.status = 'done'
+                return job.value
+            except BaseException as e:
+                job.status, job.error = 'failed', e
+                job._log(traceback.format_exc(), 'stderr')
+                logger.debug(f'Background job {label} failed: {e}')
+                raise
+            finally:
+                job.finished = time()
+                stdout.local.job = stderr.local.job = None
+                job._refresh()
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='dbt_magics')
+            job.future = self._executor.submit(run)
+            self.jobs.append(job)
+            if self._ticker is None or not self._ticker.is_alive():
+                self._ticker = threading.Thread(target=self._tick, name='dbt_magics-ticker', daemon=True)
+                self._ticker.start()
+        return job
+
+    def _tick(self):
+        """Update the elapsed time of running jobs until all jobs are finished"""
+        while True:
+            with self._lock:
+                running = [job for job in self.jobs if not job.done()]
+                if not running:
+                    self._ticker = None
+                    return
+            for job in running:
+                if job.status == 'running':
+                    job._refresh()
+            sleep(self.refresh_interval)
+
+    def running(self):
+        return [job for job in self.jobs if not job.done()]
+
+    def wait(self, timeout=None):
+        """Wait until all submitted jobs are finished"""
+        wait([job.future for job in self.jobs], timeout)
+
+    def status(self):
+        """DataFrame with the status of all jobs of this session"""
+        rows = [dict(label=job.label, status=job.status, seconds=round(job.elapsed, 1),
+                     error=str(job.error) if job.error is not None else None) for job in self.jobs]
+        return pd.DataFrame(rows, columns=['label', 'status', 'seconds', 'error'])
+
+
+background_jobs = BackgroundJobs()
@@ -1,15 +1,37 @@
+import logging
 import os
 from pathlib import Path
 from time import time
 
 import pandas as pd
 from google.cloud import bigquery
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
 from IPython.core import display, magic_arguments
 from IPython.core.magic import Magics, line_cell_magic, magics_class
-from jinja2 import Environment, Template, meta
 
-from dbt_magics.datacontroller import DataController, debounce
+from dbt_magics.arrow_helper import arrow_to_pandas, pa
+from dbt_magics.background import background_jobs
+from dbt_magics.connections import connection_manager
+from dbt_magics.datacontroller import DataController, debounce, prStyle
 from dbt_magics.dbt_helper import dbtHelper
+from dbt_magics.duckdb_helper import DuckDBHelper
+from dbt_magics.query_history import query_history
+from dbt_magics.result_cache import ResultCacheMagics, get_result_cache
+from dbt_magics.sql_helper import execute_statements, is_read_only, split_statements
+from dbt_magics.sync import DbtSyncMagics, register_sync_adapter
+
+logger = logging.getLogger('dbt_magics')
+
+def bigquery_client(project=None):
+    """Shared BigQuery client for browsing a project"""
+    return connection_manager.pool(
+        ('bigquery', 'browser', project),
+        factory=lambda: bigquery.Client(project),
+        close=lambda client: client.close(),
+    ).shared()
 
 """
 Implementation of the BigQueryMagics class.
@@ -18,9 +40,9 @@ Implement abstract methods from DataController class.
 class BigQueryDataController(DataController):
     def __init__(self):
         # If you want to use a different project by default, set it here.
-        self.client =  bigquery.Client()
+        self.client = bigquery_client()
 
-        super().__init__(r"%%bigquery", includeLeadingQuotesInCellMagic=False, table_name_quote_sign='`')
+        super().__init__(r"%%bigquery", includeLeadingQuotesInCellMagic=False, table_name_quote_sign='`', cache_namespace=f"bigquery/{self.client.project}")
 
     """
     Implemented Abstract methods
@@ -31,7 +53,11 @@ class BigQueryDataController(DataController):
         return [d.dataset_id for d in DatasetMetadataList]
 
     def get_tables(self, dataset_id):
-        tables = self.client.list_tables(dataset_id)  # Make an API request.
+        return self.get_project_tables(self.wg_project.value, dataset_id)
+
+    def get_project_tables(self, project, dataset):
+        # Qualified with the project, the datasets may come from the metadata cache without switching self.client
+        tables = self.client.list_tables(f"{project}.{dataset}")  # Make an API request.
         table_ids = [table.table_id for table in tables]
         return table_ids
     
@@ -44,7 +70,7 @@ class BigQueryDataController(DataController):
         return [p.project_id for p in self.client.list_projects()]
     
     def get_dataset_metadata(self, ProjectName):
-        self.client = bigquery.Client(ProjectName)
+        self.client = bigquery_client(ProjectName)
         datasets = list(self.client.list_datasets())  
         DatasetMetadataList = [d for d in datasets]   
         return DatasetMetadataList
@@ -53,20 +79,160 @@ class BigQueryDataController(DataController):
 class dbtHelperAdapter(dbtHelper):
     def __init__(self, adapter_name='bigquery', profile_name="poky", target='prod'):
         super().__init__(adapter_name=adapter_name, profile_name=profile_name, target=target)
+        self.duckdb_helper = DuckDBHelper(self)
         
     def source(self, schema_name, table):
-        SOURCES, _ = self._sources_and_models()        
+        relation = self._manifest_source(schema_name, table)
+        if relation:
+            return '`{database}`.`{schema}`.`{identifier}`'.format(**relation)
         default_project = [i for i in map(self.profile_config.get, ['project', 'dbname', 'database', 'dataset']) if i][0]
-        source = self._search_for_source_table(SOURCES, target_schema=schema_name, target_table=table, default_database=default_project)
+        source = self._find_source(target_schema=schema_name, target_table=table, default_database=default_project)
         results = '`{project}`.`{schema}`.`{table}`'.format(schema=source['schema'], project=default_project, table=source['table'])
         return results
 
-    def ref(self, table_name):
+    def ref(self, *args):
+        package_name, table_name = self._split_ref_args(args)
+        relation = self._manifest_ref(package_name, table_name)
+        if relation:
+            return '`{database}`.`{schema}`.`{identifier}`'.format(**relation)
         custom_schema = self._get_custom_schema(table_name)
         default_schema = self.profile_config.get("dataset")
         default_project = self.profile_config.get("project")
         return f'`{default_project}`.`{custom_schema}`.`{table_name}`'
 
+    def connections(self):
+        """Pool of warm BigQuery clients for this profile and target"""
+        project, location = self.profile_config.get("project"), self.profile_config.get("location")
+        return connection_manager.pool(
+            ('bigquery', self.profile_name, self.target),
+            factory=lambda: bigquery.Client(project=project, location=location),
+            signature=(project, location),
+            close=lambda client: client.close(),
+        )
+
+    # DuckDB methods - delegated to DuckDBHelper
+    def check_duckdb_availability(self):
+        """Check if DuckDB database is available and not locked"""
+        return self.duckdb_helper.check_duckdb_availability()
+
+    def extract_ref_table_name(self, sql_statement):
+        """Extract table name from dbt ref() function in SQL statement"""
+        return self.duckdb_helper.extract_ref_table_name(sql_statement)
+
+    def export_to_duckdb(self, df, table_name, if_exists='replace', unique_key=None):
+        """Export DataFrame to DuckDB using dbt naming conventions"""
+        return self.duckdb_helper.export_to_duckdb(df, table_name, if_exists, unique_key)
+
+    def export_stream_to_duckdb(self, batches, table_name, if_exists='replace', memory_limit=None, preview_rows=5, unique_key=None):
+        """Stream Arrow record batches into DuckDB using dbt naming conventions"""
+        return self.duckdb_helper.export_stream(batches, table_name, if_exists, memory_limit, preview_rows, unique_key)
+
+    def bqstorage_client(self):
+        """Shared BigQuery Storage Read API client, None if google-cloud-bigquery-storage is not installed"""
+        if bigquery_storage is None:
+            return None
+        return connection_manager.pool(
+            ('bigquery_storage', self.profile_name, self.target),
+            factory=bigquery_storage.BigQueryReadClient,
+        ).shared()
+
+    def fetch_dataframe(self, rows):
+        """
+        Download query results as Arrow record batches and convert them to a typed DataFrame.
+        The Storage Read API reads the result table with several streams in parallel;
+        without it (or without permission to use it) the results are paged via the REST API.
+
+        Parameters:
+        - rows: google.cloud.bigquery RowIterator of a query job or result table
+
+        Returns:
+        - (DataFrame, name of the download path)
+        """
+        if pa is None:
+            return pd.DataFrame([dict(row) for row in rows]), 'rows'
+        try:
+            bqstorage_client = self.bqstorage_client()
+            if bqstorage_client is not None:
+                return arrow_to_pandas(rows.to_arrow(bqstorage_client=bqstorage_client)), 'storage api'
+        except Exception as e:
+            logger.debug(f'Storage Read API download failed, falling back to paged download: {e}')
+        return arrow_to_pandas(rows.to_arrow(create_bqstorage_client=False)), 'paged'
+
+    def iter_arrow_batches(self, statement):
+        """Run a query and yield its result as Arrow record batches, via Storage Read API streams when available"""
+        job = self.connections().run(lambda client: client.query(statement), retry=is_read_only(statement))
+        rows = job.result()
+        print(f'Execution time: {job.ended - job.started} | Bytes Billed: {job.total_bytes_billed}')
+        try:
+            bqstorage_client = self.bqstorage_client()
+        except Exception as e:
+            logger.debug(f'Storage Read API unavailable, falling back to paged download: {e}')
+            bqstorage_client = None
+        empty = True
+        for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+            empty = False
+            yield batch
+        if empty:
+            # Empty result: take the schema from an (empty) paged download
+            yield pa.RecordBatch.from_pylist([], schema=job.result().to_arrow(create_bqstorage_client=False).schema)
+
+    def run_statements(self, statements, concurrent=None):
+        """
+        Run the statements of a cell in order, or concurrently on up to `concurrent` pooled clients.
+        Statements running in order share a BigQuery session, so temporary tables and variables
+        of earlier statements are visible to later ones.
+        """
+        session_id = None
+
+        def execute(client, statement):
+            nonlocal session_id
+            start = time()
+            if concurrent:
+                job_config = None
+            elif session_id is None:
+                job_config = bigquery.QueryJobConfig(create_session=True)
+            else:
+                job_config = bigquery.QueryJobConfig(connection_properties=[bigquery.ConnectionProperty('session_id', session_id)])
+            job = client.query(statement, job_config=job_config)
+            rows = job.result()
+            if not concurrent and session_id is None and job.session_info is not None:
+                session_id = job.session_info.session_id
+            df, _ = self.fetch_dataframe(rows)
+            duration = time()-start
+            print(f'Execution time: {int(duration//60)} min. - {duration%60:.2f} sec. | Bytes Billed: {job.total_bytes_billed}')
+            return df
+
+        pool = self.connections()
+        try:
+            return execute_statements(pool, statements, execute, concurrent)
+        finally:
+            if session_id is not None:
+                job_config = bigquery.QueryJobConfig(connection_properties=[bigquery.ConnectionProperty('session_id', session_id)])
+                try:
+                    pool.run(lambda client: client.query('CALL BQ.ABORT_SESSION()', job_config=job_config).result())
+                except Exception as e:
+                    logger.debug(f'Could not end BigQuery session {session_id}: {e}')
+
+    def reuse_previous_job(self, reuse_key, reuse):
+        """
+        Rows of the last run of the same statement within reuse minutes, read from the
+        job's destination table instead of running the query again.
+
+        Returns:
+        - (QueryJob, RowIterator) or (None, None) if there is nothing to reuse
+        """
+        previous = query_history.lookup(reuse_key, reuse)
+        if previous is None:
+            return None, None
+        try:
+            job = self.connections().run(lambda client: client.get_job(previous['query_id'], location=previous.get('location')), retry=True)
+            rows = self.connections().run(lambda client: client.list_rows(job.destination), retry=True)
+        except Exception:
+            # Anonymous result tables expire after about 24 hours
+            query_history.forget(reuse_key)
+            return None, None
+        return job, rows
+
 @magics_class
 class BigQuerySQLMagics(Magics):
     pd.set_option('display.max_columns', None)
@@ -79,6 +245,15 @@ class BigQuerySQLMagics(Magics):
     @magic_arguments.argument('--params', default='', help='Add additional Jinja params.')
     @magic_arguments.argument('--profile', default='poky', help='')
     @magic_arguments.argument('--target', default='prod', help='')
+    @magic_arguments.argument('--reuse', nargs='?', const=60, default=None, type=int, help='Reuse the results of the same statement run within the last N minutes (default 60).')
+    @magic_arguments.argument('--cache', nargs='?', const=60, default=None, type=int, help='Cache the result locally for N minutes (default 60, 0 never expires). See %%dbt_cache.')
+    @magic_arguments.argument('--export_duckdb', '-ddb', action='store_true', help='Export DataFrame to DuckDB using table name from dbt ref().')
+    @magic_arguments.argument('--duckdb_mode', '-mode', default='replace', choices=['replace', 'append', 'merge'], help='DuckDB export mode: replace (default), append or merge (upsert by --unique_key).')
+    @magic_arguments.argument('--unique_key', default=None, help='Comma separated key column(s) for --duckdb_mode merge, e.g. id or col1,col2.')
+    @magic_arguments.argument('--stream', action='store_true', help='With --export_duckdb: stream record batches into DuckDB without building a DataFrame (requires pyarrow).')
+    @magic_arguments.argument('--memory_limit', default=None, type=int, help='DuckDB memory limit in MB for --stream.')
+    @magic_arguments.argument('--concurrent', nargs='?', const=4, default=None, type=int, help='Run the statements of a multi-statement cell concurrently on up to N pooled connections (default 4). By default they run in order on one connection.')
+    @magic_arguments.argument('--background', '-bg', action='store_true', help='Run the query on a worker thread and return immediately. The result is stored in --dataframe when it finishes.')
     def bigquery(self, line, cell=None):
         """
         ---------------------------------------------------------------------------
@@ -94,6 +269,41 @@ class BigQuerySQLMagics(Magics):
         {{params.b, params.a}}
         SELECT * FROM {{ ref('table_in_dbt_project') }}
         ---------------------------------------------------------------------------
+        ---------------------------------------------------------------------------
+        %%bigquery --reuse 30
+
+        SELECT * FROM {{ ref('table_in_dbt_project') }}  # Reads the result table of the same statement from the last 30 minutes
+        ---------------------------------------------------------------------------
+        ---------------------------------------------------------------------------
+        %%bigquery --cache
+
+        SELECT * FROM {{ ref('table_in_dbt_project') }}  # Result is cached locally as Parquet for 60 minutes, see %dbt_cache
+        ---------------------------------------------------------------------------
+        ---------------------------------------------------------------------------
+        %%bigquery --export_duckdb
+
+        SELECT * FROM {{ ref('table_in_dbt_project') }}  # Mirrored to DuckDB
+
+        %%bigquery --export_duckdb --stream --memory_limit 2048
+
+        SELECT * FROM {{ ref('table_in_dbt_project') }}  # Streamed into DuckDB batch by batch, df is not created
+        ---------------------------------------------------------------------------
+        ---------------------------------------------------------------------------
+        %%bigquery
+
+        CREATE TEMP TABLE recent AS SELECT * FROM {{ ref('table_in_dbt_project') }};
+        SELECT count(*) FROM recent;  # Runs in order in one BigQuery session, results in df_1, df_2 and df (the last)
+
+        %%bigquery --concurrent
+
+        SELECT * FROM {{ ref('orders') }};
+        SELECT * FROM {{ ref('customers') }};  # Independent statements run at the same time
+        ---------------------------------------------------------------------------
+        ---------------------------------------------------------------------------
+        %%bigquery --background -df orders
+
+        SELECT * FROM {{ ref('table_in_dbt_project') }}  # Returns a job handle at once, orders is set when the query finishes
+        ---------------------------------------------------------------------------
         """
         if cell == None:
             dc = BigQueryDataController()
@@ -101,41 +311,118 @@ class BigQuerySQLMagics(Magics):
 
         args = magic_arguments.parse_argstring(self.bigquery, line)
 
-        self.dbt_helper = dbtHelperAdapter('bigquery', args.profile, args.target)
+        self.dbt_helper = dbtHelperAdapter.get_or_create('bigquery', args.profile, args.target)
 
-        env = Environment()
         def ipython(variable):
             try: result = get_ipython().ev(variable)
             except: result = False
             return result
 
-        kwargs = {i:ipython(i) for i in meta.find_undeclared_variables(env.parse(cell)) if ipython(i)}
+        kwargs = {i:ipython(i) for i in self.dbt_helper.undeclared_variables(cell) if ipython(i)}
 
-        macros_txt = self.dbt_helper.macros_txt
-        jinja_statement = macros_txt+cell
-        statement = Template(jinja_statement).render(source=self.dbt_helper.source, ref=self.dbt_helper.ref, var=self.dbt_helper.var, **kwargs).strip()
+        statement = self.dbt_helper.render(cell, **kwargs)
 
 
-        start = time()
         if args.parser:
+            macros = self.dbt_helper.required_macros(cell)
+            if macros:
+                print(f"-- macros: {', '.join(macros)}")
             print(statement)
         else:
-            #--------------------------------------------- Start
-            client = bigquery.Client(project=self.dbt_helper.profile_config.get("project"), location=self.dbt_helper.profile_config.get("location"))
-            results = client.query(statement)
-            flat_results = [dict(row) for row in results.result()]
-            df = pd.DataFrame(flat_results)
-            duration = time()-start
-            # https://cloud.google.com/bigquery/docs/reference/rest/v2/Job#JobStatistics2.FIELDS.total_bytes_billed
-            # cost per GB 0,023 * 1e-9 = cost per byte
-            PriceInDollar = str(results.estimated_bytes_processed * (0.023 * 1e-9) if results.estimated_bytes_processed != None else "") \
-                + "$" if (results.total_bytes_billed != None) \
-                    else "error calculating price"
-            print(f'Execution time: {int(duration//60)} min. - {duration%60:.2f} sec.\
-                | Cost: {PriceInDollar} Bytes Billed: {results.estimated_bytes_processed}') 
-            #--------------------------------------------- End
-
-            self.shell.user_ns[args.dataframe] = df
+            if args.export_duckdb and args.duckdb_mode == 'merge' and not args.unique_key:
+                print(f"{prStyle.RED}--duckdb_mode merge requires --unique_key, e.g. --unique_key id or --unique_key col1,col2{prStyle.RESET}")
+                return None
+
+            # Check DuckDB availability before executing query if export is requested
+            if args.export_duckdb:
+                if not self.dbt_helper.check_duckdb_availability():
+                    print(f"{prStyle.RED}Aborting query execution due to DuckDB unavailability.{prStyle.RESET}")
+                    return None
+
+            # Background jobs keep their own reference, later cells may switch self.dbt_helper
+            dbt_helper = self.dbt_helper
+            statements = split_statements(statement)
+
+            # Stream straight into DuckDB without building a DataFrame
+            if args.stream:
+                table_name = self.dbt_helper.extract_ref_table_name(cell)
+                if not args.export_duckdb or not table_name:
+                    print(f"{prStyle.RED}--stream requires --export_duckdb and a ref() to name the DuckDB table.{prStyle.RESET}")
+                    return None
+                if len(statements) > 1:
+                    print(f"{prStyle.RED}--stream runs a single statement, this cell contains {len(statements)}.{prStyle.RESET}")
+                    return None
+                batches = self.dbt_helper.iter_arrow_batches(statement)
+                export = lambda: dbt_helper.export_stream_to_duckdb(batches, table_name, args.duckdb_mode, args.memory_limit, preview_rows=int(args.n_output), unique_key=args.unique_key)
+                if args.background:
+                    return background_jobs.submit(f'%%bigquery --stream -> {table_name}', export)
+                df = export()
+                return df if int(args.n_output) else None
+
+            def execute():
+                start = time()
+                #--------------------------------------------- Start
+                def run():
+                    results = rows = None
+                    if args.reuse:
+                        reuse_key = query_history.key(dbt_helper.adapter_name, dbt_helper.profile_name, dbt_helper.target, statement)
+                        results, rows = dbt_helper.reuse_previous_job(reuse_key, args.reuse)
+                    reused = previous_job = results is not None
+                    if results is None:
+                        results = dbt_helper.connections().run(lambda client: client.query(statement), retry=is_read_only(statement))
+                        rows = results.result()
+                        reused = bool(results.cache_hit)
+                        if args.reuse:
+                            query_history.record(reuse_key, results.job_id, location=results.location)
+                    download_start = time()
+                    df, download_path = dbt_helper.fetch_dataframe(rows)
+                    download = time()-download_start
+                    duration = time()-start
+                    # https://cloud.google.com/bigquery/docs/reference/rest/v2/Job#JobStatistics2.FIELDS.total_bytes_billed
+                    # cost per GB 0,023 * 1e-9 = cost per byte
+                    PriceInDollar = str(results.estimated_bytes_processed * (0.023 * 1e-9) if results.estimated_bytes_processed != None else "") \
+                        + "$" if (results.total_bytes_billed != None) \
+                            else "error calculating price"
+                    if previous_job:
+                        # Reading the previous job's destination table isn't billed, its figures are the original run's
+                        print(f'Execution time: {int(duration//60)} min. - {duration%60:.2f} sec. | Cost: 0$ Bytes Billed: 0'
+                              f' | reused {results.job_id} (original job: {PriceInDollar} Bytes Billed: {results.estimated_bytes_processed})')
+                    else:
+                        print(f'Execution time: {int(duration//60)} min. - {duration%60:.2f} sec.\
+                        | Cost: {PriceInDollar} Bytes Billed: {results.estimated_bytes_processed}'
+                        + (f' | reused {results.job_id}' if reused else '')) 
+                    print(f'Download: {len(df)} rows in {download:.2f} sec. ({len(df)/max(download, 1e-6):,.0f} rows/s, {download_path})')
+                    return df
+
+                if len(statements) > 1:
+                    results = dbt_helper.run_statements(statements, args.concurrent)
+                    for index, result in enumerate(results, 1):
+                        self.shell.user_ns[f'{args.dataframe}_{index}'] = result
+                    df = results[-1]
+                    print(f"{prStyle.BLUE}{len(results)} statements{prStyle.RESET} | results in {args.dataframe}_1 ... {args.dataframe}_{len(results)}, {args.dataframe} is the last one")
+                elif args.cache is not None:
+                    df = get_result_cache().cached(statement, dbt_helper.adapter_name, dbt_helper.profile_name, dbt_helper.target, args.cache, run)
+                else:
+                    df = run()
+                #--------------------------------------------- End
+
+                self.shell.user_ns[args.dataframe] = df
+
+                # Export to DuckDB if requested
+                if args.export_duckdb and df is not None:
+                    # Extract table name from ref() in the original cell content
+                    table_name = dbt_helper.extract_ref_table_name(cell)
+
+                    if table_name:
+                        dbt_helper.export_to_duckdb(df, table_name, args.duckdb_mode, args.unique_key)
+                    else:
+                        print(f"{prStyle.RED}No ref() function found in SQL. Please use ref('table_name') to specify the table for DuckDB export.{prStyle.RESET}")
+                return df
+
+            if args.background:
+                return background_jobs.submit(f'%%bigquery -> {args.dataframe}', execute)
+            df = execute()
+
             df = df.head(int(args.n_output)) if type(df)==pd.DataFrame else None
             return df
 
@@ -147,4 +434,7 @@ def load_ipython_extension(ipython):
     });
     """
     display.display_javascript(js, raw=True)
-    ipython.register_magics(BigQuerySQLMagics)
\ No newline at end of file
+    ipython.register_magics(BigQuerySQLMagics)
+    ipython.register_magics(ResultCacheMagics)
+    register_sync_adapter('bigquery', dbtHelperAdapter)
+    ipython.register_magics(DbtSyncMagics)
\ No newline at end of file
@@ -0,0 +1,238 @@
+"""
+Connection Manager Module for dbt-magics
+
+Keeps warehouse connections (Snowpark sessions, boto3 clients, BigQuery clients,
+SQLite connections) warm per (adapter, profile, target), so that cells and
+DataControllers don't pay authentication and handshake latency on every run.
+
+Idle connections are health checked before reuse, and connections that fail
+with an expired session or credentials are replaced. Only calls the caller marks
+as safe to repeat (e.g. read-only statements) are retried on the new connection.
+"""
+
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import time
+
+logger = logging.getLogger('dbt_magics')
+
+# Error messages that mean the connection (not the statement) is broken
+EXPIRED_PATTERN = r'expired|authenticat|session (is )?(closed|no longer exists)|connection (reset|closed|aborted)|broken pipe|not connected'
+
+
+class ConnectionPool:
+    """Pool of warm connections for one (adapter, profile, target)"""
+
+    def __init__(self, factory, health_check=None, close=None, expired_pattern=EXPIRED_PATTERN, keepalive=300, max_idle=4):
+        """
+        Parameters:
+        - factory: callable creating a new connection
+        - health_check: callable(connection) raising if the connection is unusable (optional)
+        - close: callable(connection) closing a connection (optional)
+        - expired_pattern: regex matched against error messages of expired sessions and credentials
+        - keepalive: seconds a connection may be idle before it is health checked again
+        - max_idle: number of idle connections kept open
+        """
+        self.factory = factory
+        self.health_check = health_check
+        self._close = close
+        self.expired_pattern = expired_pattern
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self._idle = []  # [(connection, last used), ...]
+        self._shared = None
+        self._lock = threading.Lock()
+        self.stats = dict(created=0, reused=0, reconnected=0)
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _connect(self):
+        connection = self.factory()
+        self._count('created')
+        return connection
+
+    def _is_alive(self, connection, last_used):
+        if self.health_check is None or time() - last_used < self.keepalive:
+            return True
+        try:
+            self.health_check(connection)
+            return True
+        except Exception as e:
+            logger.debug(f'Discarding stale connection: {e}')
+            return False
+
+    def is_expired_error(self, error):
+        """True if an error means the connection or its credentials expired"""
+        return re.search(self.expired_pattern, str(error), re.IGNORECASE) is not None
+
+    def discard(self, connection):
+        """Close a connection without returning it to the pool"""
+        if self._close is None:
+            return
+        try:
+            self._close(connection)
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Take a connection out of the pool, creating one if no healthy idle connection exists"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            if self._is_alive(connection, last_used):
+                self._count('reused')
+                return connection
+            self.discard(connection)
+        return self._connect()
+
+    def release(self, connection):
+        """Return a connection to the pool"""
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((connection, time()))
+                return
+        self.discard(connection)
+
+    @contextmanager
+    def connection(self):
+        """Context manager handing out a pooled connection"""
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException as e:
+            if self.is_expired_error(e):
+                self.discard(connection)
+            else:
+                self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def run(self, fn, retry=False):
+        """
+        Call fn(connection) with a pooled connection.
+        If the connection turns out to be expired, it is replaced. fn is only called again on
+        the new connection if retry is True: the statement may have run before the connection
+        broke, and running e.g. an INSERT or MERGE twice is not safe.
+
+        Parameters:
+        - fn: callable(connection)
+        - retry: fn is safe to repeat, e.g. a read-only statement (see sql_helper.is_read_only)
+        """
+        connection = self.acquire()
+        try:
+            result = fn(connection)
+        except BaseException as e:
+            if not isinstance(e, Exception) or not self.is_expired_error(e):
+                self.release(connection)
+                raise
+            self.discard(connection)
+            if not retry:
+                raise
+            logger.debug(f'Reconnecting after expired connection: {e}')
+            self._count('reconnected')
+            connection = self._connect()
+            try:
+                result = fn(connection)
+            except BaseException:
+                self.release(connection)
+                raise
+        self.release(connection)
+        return result
+
+    def run_many(self, fn, items, concurrent=False, max_workers=4):
+        """
+        Call fn(connection, item) for each item and return the results in order.
+
+        Sequential calls share one connection, so later items see the session state
+        (temporary tables, variables, USE statements) of earlier ones. Concurrent calls
+        run on up to max_workers pooled connections.
+        """
+        items = list(items)
+        if not concurrent or len(items) < 2:
+            with self.connection() as connection:
+                return [fn(connection, item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix='dbt_magics') as executor:
+            return list(executor.map(lambda item: self.run(lambda connection: fn(connection, item)), items))
+
+    def shared(self):
+        """
+        Long-lived connection shared by DataControllers for metadata browsing.
+        Health checked like pooled connections and replaced when it is stale.
+        """
+        with self._lock:
+            shared = self._shared
+        if shared is not None and self._is_alive(*shared):
+            connection = shared[0]
+        else:
+            if shared is not None:
+                self.discard(shared[0])
+            connection = self._connect()
+        with self._lock:
+            self._shared = (connection, time())
+        return connection
+
+    def snapshot(self):
+        """Copy of the stats with the number of idle connections"""
+        with self._lock:
+            return dict(self.stats, idle=len(self._idle))
+
+    def close(self):
+        """Close all idle and shared connections"""
+        with self._lock:
+            connections = [c for c, _ in self._idle] + ([self._shared[0]] if self._shared else [])
+            self._idle, self._shared = [], None
+        for connection in connections:
+            self.discard(connection)
+
+
+class ConnectionManager:
+    """Process-wide registry of connection pools keyed by (adapter, profile, target)"""
+
+    def __init__(self):
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def pool(self, key, factory, signature=None, **kwargs):
+        """
+        Get the pool for a key, creating it on first use
+
+        Parameters:
+        - key: tuple like (adapter, profile, target)
+        - factory: callable creating a new connection
+        - signature: connection settings; the pool is rebuilt when they change
+        - kwargs: passed to ConnectionPool
+        """
+        with self._lock:
+            entry = self._pools.get(key)
+            if entry is not None and entry[0] == signature:
+                return entry[1]
+            pool = ConnectionPool(factory, **kwargs)
+            self._pools[key] = (signature, pool)
+        if entry is not None:
+            entry[1].close()
+        return pool
+
+    def close(self, key=None):
+        """Close the pool of one key, or all pools"""
+        with self._lock:
+            keys = [key] if key is not None else list(self._pools)
+            entries = [self._pools.pop(k) for k in keys if k in self._pools]
+        for _, pool in entries:
+            pool.close()
+
+    def stats(self):
+        """Connection statistics per pool"""
+        with self._lock:
+            pools = {key: pool for key, (_, pool) in self._pools.items()}
+        return {key: pool.snapshot() for key, pool in pools.items()}
+
+
+connection_manager = ConnectionManager()
@@ -1,8 +1,18 @@
 import asyncio
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import html
+import logging
 import re
+import threading
 import ipywidgets as widgets
 from pandas.io.clipboard import clipboard_set
+from traitlets import Any, Bunch
+
+from dbt_magics.metadata_cache import LEVELS, as_metadata, get_metadata_cache
+from dbt_magics.search_index import get_search_index
+
+logger = logging.getLogger('dbt_magics')
 
 
 # Styling
@@ -27,11 +37,192 @@ class CB(widgets.HBox):
         self.layout = layout
         self.check = widgets.Checkbox(value=True, description=name, indent=False)
         self.lab = widgets.Label(dtype.upper())
+        self._style = None
+        self.set(name, dtype)
+        self.children = (self.check, self.lab)
+
+    # Show another column, the rows of VirtualCheckList are reused while paging
+    def set(self, name, dtype):
+        self.check.description = name
+        self.lab.value = dtype.upper()
         dtype = dtype if "int" not in dtype else "int"
         dtype = 'decimal' if "decimal" in dtype else dtype
         dtype = 'string' if "varchar" in dtype else dtype
-        self.lab.add_class(f'aen_cb_lab_style_{dtype}')
-        self.children = (self.check, self.lab)
+        if self._style is not None:
+            self.lab.remove_class(self._style)
+        self._style = f'aen_cb_lab_style_{dtype}'
+        self.lab.add_class(self._style)
+
+
+# Buttons and position label to page through a virtual list
+class Pager(widgets.HBox):
+    def __init__(self, on_turn):
+        super().__init__()
+        self.previous = widgets.Button(icon='chevron-left', layout=widgets.Layout(width='40px'))
+        self.next = widgets.Button(icon='chevron-right', layout=widgets.Layout(width='40px'))
+        self.info = widgets.Label()
+        self.previous.on_click(lambda x: on_turn(-1))
+        self.next.on_click(lambda x: on_turn(1))
+        self.children = (self.previous, self.info, self.next)
+
+    def update(self, start, shown, total):
+        self.info.value = f'{start + 1:,}-{start + shown:,} of {total:,}' if shown else 'no matches'
+        self.previous.disabled = start == 0
+        self.next.disabled = start + shown >= total
+
+
+# Select over many options (e.g. 100k tables) that only renders the page of rows on screen.
+# Filtering doesn't rebuild widgets; options, value and index work like on widgets.Select.
+class VirtualSelect(widgets.VBox):
+    value = Any(None, allow_none=True)
+
+    def __init__(self, options=(), rows=10):
+        super().__init__()
+        self.rows = rows
+        self._labels, self._values, self._positions = [], (), {}
+        self._filter, self._visible, self._page = '', range(0), 0
+        self._rendering = False
+        self._select = widgets.Select(options=[], rows=rows)
+        self._pager = Pager(self._turn)
+        self.children = (self._select, self._pager)
+        self._select.observe(self._on_select, names='value')
+        self.observe(lambda change: self._show(change['new']), names='value')
+        self.options = options
+
+    @property
+    def options(self):
+        return self._values
+
+    @options.setter
+    def options(self, options):
+        pairs = [option if isinstance(option, tuple) else (option, option) for option in options]
+        self._labels = [label for label, _ in pairs]
+        self._values = tuple(value for _, value in pairs)
+        self._positions = {value: position for position, value in enumerate(self._values)}
+        self._refilter()
+        if self.value not in self._positions:
+            self.value = None
+        self._show(self.value)
+
+    @property
+    def index(self):
+        return self._positions.get(self.value)
+
+    @index.setter
+    def index(self, index):
+        self.value = None if index is None else self._values[index]
+
+    # Show only the options containing text (case-insensitive). Returns the values of the matching options.
+    def filter(self, text):
+        self._filter = text.lower()
+        self._refilter()
+        self._show(self.value)
+        return [self._values[position] for position in self._visible]
+
+    def _refilter(self):
+        if self._filter:
+            self._visible = [position for position, label in enumerate(self._labels) if self._filter in label.lower()]
+        else:
+            self._visible = range(len(self._labels))
+
+    # Turn to the page of value (the first page if it isn't shown) and render it
+    def _show(self, value):
+        position = self._positions.get(value)
+        try:
+            self._page = self._visible.index(position) // self.rows if position is not None else 0
+        except ValueError:
+            self._page = 0
+        self._render()
+
+    def _turn(self, pages):
+        self._page = max(0, self._page + pages)
+        self._render()
+
+    def _render(self):
+        start = self._page * self.rows
+        page = self._visible[start:start + self.rows]
+        self._rendering = True
+        try:
+            self._select.options = tuple((self._labels[position], self._values[position]) for position in page)
+            self._select.value = self.value if self._positions.get(self.value) in page else None
+        finally:
+            self._rendering = False
+        self._pager.update(start, len(page), len(self._visible))
+
+    def _on_select(self, change):
+        if not self._rendering and change['new'] is not None:
+            self.value = change['new']
+
+
+# Column checkboxes of wide tables: only the page of rows on screen is rendered and its CB widgets are
+# reused while paging and filtering. The check state of all columns is kept in a bytearray.
+class VirtualCheckList(widgets.VBox):
+    def __init__(self, rows=15):
+        super().__init__()
+        self.rows = rows
+        self.items, self.checked = [], bytearray()
+        self._filter, self._visible, self._page = '', range(0), 0
+        self._rendering = False
+        self._boxes = [CB('', '') for _ in range(rows)]
+        for position, box in enumerate(self._boxes):
+            box.check.observe(lambda change, position=position: self._on_check(position, change), names='value')
+        self._pager = Pager(self._turn)
+        self.children = tuple(self._boxes) + (self._pager,)
+        self._render()
+
+    # Show the columns of another table, all checked. items: [(column_name, data_type), ...]
+    def set_items(self, items):
+        self.items = [(name, dtype) for name, dtype in items]
+        self.checked = bytearray(b'\x01' * len(self.items))
+        self._refilter()
+        self._render()
+
+    def filter(self, text):
+        self._filter = text.lower()
+        self._refilter()
+        self._render()
+
+    def set_all(self, value):
+        self.checked = bytearray((b'\x01' if value else b'\x00') * len(self.items))
+        self._render()
+
+    def all_checked(self):
+        return 0 not in self.checked
+
+    # Checked columns as (column_name, data_type)
+    def selected(self):
+        return [item for item, checked in zip(self.items, self.checked) if checked]
+
+    def _refilter(self):
+        if self._filter:
+            self._visible = [position for position, (name, _) in enumerate(self.items) if self._filter in name.lower()]
+        else:
+            self._visible = range(len(self.items))
+        self._page = 0
+
+    def _turn(self, pages):
+        self._page = max(0, self._page + pages)
+        self._render()
+
+    def _render(self):
+        start = self._page * self.rows
+        page = self._visible[start:start + self.rows]
+        self._rendering = True
+        try:
+            for box, position in zip(self._boxes, page):
+                box.set(*self.items[position])
+                box.check.value = bool(self.checked[position])
+                box.layout.display = None
+            for box in self._boxes[len(page):]:
+                box.layout.display = 'none'
+        finally:
+            self._rendering = False
+        self._pager.update(start, len(page), len(self._visible))
+        self._pager.layout.display = None if len(self._visible) > self.rows else 'none'
+
+    def _on_check(self, position, change):
+        if not self._rendering:
+            self.checked[self._visible[self._page * self.rows + position]] = change['new']
 
 # Code for Timer and debounce
 # is from https://ipywidgets.readthedocs.io/en/latest/examples/Widget%20Events.html#Debouncing
@@ -79,21 +270,43 @@ due to the different dependencies (e.g. BigQuery, Athena, SQLite)
 class DataController(ABC):
     """
     lineMagicName: The name of the line magic that is displayed in the output widget, e.g. %bigquery or %athena
+    cache_namespace: Key of the data source in the metadata cache, e.g. athena/my_profile/dev (default lineMagicName)
     """
-    def __init__(self, lineMagicName, includeLeadingQuotesInCellMagic=True, table_name_quote_sign='"'):
-        self.projects = self.get_projects()
+    def __init__(self, lineMagicName, includeLeadingQuotesInCellMagic=True, table_name_quote_sign='"', cache_namespace=None):
+        self.metadata = get_metadata_cache()
+        self.cache_namespace = cache_namespace or lineMagicName
+        self._keep_selection = False
+        # Metadata is fetched on the thread pool, prefetches and background refreshes queue on their own worker
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='dbt_magics-metadata')
+        self._prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dbt_magics-prefetch')
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._generations = dict.fromkeys(LEVELS, 0)
+        self._status = {}
+        # (project, dataset, table) picked in the global search, selected as the dropdowns load
+        self._target = None
+        self.search_index = get_search_index(self.cache_namespace)
+        self._prefetcher.submit(self.search_index.load, self.metadata, self.cache_namespace)
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        self.projects, self.tables = [], []
+        self.partition_columns = []
         self.lineMagicName = lineMagicName
         self.includeLeadingQuotesInCellMagic = includeLeadingQuotesInCellMagic
         self.table_name_quote_sign = table_name_quote_sign
 
         #----------- WIDGETS -----------#
         # self.wg_catalog = widgets.Dropdown(options=self.catalog_names, value=None)
-        self.wg_project = widgets.Dropdown(options=[p for p in self.projects])
+        self.wg_project = widgets.Dropdown(options=[])
         self.wg_search_table = widgets.Text(placeholder='Search for table...')
         self.wg_database = widgets.Dropdown(options=[])
-        self.wg_tables = widgets.Select(options=[])
-        self.set_dataset_options(self.wg_project.value)
-        self.set_tables_options(self.wg_database.value)
+        self.wg_tables = VirtualSelect(rows=10)
+        self.wg_status = widgets.HTML()
+        self.wg_search_all = widgets.Text(placeholder='Search tables of all datasets...')
+        self.wg_harvest = widgets.Button(icon='database', tooltip='Index the tables of all projects and datasets for the search', layout=widgets.Layout(width='40px'))
+        self.wg_search_results = widgets.Select(options=[], rows=8, layout=widgets.Layout(display='none'))
 
         self.wg_style = widgets.HTML('''<style>
             .widget-text input[type="text"] {max-width:650px; background-color:#89d5c7; border-radius:7px; font-size: 13pt}
@@ -114,12 +327,13 @@ class DataController(ABC):
             </style>''')
         
         
-        self.wg_base_dropdowns = widgets.VBox(children=[self.wg_project, self.wg_database, self.wg_search_table, self.wg_tables])
+        self.wg_refresh = widgets.Button(icon='refresh', tooltip='Reload metadata', layout=widgets.Layout(width='40px'))
+        self.wg_base_dropdowns = widgets.VBox(children=[widgets.HBox([self.wg_search_all, self.wg_harvest]), self.wg_search_results, widgets.HBox([self.wg_project, self.wg_refresh]), self.wg_database, self.wg_search_table, self.wg_tables, self.wg_status])
         self.wg_base_dropdowns.add_class('wg_base_dropdowns')
         self.all_columns = widgets.Button(description="All Columns")
         self.wg_search_column = widgets.Text(placeholder='<column>')
         self.wg_columns_and_search = widgets.HBox(children=[self.all_columns, self.wg_search_column])
-        self.wg_check_boxes = widgets.VBox(children=[])
+        self.wg_check_boxes = VirtualCheckList()
         self.wg_columns_container = widgets.VBox(children=[self.wg_columns_and_search, self.wg_check_boxes])
         self.wg_column = widgets.Accordion(children=[self.wg_columns_container], selected_index=None)    
         self.select_sql = widgets.Button(description="SELECT", icon='fa-copy')
@@ -134,14 +348,19 @@ class DataController(ABC):
             )  
         
         #----------- WIDGET ACTIONS -----------#
-        self.wg_project.observe(self.set_dataset_options, names='value')
-        self.wg_database.observe(self.set_tables_options, names='value')
-        self.wg_tables.observe(self.set_columns_options, names='value')
+        self._observe(self.wg_project, self.set_dataset_options)
+        self._observe(self.wg_database, self.set_tables_options)
+        self._observe(self.wg_tables, self.set_columns_options)
+        self.wg_refresh.on_click(self.refresh_metadata)
         self.select_sql.on_click(self.on_button_clicked)
         self.select_sql_star.on_click(lambda x: self.on_button_clicked(x, star=True))
-        self.wg_search_table.observe(self.search_tables, names='value')
+        self._observe(self.wg_search_table, self.search_tables)
+        self.wg_search_all.observe(self.search_all_tables, names='value')
+        self._observe(self.wg_search_results, lambda change: self.jump_to(*change['new']) if change['new'] else None)
+        self.wg_harvest.on_click(lambda x: threading.Thread(target=self.harvest_tables, name='dbt_magics-harvest', daemon=True).start())
         self.all_columns.on_click(self.all_columns_handler)
         self.wg_search_column.observe(self.search_columns, names='value')
+        self._request('projects', ())
         
 
     """ Abstract methods """
@@ -187,44 +406,326 @@ class DataController(ABC):
     def get_columns(self, table):
         pass
 
+    """
+    Should return a list of tables for a dataset of any project, used to index all tables for the global search.
+    Child classes whose get_tables reads the selected project from the widgets have to override it.
+    """
+    def get_project_tables(self, project, dataset):
+        return self.get_tables(dataset)
+
+    """ Metadata loading """
+
+    # Selection a level's metadata belongs to: the project for datasets, project and dataset for tables, ...
+    def _scope(self, level):
+        names = ('wg_project', 'wg_database', 'wg_tables')[:LEVELS.index(level)]
+        return tuple(getattr(self, name).value for name in names)
+
+    def _fetch(self, level, scope):
+        if level == 'projects':
+            return self.get_projects()
+        if level == 'datasets':
+            return self.get_datasets(scope[0])
+        if level == 'tables':
+            return self.get_tables(scope[1])
+        return self.get_columns(scope[2])
+
+    # Metadata of a level from the cache, fetched from the data source if missing.
+    # Expired entries are returned right away and refreshed in the background.
+    def _load(self, level, scope):
+        value, fresh = self.metadata.get(self.cache_namespace, level, scope)
+        if value is not None:
+            if not fresh:
+                self._prefetcher.submit(self._refresh, level, scope, value)
+            return value
+        return self._refresh_level(level, scope)
+
+    # Fetch a level from the data source into the cache. Returns None if the selection changed meanwhile:
+    # get_tables and get_columns read the project and dataset from the widgets.
+    def _refresh_level(self, level, scope):
+        if scope[:-1] != self._scope(level)[:-1]:
+            return None
+        value = as_metadata(level, self._fetch(level, scope))
+        if scope[:-1] != self._scope(level)[:-1]:
+            return None
+        self.metadata.put(self.cache_namespace, level, scope, value)
+        if level == 'tables':
+            self.search_index.add(*scope, value)
+        return value
+
+    def _refresh(self, level, scope, cached):
+        try:
+            value = self._refresh_level(level, scope)
+        except Exception as e:
+            logger.debug(f'Refreshing {level} of {scope} failed: {e}')
+            return
+        if value is not None and value != cached:
+            self._call_soon(self._apply_refresh, level, scope, value)
+
+    def _apply_refresh(self, level, scope, value):
+        if scope == self._scope(level):
+            getattr(self, f'_show_{level}')(value)
+
+    # Load a level on the thread pool, a load of the same level and scope that is already running is shared
+    def _submit(self, level, scope, executor):
+        key = (level, scope)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = self._inflight[key] = executor.submit(self._load, level, scope)
+        future.add_done_callback(lambda future: self._inflight.pop(key, None))
+        return future
+
+    # Load a level and show it once loaded. Every request gets a new generation of its level,
+    # responses of older generations (the user clicked ahead) are dropped.
+    # keep: keep the selection and reload the selected levels below (refresh), otherwise the level is shown unselected
+    def _request(self, level, scope, keep=False):
+        self._generations[level] += 1
+        generation = self._generations[level]
+        self._set_status(level, f'Loading {level}' + (f' of {scope[-1]}' if scope else '') + '...')
+        future = self._submit(level, scope, self._executor)
+        future.add_done_callback(lambda future: self._call_soon(self._deliver, level, scope, generation, keep, future))
+
+    def _deliver(self, level, scope, generation, keep, future):
+        if generation != self._generations[level]:
+            return
+        self._set_status(level, None)
+        if scope != self._scope(level):
+            return
+        try:
+            value = future.result()
+        except Exception as e:
+            logger.debug(f'Loading {level} of {scope} failed: {e}')
+            self._set_status(level, f'Loading {level} failed: {e}', error=True)
+            return
+        if value is None:
+            return
+        if not keep:
+            getattr(self, f'_set_{level}')(value)
+            self._prefetch_next(level, scope, value)
+        elif getattr(self, f'_show_{level}')(value) and level != 'columns':
+            below = LEVELS[LEVELS.index(level) + 1]
+            if self._scope(below)[-1] is not None:
+                self._request(below, self._scope(below), keep=True)
+
+    # Warm the cache with the level the user most likely opens next: the option picked last time, else the first one
+    def _prefetch_next(self, level, scope, options):
+        if level not in ('datasets', 'tables') or not options:
+            return
+        picked, _ = self.metadata.get(self.cache_namespace, 'selected', scope)
+        option = picked if picked in options else options[0]
+        below = LEVELS[LEVELS.index(level) + 1]
+        self._submit(below, scope + (option,), self._prefetcher)
+
+    # Remember the option picked for a scope, it is prefetched first next time
+    def _remember(self, scope, value):
+        self.metadata.put(self.cache_namespace, 'selected', scope, value)
+
+    # Run fn on the kernel's event loop, widgets are updated and debounced handlers started from there
+    def _call_soon(self, fn, *args):
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(fn, *args)
+        else:
+            fn(*args)
+
+    def _set_status(self, level, text, error=False):
+        if text is None:
+            self._status.pop(level, None)
+        else:
+            self._status[level] = (text, error)
+        self.wg_status.value = '<br>'.join(
+            f"<span style='color:{'red' if error else 'gray'}'>{'&#10060;' if error else '&#9203;'} {html.escape(text)}</span>"
+            for text, error in self._status.values())
+
+    def _observe(self, widget, handler):
+        widget.observe(lambda change: None if self._keep_selection else handler(change), names='value')
+
+    # Set the options of a dropdown without a selection and without triggering its handler
+    def _replace_options(self, widget, options):
+        self._keep_selection = True
+        try:
+            widget.index = None
+            widget.options = tuple(options)
+        finally:
+            self._keep_selection = False
+
+    # Empty levels and drop their pending responses, e.g. the tables and columns when another dataset is picked
+    def _clear(self, *levels):
+        for level in levels:
+            self._generations[level] += 1
+            self._set_status(level, None)
+        if 'datasets' in levels:
+            self._replace_options(self.wg_database, [])
+        if 'tables' in levels:
+            self.tables = []
+            self._replace_options(self.wg_tables, [])
+        if 'columns' in levels:
+            self._show_columns([])
+
+    def _set_projects(self, projects):
+        self.projects = projects
+        self._replace_options(self.wg_project, projects)
+        if not self._select_target('projects') and projects:
+            self.wg_project.index = 0
+
+    def _set_datasets(self, datasets):
+        self._replace_options(self.wg_database, datasets)
+        self._select_target('datasets')
+
+    def _set_tables(self, tables):
+        self.tables = tables
+        self._replace_options(self.wg_tables, tables)
+        self._select_target('tables')
+
+    def _set_columns(self, table_tuples):
+        self._show_columns(table_tuples)
+
+    # Replace the options of a dropdown and keep its selection if it still exists.
+    # Returns False if the selection was lost, the level below is then reloaded by handler.
+    def _update_options(self, widget, options, handler):
+        value = widget.value
+        self._keep_selection = True
+        try:
+            widget.options = tuple(options)
+            if value in widget.options:
+                widget.value = value
+        finally:
+            self._keep_selection = False
+        if widget.value != value:
+            handler(Bunch(name='value', old=value, new=widget.value))
+            return False
+        return True
+
+    def _show_projects(self, projects):
+        self.projects = projects
+        return self._update_options(self.wg_project, projects, self.set_dataset_options)
+
+    def _show_datasets(self, datasets):
+        return self._update_options(self.wg_database, datasets, self.set_tables_options)
+
+    def _show_tables(self, tables):
+        self.tables = tables
+        return self._update_options(self.wg_tables, tables, self.set_columns_options)
+
+    def _show_columns(self, table_tuples):
+        # Partition columns are columns with a partition type, e.g. "DATE(PART.)"
+        self.partition_columns = [(name, dtype) for name, dtype in table_tuples if "Part." in dtype]
+        self.wg_check_boxes.set_items(table_tuples)
+        return True
+
+    # Drop the cached metadata of this browser and reload the current selection from the data source
+    def refresh_metadata(self, x=None):
+        self.metadata.invalidate(self.cache_namespace)
+        self._request('projects', (), keep=True)
+
+    """ Global table search """
+
+    # Cache the tables of every dataset of every project and add them to the global table search
+    def harvest_tables(self, max_workers=8):
+        def harvest(scope):
+            tables, fresh = self.metadata.get(self.cache_namespace, 'tables', scope)
+            if tables is None or not fresh:
+                tables = as_metadata('tables', self.get_project_tables(*scope))
+                self.metadata.put(self.cache_namespace, 'tables', scope, tables)
+            self.search_index.add(*scope, tables)
+            return len(tables)
+
+        self._call_soon(self._set_status, 'harvest', 'Listing datasets...')
+        scopes = []
+        for project in self._load('projects', ()):
+            try:
+                scopes += [(project, dataset) for dataset in self._load('datasets', (project,))]
+            except Exception as e:
+                logger.debug(f'Listing the datasets of {project} failed: {e}')
+        tables, failed = 0, 0
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dbt_magics-harvest') as executor:
+            futures = [executor.submit(harvest, scope) for scope in scopes]
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    tables += future.result()
+                except Exception as e:
+                    failed += 1
+                    logger.debug(f'Harvesting tables failed: {e}')
+                self._call_soon(self._set_status, 'harvest', f'Indexed {tables:,} tables of {done}/{len(scopes)} datasets...')
+        self._call_soon(self._set_status, 'harvest', None)
+        if failed:
+            self._call_soon(self._set_status, 'harvest', f'Tables of {failed} datasets could not be listed', True)
+        return tables
+
+    # Show the best matches of the global table search below the search box
+    @debounce(0.3)
+    def search_all_tables(self, observation):
+        query = observation['new'].strip()
+        results = self.search_index.search(query) if query else []
+        self._replace_options(self.wg_search_results, [(f'{table}  -  {project}.{dataset}', (project, dataset, table)) for _, project, dataset, table in results])
+        self.wg_search_results.layout.display = None if query else 'none'
+
+    # Select a table in the dropdowns, the levels in between are selected as they load
+    def jump_to(self, project, dataset, table):
+        self._target = (project, dataset, table)
+        if self.wg_search_table.value:
+            self._keep_selection = True
+            try:
+                self.wg_search_table.value = ''
+                self.wg_tables.filter('')
+            finally:
+                self._keep_selection = False
+        for level, value in zip(('projects', 'datasets', 'tables'), self._target):
+            if self._scope(LEVELS[LEVELS.index(level) + 1])[-1] != value:
+                self._select_target(level)
+                return
+        self._target = None
+
+    # Select the search target at a level whose options were just loaded. Returns True if it was selected,
+    # the target is dropped once reached or when the user picked something else above it.
+    def _select_target(self, level):
+        if self._target is None:
+            return False
+        index = LEVELS.index(level)
+        widget = (self.wg_project, self.wg_database, self.wg_tables)[index]
+        value = self._target[index]
+        if self._scope(level) != self._target[:index] or value not in widget.options:
+            self._target = None
+            return False
+        if level == 'tables':
+            self._target = None
+        widget.value = value
+        return True
+
     """ Additional methods """
 
     # Set the options for the dataset dropdown
     @debounce(0.3)
     def set_dataset_options(self, observation):
         observation = observation if type(observation)==str else observation['new']
-        datasets = self.get_datasets(observation)
-        self.wg_database.index = None
-        self.wg_database.options = tuple(datasets)
+        self._clear('datasets', 'tables', 'columns')
+        if observation is not None:
+            self._request('datasets', (observation,))
 
     # Set the options for the table dropdown
     @debounce(0.3)
     def set_tables_options(self, observation):
         observation = observation if type(observation)==str else observation['new']
-        self.tables = self.get_tables(observation)
-        self.wg_tables.index = None
-        self.wg_tables.options = tuple(self.tables)
+        self._clear('tables', 'columns')
+        if observation is not None:
+            self._remember((self.wg_project.value,), observation)
+            self._request('tables', (self.wg_project.value, observation))
 
     # Set the options for the column checkboxes
     def set_columns_options(self, table):
         if table.new == None:
             return
-        f = lambda name, dtype: CB(name, dtype)
-        
-        table_tuples = self.get_columns(table.new)
-
-        # Partition columns are columns with a partition type, e.g. "DATE(PART.)"
-        self.partition_columns = [f(*i) for i in table_tuples if "Part." in i[1]]
-        self.check_boxes = [f(*i) for i in table_tuples] 
-        self.wg_columns_container.children = [self.all_columns, self.wg_search_column]+self.check_boxes
-        self.wg_check_boxes.children = self.check_boxes
+        scope = (self.wg_project.value, self.wg_database.value, table.new)
+        self._clear('columns')
+        self._remember(scope[:-1], table.new)
+        self._request('columns', scope)
 
     # Print the SQL statement to the output widget when the button is clicked
     def on_button_clicked(self, x, star=False):
         f = lambda name, dtype:  f'{name} {prStyle.BLUE}-- {dtype}{prStyle.RESET}'
         with self.output:
             self.output.clear_output()
-            part = [i.check.description for i in self.partition_columns if i.lab.value in ('DATE(PART.)', 'STRING(PART.)')]
+            part = [name for name, dtype in self.partition_columns if dtype.upper() in ('DATE(PART.)', 'STRING(PART.)')]
             if len(part):
                 part_string = f"\n{prStyle.MAGENTA}WHERE{prStyle.RESET} DATE({part[0]})=current_date\n{prStyle.MAGENTA}LIMIT{prStyle.RESET} {prStyle.CYAN}100{prStyle.RESET}"
             else:
@@ -232,7 +733,7 @@ class DataController(ABC):
             if star:
                 cols = '*'
             else:
-                cols = "\n    , ".join([f(i.check.description, i.lab.value) for i in self.check_boxes if i.check.value])
+                cols = "\n    , ".join([f(name, dtype.upper()) for name, dtype in self.wg_check_boxes.selected()])
             
             output_string = f'{prStyle.RED}{self.lineMagicName}{prStyle.RESET}\n{prStyle.MAGENTA}SELECT{prStyle.RESET}\n    {cols} \n{prStyle.MAGENTA}FROM{prStyle.RESET} {prStyle.GREEN}"{self.wg_project.value}"."{self.wg_database.value}"."{self.wg_tables.value.split(" (")[0]}"{prStyle.RESET}{part_string}'
             
@@ -245,24 +746,16 @@ class DataController(ABC):
     # https://ipywidgets.readthedocs.io/en/latest/examples/Widget%20Events.html#Debouncing
     @debounce(0.3)
     def search_tables(self, observation):
-        self.wg_tables.options = tuple([i for i in self.tables if observation['new'].lower() in i.lower()])
-        if len(self.wg_tables.options) > 0:
-            self.wg_tables.index = 0
-        else:
-            self.wg_tables.index = None
+        matches = self.wg_tables.filter(observation['new'])
+        self.wg_tables.value = matches[0] if matches else None
 
     # Select all columns
     def all_columns_handler(self, observation):
-        if all([i.check.value for i in self.check_boxes]):
-            for box in self.check_boxes:
-                box.check.value = False
-        else:
-            for box in self.check_boxes:
-                box.check.value = True
+        self.wg_check_boxes.set_all(not self.wg_check_boxes.all_checked())
 
     def __call__(self):
         return self.pannel
     
     # Search the columns and set the checkboxes
     def search_columns(self, observation):
-        self.wg_columns_container.children = [self.all_columns, self.wg_search_column]+ [i for i in self.check_boxes if observation['new'] in i.check.description]
\ No newline at end of file
+        self.wg_check_boxes.filter(observation['new'])
\ No newline at end of file
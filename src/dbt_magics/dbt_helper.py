@@ -1,10 +1,16 @@
 import os
 import re
+import inspect
 import logging
+import threading
 from pathlib import Path
 
 import yaml
 
+from dbt_magics.manifest import get_manifest_resolver, use_manifest
+from dbt_magics.project_index import folder_tags, get_project_index
+from dbt_magics.templating import MACRO_LIBRARY, get_template_renderer
+
 # Set up logger for dbt_magics
 logger = logging.getLogger('dbt_magics')
 
@@ -24,6 +30,18 @@ def _log_once(message):
         print(message)
         _logged_messages.add(message)
 
+# Parsed profiles.yml files: path -> {'mtime', 'raw', 'env_vars', 'env', 'profiles'}
+_profiles_cache = {}
+# Session-wide helpers: (helper class, constructor arguments) -> helper
+_helper_registry = {}
+_registry_lock = threading.Lock()
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
 """
 Base class to help with dbt project
 
@@ -57,6 +75,39 @@ class dbtHelper():
         except:
             raise BaseException(f"Profile-target '{self.target}' not found.")
         self.dbt_project = self._get_dbt_project()
+        self._fingerprint = self._config_fingerprint()
+
+    @classmethod
+    def get_or_create(cls, *args, **kwargs):
+        """
+        Return the session-wide helper for the given (adapter, profile, target).
+
+        The helper is rebuilt when profiles.yml or dbt_project.yml change on disk,
+        or when an environment variable they depend on changes.
+        """
+        bound = inspect.signature(cls).bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (cls, tuple(bound.arguments.items()))
+        with _registry_lock:
+            helper = _helper_registry.get(key)
+            if helper is None or helper._is_stale():
+                helper = cls(*args, **kwargs)
+                _helper_registry[key] = helper
+        return helper
+
+    def _config_fingerprint(self):
+        """State of the files and environment variables the parsed configuration depends on"""
+        adapter_upper = self.adapter_name.upper()
+        env_names = [f'{adapter_upper}_PROFILES_PATH', 'MAGICS_PROFILES_PATH', f'{adapter_upper}_PROJECT_FOLDER', 'MAGICS_PROJECT_FOLDER'] + self._env_vars
+        return (tuple((name, os.environ.get(name)) for name in env_names),
+                _mtime(self._profiles_path()),
+                _mtime(os.path.join(self.project_folder, "dbt_project.yml")))
+
+    def _is_stale(self):
+        try:
+            return self._config_fingerprint() != self._fingerprint
+        except AssertionError:
+            return True
 
     @property
     def project_folder(self):
@@ -149,47 +200,108 @@ class dbtHelper():
                 macro_files.append(os.path.join(top, nm))
         return [i for i in macro_files if i.endswith(".sql")]        
 
-    def _get_profiles(self):
+    def _profiles_path(self):
         # Check adapter-specific env var first, then fall back to generic, then default location
         adapter_upper = self.adapter_name.upper()
-        profiles_file_path = (os.environ.get(f'{adapter_upper}_PROFILES_PATH') or 
-                             os.environ.get('MAGICS_PROFILES_PATH') or 
-                             os.path.join(Path().home(), ".dbt", "profiles.yml"))
+        return (os.environ.get(f'{adapter_upper}_PROFILES_PATH') or 
+                os.environ.get('MAGICS_PROFILES_PATH') or 
+                os.path.join(Path().home(), ".dbt", "profiles.yml"))
+
+    def _referenced_env_vars(self, data):
+        """Names of all environment variables referenced with env_var() in a parsed YAML file"""
+        if isinstance(data, dict):
+            return [name for value in data.values() for name in self._referenced_env_vars(value)]
+        elif isinstance(data, list):
+            return [name for item in data for name in self._referenced_env_vars(item)]
+        elif isinstance(data, str):
+            return re.findall(r'env_var\(\s*[\'"]([^\'"]+)[\'"]', data)
+        return []
+
+    def _get_profiles(self):
+        profiles_file_path = self._profiles_path()
         logger.debug(f'Using profiles.yml from: {profiles_file_path}')
-        profiles = self._open_yaml(profiles_file_path)
-        # Apply env_var substitution to the loaded profiles
-        return self._substitute_env_vars(profiles)
+        # profiles.yml is only re-read when it changed on disk
+        mtime = os.path.getmtime(profiles_file_path)
+        cached = _profiles_cache.get(profiles_file_path)
+        if cached is None or cached['mtime'] != mtime:
+            raw = self._open_yaml(profiles_file_path)
+            cached = dict(mtime=mtime, raw=raw, env_vars=sorted(set(self._referenced_env_vars(raw))), env=None, profiles=None)
+            _profiles_cache[profiles_file_path] = cached
+        # Apply env_var substitution again only when a referenced variable changed
+        env = {name: os.environ.get(name) for name in cached['env_vars']}
+        if cached['env'] != env:
+            cached['profiles'] = self._substitute_env_vars(cached['raw'])
+            cached['env'] = env
+        self._env_vars = cached['env_vars']
+        return cached['profiles']
 
     def _get_dbt_project(self):
         dbt_project_file_path = os.path.join(self.project_folder, "dbt_project.yml")
         return self._open_yaml(dbt_project_file_path)
 
+    @property
+    def project_index(self):
+        """Session-wide index of the project's models, seeds and sources"""
+        index = get_project_index(self.project_folder, self.dbt_project)
+        index.refresh()
+        return index
+
+    @property
+    def manifest(self):
+        """
+        ManifestResolver for the project's manifest.json.
+        None if MAGICS_USE_MANIFEST is not set, the manifest is missing or older than the project files,
+        or it was compiled for another target (e.g. dev while --target prod is active).
+        """
+        if not use_manifest():
+            return None
+        target_path = self.dbt_project.get("target-path", "target")
+        resolver = get_manifest_resolver(os.path.join(self.project_folder, target_path, "manifest.json"), root_project=self.dbt_project.get("name"))
+        dbt_project_mtime = os.path.getmtime(os.path.join(self.project_folder, "dbt_project.yml"))
+        if not resolver.is_fresh(max(self.project_index.latest_mtime, dbt_project_mtime)):
+            logger.debug('manifest.json is missing or outdated, falling back to the project files')
+            return None
+        database = next((self.profile_config[key] for key in ('database', 'project', 'dbname') if self.profile_config.get(key)), None)
+        schema = self.profile_config.get('schema') or self.profile_config.get('dataset')
+        if not resolver.matches_target(self.profile_config.get('type'), database, schema):
+            logger.debug(f'manifest.json was compiled for another target than {self.target}, falling back to the project files')
+            return None
+        return resolver
+
+    def _split_ref_args(self, args):
+        """Split dbt's ref('model') and ref('package', 'model') arguments into (package_name, table_name)"""
+        if len(args) == 1:
+            return None, args[0]
+        return args[0], args[1]
+
+    def _manifest_ref(self, package_name, table_name):
+        """Relation dict(database, schema, identifier) of a ref() from the manifest or None"""
+        manifest = self.manifest
+        return manifest.ref(table_name, package_name) if manifest else None
+
+    def _manifest_source(self, source_name, table_name):
+        """Relation dict(database, schema, identifier) of a source() from the manifest or None"""
+        manifest = self.manifest
+        return manifest.source(source_name, table_name) if manifest else None
+
+    def select_models(self, select, exclude=None):
+        """
+        Model names matching dbt-style selectors, e.g. ['stg_*', 'tag:daily', 'path:marts', 'tag:daily,path:staging']
+        Tags come from config(tags=...), schema files and +tags in dbt_project.yml.
+        """
+        return self.project_index.select_models(select, exclude, folder_tags=folder_tags(self.dbt_project.get("models")))
+
     def _sources_and_models(self):
-        SOURCES, MODELS = [], []
-        # dbt_project, dbt_project_folder = get_dbt_project()
-        for mp in self.dbt_project.get("model-paths"):
-            folder = os.path.join(self.project_folder, mp)
-            for root, dirs, files in os.walk(folder):
-                for f in files:
-                    if f.endswith(".yml"):
-                        file = self._open_yaml(os.path.join(root, f))
-                        SOURCES += file.get("sources", [])
-                    elif f.endswith(".sql"):
-                        model_path = os.path.join(root, f).split(mp)[-1]
-                        model = [i for i in os.path.normpath(model_path).split(os.path.sep) if i]
-                        schema = model[0]
-                        table = model[-1].replace(".sql","")
-                        MODELS += [{table: schema}]
-                        
-        for mp in self.dbt_project.get("seed-paths"):
-            folder = os.path.join(self.project_folder, mp)
-            for root, dirs, files in os.walk(folder):
-                for f in files:
-                    if f.endswith(".yml"):
-                        file = self._open_yaml(os.path.join(root, f))
-                        MODELS += [{seed['name']: 'seeds'} for seed in file.get("seeds", [])]
-
-        return (SOURCES, MODELS)
+        index = self.project_index
+        return (index.source_entries(), index.model_entries())
+
+    def _find_source(self, target_schema, target_table, default_database):
+        """Look up a source table in the project index, same result format as _search_for_source_table"""
+        entry = self.project_index.find_source(target_schema, target_table)
+        if entry is None:
+            return dict(database=default_database, schema=target_schema, table="<! TABLE NOT FOUND in dbt project !>")
+        # Use 'schema' property if specified, otherwise fall back to source name
+        return dict(database=entry.get('database', default_database), schema=entry.get('schema', target_schema), table=target_table)
 
     def _len_check(self, source, table_name):
         if len(source)>1: 
@@ -201,8 +313,7 @@ class dbtHelper():
         return source
         
     def _get_custom_schema(self, table_name):
-        _, MODELS = self._sources_and_models()
-        table = [i for i in MODELS if i.get(table_name, False)]
+        table = [{table_name: folder} for folder in self.project_index.find_model(table_name)]
         table = self._len_check(table, table_name=table_name)
         if table[table_name]=='seeds':
             custom_schema = self.dbt_project.get("seeds").get(self.profile_name).get('+schema')
@@ -210,16 +321,27 @@ class dbtHelper():
             custom_schema = self.dbt_project.get("models").get(self.profile_name).get(table[table_name]).get('+schema')
         return custom_schema
 
+    @property
+    def templates(self):
+        """Session-wide TemplateRenderer with the project's compiled macro library"""
+        return get_template_renderer(self.project_folder, self.dbt_project.get("macro-paths"))
+
     @property
     def macros_txt(self):
-        folder = self.project_folder
-        macros_txt = ""
-        for mp in self.dbt_project.get("macro-paths"):
-            macros_files = self._get_macros(os.path.join(folder, mp))
-            for mf in macros_files:
-                with open(mf, encoding='utf-8') as file:
-                    macros_txt += "".join(file.readlines()) + "\n"
-        return macros_txt
+        templates = self.templates
+        return templates.environment.loader.get_source(templates.environment, MACRO_LIBRARY)[0] + "\n"
+
+    def undeclared_variables(self, cell):
+        """Variables used in a cell that have to be provided from the notebook namespace"""
+        return self.templates.undeclared_variables(cell)
+
+    def required_macros(self, cell):
+        """Names of the project macros a cell pulls in when it is rendered"""
+        return self.templates.required_macros(cell)
+
+    def render(self, cell, **kwargs):
+        """Render a cell with the project macros and dbt's source(), ref() and var()"""
+        return self.templates.render(cell, source=self.source, ref=self.ref, var=self.var, **kwargs).strip()
 
     def var(self, value):
         return self.dbt_project['vars'].get(value, f'ERROR: NOT FOUND VALUE {value}')
\ No newline at end of file
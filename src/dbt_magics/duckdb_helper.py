@@ -5,12 +5,169 @@ This module provides shared DuckDB functionality that can be used
 across different database adapters (Snowflake, Athena, etc.)
 """
 
+import logging
 import os
 import re
-from time import time
+import threading
+from contextlib import contextmanager
+from itertools import chain
+from time import sleep, time
 import duckdb
 import pandas as pd
 
+from dbt_magics.arrow_helper import pa, require_pyarrow
+
+logger = logging.getLogger('dbt_magics')
+
+def _get_pr_style():
+    """Get prStyle from datacontroller, with fallback"""
+    try:
+        from dbt_magics.datacontroller import prStyle
+        return prStyle
+    except ImportError:
+        # Fallback class if prStyle is not available
+        class FallbackStyle:
+            RED = '\033[91m'
+            GREEN = '\033[92m'
+            YELLOW = '\033[93m'
+            RESET = '\033[0m'
+        return FallbackStyle()
+
+
+# Error messages of a database file locked by another process
+LOCK_PATTERN = r'could not set lock|conflicting lock|database is locked'
+
+
+class DuckDBConnectionManager:
+    """
+    Process-wide DuckDB connections, one per database file.
+    Exports get their own cursor on the shared connection instead of reconnecting.
+
+    DuckDB only allows one writing process per file, so connections are closed after
+    idle_timeout seconds to release the lock for other processes (e.g. dbt run).
+    Connecting to a file locked by another process is retried with backoff.
+    """
+
+    def __init__(self, retries=8, initial_delay=0.25, max_delay=5.0, idle_timeout=60):
+        """
+        Parameters:
+        - retries: connection attempts while the file is locked by another process
+        - initial_delay: seconds to wait before the first retry, doubled after every attempt
+        - max_delay: maximum seconds between two attempts
+        - idle_timeout: seconds after the last use until a file connection is closed (None keeps it open)
+        """
+        self.retries = retries
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+        self._connections = {}  # db path -> connection
+        self._users = {}  # db path -> number of open cursors
+        self._timers = {}
+        self._lock = threading.Lock()
+        self.metrics = dict(connections=0, cursors=0, lock_retries=0, lock_wait_seconds=0.0, idle_closed=0)
+
+    def is_lock_error(self, error):
+        return re.search(LOCK_PATTERN, str(error), re.IGNORECASE) is not None
+
+    def _count(self, metric, amount=1):
+        with self._lock:
+            self.metrics[metric] += amount
+
+    def _connect(self, db_path):
+        delay = self.initial_delay
+        for attempt in range(self.retries + 1):
+            try:
+                connection = duckdb.connect(db_path)
+                self._count('connections')
+                return connection
+            except duckdb.Error as e:
+                if not self.is_lock_error(e) or attempt == self.retries:
+                    raise
+                if attempt == 0:
+                    prStyle = _get_pr_style()
+                    print(f"{prStyle.YELLOW}DuckDB database is locked by another process: {db_path}. Waiting for the lock...{prStyle.RESET}")
+                logger.debug(f'DuckDB lock on {db_path}, retrying in {delay:.2f}s: {e}')
+                sleep(delay)
+                self._count('lock_retries')
+                self._count('lock_wait_seconds', delay)
+                delay = min(delay * 2, self.max_delay)
+
+    def connection(self, db_path):
+        """Get the shared connection of a database file, connecting on first use"""
+        with self._lock:
+            connection = self._connections.get(db_path)
+        if connection is not None:
+            return connection
+        connection = self._connect(db_path)
+        with self._lock:
+            if db_path in self._connections:
+                # Another thread connected in the meantime
+                connection.close()
+            else:
+                self._connections[db_path] = connection
+            return self._connections[db_path]
+
+    @contextmanager
+    def cursor(self, db_path):
+        """Context manager handing out a cursor on the shared connection of a database file"""
+        with self._lock:
+            self._users[db_path] = self._users.get(db_path, 0) + 1
+            timer = self._timers.pop(db_path, None)
+        if timer is not None:
+            timer.cancel()
+        try:
+            cursor = self.connection(db_path).cursor()
+            self._count('cursors')
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+        finally:
+            with self._lock:
+                self._users[db_path] -= 1
+                idle = self._users[db_path] == 0
+            if idle:
+                self._schedule_close(db_path)
+
+    def _schedule_close(self, db_path):
+        # In-memory databases would lose their tables, keep them open
+        if self.idle_timeout is None or db_path == ':memory:':
+            return
+        timer = threading.Timer(self.idle_timeout, self._close_idle, args=(db_path,))
+        timer.daemon = True
+        with self._lock:
+            self._timers[db_path] = timer
+        timer.start()
+
+    def _close_idle(self, db_path):
+        with self._lock:
+            if self._users.get(db_path) or self._timers.get(db_path) is not threading.current_thread():
+                return
+            self._timers.pop(db_path, None)
+            connection = self._connections.pop(db_path, None)
+        if connection is not None:
+            connection.close()
+            self._count('idle_closed')
+
+    def close(self, db_path=None):
+        """Close the connection of one database file, or all connections"""
+        with self._lock:
+            paths = [db_path] if db_path is not None else list(self._connections)
+            connections = [self._connections.pop(path) for path in paths if path in self._connections]
+            timers = [self._timers.pop(path) for path in paths if path in self._timers]
+        for timer in timers:
+            timer.cancel()
+        for connection in connections:
+            connection.close()
+
+    def stats(self):
+        """Connection and lock wait metrics"""
+        with self._lock:
+            return dict(self.metrics, open=sorted(self._connections))
+
+
+duckdb_connections = DuckDBConnectionManager()
+
 
 class DuckDBHelper:
     """Helper class for DuckDB operations in dbt-magics"""
@@ -24,23 +181,19 @@ class DuckDBHelper:
         """
         self.dbt_helper = dbt_helper
         self.prStyle = self._get_pr_style()
+        self._duckdb_config = None
     
     def _get_pr_style(self):
         """Get prStyle from datacontroller, with fallback"""
-        try:
-            from dbt_magics.datacontroller import prStyle
-            return prStyle
-        except ImportError:
-            # Fallback class if prStyle is not available
-            class FallbackStyle:
-                RED = '\033[91m'
-                GREEN = '\033[92m'
-                YELLOW = '\033[93m'
-                RESET = '\033[0m'
-            return FallbackStyle()
+        return _get_pr_style()
     
     def get_duckdb_config(self):
-        """Get DuckDB configuration from dbt profiles"""
+        """Get DuckDB configuration from dbt profiles (parsed once per dbt helper)"""
+        if self._duckdb_config is None:
+            self._duckdb_config = self._read_duckdb_config()
+        return self._duckdb_config
+
+    def _read_duckdb_config(self):
         duckdb_config = self.dbt_helper.profile_config.get('duckdb', {})
         if not duckdb_config:
             # Try to find duckdb profile in the same profiles.yml
@@ -73,12 +226,10 @@ class DuckDBHelper:
             return True
             
         try:
-            # Try to connect with a short timeout to check if database is locked
-            conn = duckdb.connect(db_path)
-            
-            # Try a simple operation to ensure the database is writable
-            conn.execute("SELECT 1")
-            conn.close()
+            # Connecting waits with backoff while another process holds the lock
+            with duckdb_connections.cursor(db_path) as conn:
+                # Try a simple operation to ensure the database is writable
+                conn.execute("SELECT 1")
             return True
             
         except Exception as e:
@@ -117,6 +268,23 @@ class DuckDBHelper:
         # Return schema.table_name format
         return f"{duckdb_schema}.{table_name}"
     
+    def count_rows(self, table_name):
+        """
+        Number of rows of a table in DuckDB
+
+        Parameters:
+        - table_name: base table name (will be prefixed with schema)
+
+        Returns:
+        - row count, or None if the table doesn't exist
+        """
+        db_path = self.get_duckdb_config().get('path', self.get_duckdb_config().get('database', ':memory:'))
+        with duckdb_connections.cursor(db_path) as conn:
+            try:
+                return conn.execute(f"SELECT count(*) FROM {self.get_duckdb_table_name(table_name)}").fetchone()[0]
+            except duckdb.CatalogException:
+                return None
+
     def extract_ref_table_name(self, sql_statement):
         """
         Extract table name from dbt ref() function in SQL statement
@@ -127,10 +295,10 @@ class DuckDBHelper:
         Returns:
         - First table name found in ref() function, or None if not found
         """
-        # Pattern to match ref('table_name') or ref("table_name")
-        ref_pattern = r"ref\s*\(\s*['\"]([^'\"]+)['\"]"
+        # Pattern to match ref('table_name'), ref("table_name") or ref('package', 'table_name')
+        ref_pattern = r"ref\s*\(\s*['\"]([^'\"]+)['\"](?:\s*,\s*['\"]([^'\"]+)['\"])?"
         
-        matches = re.findall(ref_pattern, sql_statement, re.IGNORECASE)
+        matches = [model or first for first, model in re.findall(ref_pattern, sql_statement, re.IGNORECASE)]
         
         if matches:
             # Return the first ref table name found
@@ -141,18 +309,66 @@ class DuckDBHelper:
         
         return None
     
-    def export_to_duckdb(self, df, table_name, if_exists='replace'):
+    def _write_table(self, conn, full_table_name, source, if_exists, unique_key=None):
+        """
+        Replace, append to or merge into a table from a registered relation, within the caller's transaction
+
+        Returns:
+        - (updated rows, inserted rows) for merge, None otherwise
+        """
+        if if_exists == 'replace':
+            conn.execute(f"CREATE OR REPLACE TABLE {full_table_name} AS SELECT * FROM {source}")
+            return None
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {full_table_name} AS SELECT * FROM {source} LIMIT 0")
+        if if_exists == 'merge':
+            return self._merge_table(conn, full_table_name, source, unique_key)
+        # append
+        conn.execute(f"INSERT INTO {full_table_name} BY NAME SELECT * FROM {source}")
+        return None
+
+    def _merge_table(self, conn, full_table_name, source, unique_key):
+        """
+        Upsert a relation into a table by unique key. Rows whose key exists with different values
+        are deleted and inserted again; unchanged rows are left as they are.
+        """
+        quote = lambda column: '"' + column.replace('"', '""') + '"'
+        columns = [column[0] for column in conn.execute(f"SELECT * FROM {source} LIMIT 0").description]
+        missing = [key for key in unique_key if key not in columns]
+        if missing:
+            raise BaseException(f"unique_key column(s) {missing} not found in the result columns {columns}")
+
+        key_match = ' AND '.join(f"t.{quote(key)} IS NOT DISTINCT FROM s.{quote(key)}" for key in unique_key)
+        changed = ' OR '.join(f"t.{quote(column)} IS DISTINCT FROM s.{quote(column)}" for column in columns if column not in unique_key) or 'FALSE'
+        updated = conn.execute(f"DELETE FROM {full_table_name} AS t USING {source} AS s WHERE {key_match} AND ({changed})").fetchone()[0]
+        inserted = conn.execute(f"""
+            INSERT INTO {full_table_name} BY NAME SELECT s.* FROM {source} AS s
+            WHERE NOT EXISTS (SELECT 1 FROM {full_table_name} AS t WHERE {key_match})
+        """).fetchone()[0]
+        return updated, inserted - updated
+
+    def _unique_key(self, if_exists, unique_key):
+        """Parse 'col1,col2' into a list; merge requires a unique key"""
+        if isinstance(unique_key, str):
+            unique_key = [key.strip() for key in unique_key.split(',') if key.strip()]
+        if if_exists == 'merge' and not unique_key:
+            raise BaseException("--duckdb_mode merge requires --unique_key, e.g. --unique_key id or --unique_key col1,col2")
+        return list(unique_key or [])
+
+    def export_to_duckdb(self, df, table_name, if_exists='replace', unique_key=None):
         """
         Export DataFrame to DuckDB using dbt naming conventions
+        DuckDB scans the DataFrame or Arrow table directly and writes it in one transaction.
         
         Parameters:
-        - df: pandas DataFrame to export
+        - df: pandas DataFrame (or pyarrow.Table) to export
         - table_name: base table name (will be prefixed with schema)
-        - if_exists: 'replace' (default) or 'append'
+        - if_exists: 'replace' (default), 'append' or 'merge'
+        - unique_key: column name(s) identifying a row for merge, e.g. 'id' or 'col1,col2'
         """
-        if df is None or df.empty:
+        if df is None or len(df) == 0:
             print(f"{self.prStyle.RED}DataFrame is empty or None. Nothing to export.{self.prStyle.RESET}")
             return
+        unique_key = self._unique_key(if_exists, unique_key)
             
         duckdb_config = self.get_duckdb_config()
         
@@ -166,79 +382,161 @@ class DuckDBHelper:
         # Get fully qualified table name with schema
         full_table_name = self.get_duckdb_table_name(table_name)
         schema_name, table_only = full_table_name.split('.', 1)
+        source_view = f"temp_{table_only}_export"
         
         try:
-            # Connect to DuckDB
-            conn = duckdb.connect(db_path)
-            
-            # Create schema if it doesn't exist
-            conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name}")
-            
-            # Export DataFrame to DuckDB
-            if if_exists == 'replace':
-                conn.execute(f"DROP TABLE IF EXISTS {full_table_name}")
-            
-            # Register DataFrame as temporary table
-            temp_table_name = f"temp_{table_only}_{int(time())}"
-            conn.register(temp_table_name, df)
-            
-            # Create or insert into the target table
-            if if_exists == 'replace':
-                conn.execute(f"CREATE TABLE {full_table_name} AS SELECT * FROM {temp_table_name}")
-            else:  # append
-                # Check if table exists, create if not
-                table_exists = conn.execute(f"""
-                    SELECT COUNT(*) FROM information_schema.tables 
-                    WHERE table_schema = '{schema_name}' AND table_name = '{table_only}'
-                """).fetchone()[0] > 0
-                
-                if not table_exists:
-                    conn.execute(f"CREATE TABLE {full_table_name} AS SELECT * FROM {temp_table_name}")
-                else:
-                    conn.execute(f"INSERT INTO {full_table_name} SELECT * FROM {temp_table_name}")
-            
-            conn.unregister(temp_table_name)
-            conn.close()
+            start = time()
+            nbytes = df.nbytes if pa is not None and isinstance(df, (pa.Table, pa.RecordBatch)) else df.memory_usage(index=False).sum()
+
+            # Cursor on the shared connection of the database file
+            with duckdb_connections.cursor(db_path) as conn:
+                # Arrow data and DataFrames are both scanned in place, without a copy
+                conn.register(source_view, df)
+                conn.execute("BEGIN TRANSACTION")
+                try:
+                    conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name}")
+                    merged = self._write_table(conn, full_table_name, source_view, if_exists, unique_key)
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                finally:
+                    conn.unregister(source_view)
+            duration = max(time() - start, 1e-6)
             
-            action = "replaced" if if_exists == 'replace' else "appended to"
-            print(f"{self.prStyle.GREEN}DataFrame successfully {action} table '{full_table_name}' in DuckDB at: {db_path}{self.prStyle.RESET}")
+            action = {'replace': "replaced", 'append': "appended to", 'merge': "merged into"}[if_exists]
+            merge_info = f" | {merged[0]} updated, {merged[1]} inserted, {len(df) - sum(merged)} unchanged" if merged else ""
+            print(f"{self.prStyle.GREEN}DataFrame successfully {action} table '{full_table_name}' in DuckDB at: {db_path}{self.prStyle.RESET} "
+                  f"| {len(df)} rows in {duration:.2f} sec. ({nbytes/1024/1024/duration:.1f} MB/s, {len(df)/duration:,.0f} rows/s){merge_info}")
             
         except Exception as e:
             print(f"{self.prStyle.RED}Error exporting to DuckDB: {str(e)}{self.prStyle.RESET}")
-            # Clean up in case of error
-            try:
-                if 'conn' in locals():
-                    if 'temp_table_name' in locals():
-                        conn.unregister(temp_table_name)
-                    conn.close()
-            except:
-                pass
 
+    @contextmanager
+    def _memory_limit(self, conn, memory_limit):
+        """
+        Limit DuckDB's memory to memory_limit MB within the block. The setting applies to the
+        whole database of the shared connection, so it is reset to DuckDB's default afterwards.
+        """
+        if not memory_limit:
+            yield
+            return
+        conn.execute(f"SET memory_limit = '{int(memory_limit)}MB'")
+        try:
+            yield
+        finally:
+            conn.execute("RESET memory_limit")
 
-def export_dataframe_to_duckdb_with_profile(df, table_name, profile_name=None, target=None, adapter_name='snowflake', if_exists='replace'):
+    def export_stream(self, batches, table_name, if_exists='replace', memory_limit=None, preview_rows=5, unique_key=None, verbose=True, raise_errors=False):
+        """
+        Stream Arrow record batches into DuckDB as they arrive, without building a DataFrame.
+        Only one batch is held in memory at a time, so results larger than RAM can be mirrored.
+        The table is written in one transaction and rolled back if the stream fails. The transaction
+        starts once the first batch arrived, so DuckDB isn't locked while the warehouse runs the
+        query, but stays open while the later batches are fetched.
+
+        Parameters:
+        - batches: iterable of pyarrow RecordBatches (or Tables), e.g. from an adapter's iter_arrow_batches()
+        - table_name: base table name (will be prefixed with schema)
+        - if_exists: 'replace' (default), 'append' or 'merge'
+        - memory_limit: DuckDB memory limit in MB (optional), the batch being fetched isn't counted
+        - preview_rows: number of rows read back from DuckDB for display
+        - unique_key: column name(s) identifying a row for merge, e.g. 'id' or 'col1,col2'
+        - verbose: print the export summary
+        - raise_errors: raise instead of printing errors, e.g. to retry the export
+
+        Returns:
+        - DataFrame with the first preview_rows rows of the table, or None if nothing was exported
+        """
+        require_pyarrow("Streaming export")
+        unique_key = self._unique_key(if_exists, unique_key)
+        duckdb_config = self.get_duckdb_config()
+
+        if not duckdb_config:
+            print(f"{self.prStyle.RED}DuckDB configuration not found in dbt profiles. Please add duckdb configuration.{self.prStyle.RESET}")
+            return None
+
+        db_path = duckdb_config.get('path', duckdb_config.get('database', ':memory:'))
+        full_table_name = self.get_duckdb_table_name(table_name)
+        schema_name, table_only = full_table_name.split('.', 1)
+        batch_view = f"temp_{table_only}_batch"
+
+        try:
+            # The warehouse query runs until its first batch arrives, fetch it before DuckDB is locked for writing
+            batches = iter(batches)
+            first = next(batches, None)
+            batches = chain([first], batches) if first is not None else iter(())
+            with duckdb_connections.cursor(db_path) as conn, self._memory_limit(conn, memory_limit):
+                conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name}")
+
+                start = time()
+                rows = nbytes = updated = inserted = 0
+                written = False
+                conn.execute("BEGIN TRANSACTION")
+                try:
+                    for batch in batches:
+                        # An empty batch carries the schema of an empty result, replace still empties the table
+                        conn.register(batch_view, batch)
+                        # The first batch replaces or creates the table, later batches are appended (or merged)
+                        merged = self._write_table(conn, full_table_name, batch_view, 'append' if written and if_exists == 'replace' else if_exists, unique_key)
+                        if merged:
+                            updated, inserted = updated + merged[0], inserted + merged[1]
+                        conn.unregister(batch_view)
+                        written = True
+                        rows += batch.num_rows
+                        nbytes += batch.nbytes
+                    if not written and if_exists == 'replace':
+                        # Without a schema the table can't be replaced, keeping the old rows would look like a success
+                        raise ValueError(f"Query returned no result set, table '{full_table_name}' was not replaced")
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                duration = max(time() - start, 1e-6)
+
+                if not written:
+                    if verbose:
+                        print(f"{self.prStyle.YELLOW}Query returned no result set. Nothing to export.{self.prStyle.RESET}")
+                    return None
+
+                action = {'replace': "replaced", 'append': "appended to", 'merge': "merged into"}[if_exists]
+                merge_info = f" | {updated} updated, {inserted} inserted, {rows - updated - inserted} unchanged" if if_exists == 'merge' else ""
+                if verbose:
+                        print(f"{self.prStyle.GREEN}Streamed {rows} rows ({nbytes/1024/1024:.1f} MB) in {duration:.2f} sec. "
+                          f"({nbytes/1024/1024/duration:.1f} MB/s, {rows/duration:,.0f} rows/s) - {action} table '{full_table_name}' in DuckDB at: {db_path}{self.prStyle.RESET}{merge_info}")
+                return conn.execute(f"SELECT * FROM {full_table_name} LIMIT {int(preview_rows)}").df()
+
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"{self.prStyle.RED}Error streaming to DuckDB: {str(e)}{self.prStyle.RESET}")
+            return None
+
+
+def export_dataframe_to_duckdb_with_profile(df, table_name, profile_name=None, target=None, adapter_name='snowflake', if_exists='replace', unique_key=None):
     """
     Standalone function to export any DataFrame to DuckDB using dbt profile configuration
     
     Parameters:
-    - df: pandas DataFrame to export
+    - df: pandas DataFrame (or pyarrow.Table) to export
     - table_name: name of the table in DuckDB
     - profile_name: dbt profile name (optional)
     - target: dbt target (optional)
     - adapter_name: dbt adapter name ('snowflake', 'athena', etc.)
-    - if_exists: 'replace' (default) or 'append'
+    - if_exists: 'replace' (default), 'append' or 'merge'
+    - unique_key: key column(s) for merge, e.g. 'id' or 'col1,col2'
     
     Usage:
     export_dataframe_to_duckdb_with_profile(my_df, 'my_table')
     export_dataframe_to_duckdb_with_profile(my_df, 'my_table', if_exists='append')
+    export_dataframe_to_duckdb_with_profile(my_df, 'my_table', if_exists='merge', unique_key='id')
     export_dataframe_to_duckdb_with_profile(my_df, 'my_table', adapter_name='athena')
     """
     from dbt_magics.dbt_helper import dbtHelper
     
-    # Create a temporary dbt helper to access configuration
-    class TempDbtHelper(dbtHelper):
-        def __init__(self, adapter_name, profile_name, target):
-            super().__init__(adapter_name=adapter_name, profile_name=profile_name, target=target)
-    
-    helper = TempDbtHelper(adapter_name, profile_name, target)
-    duckdb_helper = DuckDBHelper(helper)
-    duckdb_helper.export_to_duckdb(df, table_name, if_exists)
+    # Reuse the session-wide dbt helper to access configuration
+    helper = dbtHelper.get_or_create(adapter_name=adapter_name, profile_name=profile_name, target=target)
+    duckdb_helper = getattr(helper, 'duckdb_helper', None)
+    if duckdb_helper is None:
+        duckdb_helper = helper.duckdb_helper = DuckDBHelper(helper)
+    duckdb_helper.export_to_duckdb(df, table_name, if_exists, unique_key)
@@ -0,0 +1,148 @@
+"""
+Manifest Module for dbt-magics
+
+Resolves ref() and source() from the manifest.json that `dbt parse` / `dbt compile`
+writes into the target folder. The manifest already contains the exact relation
+of every node (custom schemas, aliases and package models included), so no
+project files have to be walked or parsed.
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger('dbt_magics')
+
+REF_RESOURCE_TYPES = ('model', 'seed', 'snapshot')
+
+
+def use_manifest():
+    """Manifest resolution is opt-in via MAGICS_USE_MANIFEST"""
+    return os.environ.get('MAGICS_USE_MANIFEST', 'false').lower() in ('true', '1', 'yes')
+
+
+class ManifestResolver:
+    """Lazily loaded index of the nodes and sources of a dbt manifest.json"""
+
+    def __init__(self, manifest_path, root_project=None):
+        """
+        Parameters:
+        - manifest_path: path to target/manifest.json
+        - root_project: name of the root dbt project, preferred when a model name exists in several packages
+        """
+        self.manifest_path = manifest_path
+        self.root_project = root_project
+        self._loaded_mtime = None
+        self.nodes = {}    # model name -> [node, ...]
+        self.sources = {}  # (source name, table name) -> source
+        self.adapter_type = None
+        self.target_relations = set()  # (database, schema) of root project models without custom database or schema
+
+    @property
+    def mtime(self):
+        """mtime of the manifest file or None if it does not exist"""
+        try:
+            return os.path.getmtime(self.manifest_path)
+        except OSError:
+            return None
+
+    def is_fresh(self, project_mtime):
+        """True if the manifest exists and is not older than the project files"""
+        mtime = self.mtime
+        return mtime is not None and mtime >= project_mtime
+
+    def _load(self):
+        mtime = self.mtime
+        if mtime is None or mtime == self._loaded_mtime:
+            return
+        with open(self.manifest_path) as file:
+            manifest = json.load(file)
+
+        nodes, sources = {}, {}
+        for node in manifest.get('nodes', {}).values():
+            if node.get('resource_type') in REF_RESOURCE_TYPES:
+                nodes.setdefault(node['name'], []).append(node)
+        for source in manifest.get('sources', {}).values():
+            sources[(source['source_name'], source['name'])] = source
+
+        metadata = manifest.get('metadata', {})
+        self.root_project = self.root_project or metadata.get('project_name')
+        self.adapter_type = metadata.get('adapter_type')
+        # Models without a custom database or schema are built in the target's, which tells the target compiled for
+        self.target_relations = {
+            (str(node.get('database') or '').lower(), str(node.get('schema') or '').lower())
+            for candidates in nodes.values() for node in candidates
+            if node.get('package_name') == self.root_project and node.get('resource_type') == 'model'
+            and not node.get('config', {}).get('schema') and not node.get('config', {}).get('database')}
+        self.nodes, self.sources = nodes, sources
+        self._loaded_mtime = mtime
+        logger.debug(f'Loaded {len(nodes)} nodes and {len(sources)} sources from {self.manifest_path}')
+
+    def matches_target(self, adapter_type=None, database=None, schema=None):
+        """
+        True if the manifest was compiled for the given target. The manifest doesn't name its target,
+        the adapter type and the database and schema of models without custom ones are compared instead.
+        Unknown values (None) aren't compared.
+        """
+        self._load()
+        if adapter_type and self.adapter_type and adapter_type.lower() != self.adapter_type.lower():
+            return False
+        if not self.target_relations or schema is None:
+            return True
+        databases = {relation_database for relation_database, _ in self.target_relations}
+        schemas = {relation_schema for _, relation_schema in self.target_relations}
+        if database is not None and str(database).lower() not in databases:
+            return False
+        return str(schema).lower() in schemas
+
+    def _pick_node(self, candidates, package_name):
+        if package_name:
+            candidates = [n for n in candidates if n.get('package_name') == package_name]
+        elif len(candidates) > 1:
+            # Prefer models of the root project over package models with the same name
+            root = [n for n in candidates if n.get('package_name') == self.root_project]
+            candidates = root or candidates
+        if len(candidates) > 1:
+            # Versioned models: ref() without version resolves to the latest version
+            latest = [n for n in candidates if n.get('version') is not None and n.get('version') == n.get('latest_version')]
+            candidates = latest or candidates
+        if len(candidates) > 1:
+            raise BaseException(f"Conflicting table name: {candidates[0]['name']}. Packages: {[n.get('package_name') for n in candidates]}.")
+        return candidates[0] if candidates else None
+
+    def ref(self, table_name, package_name=None):
+        """
+        Resolve a ref() from the manifest
+
+        Returns:
+        - dict(database, schema, identifier) or None if the model is not in the manifest
+        """
+        self._load()
+        node = self._pick_node(self.nodes.get(table_name, []), package_name)
+        if node is None:
+            return None
+        return dict(database=node.get('database'), schema=node.get('schema'), identifier=node.get('alias') or node['name'])
+
+    def source(self, source_name, table_name):
+        """
+        Resolve a source() from the manifest
+
+        Returns:
+        - dict(database, schema, identifier) or None if the source is not in the manifest
+        """
+        self._load()
+        source = self.sources.get((source_name, table_name))
+        if source is None:
+            return None
+        return dict(database=source.get('database'), schema=source.get('schema'), identifier=source.get('identifier') or source['name'])
+
+
+# Process-wide resolvers, one per manifest file
+_manifest_resolvers = {}
+
+def get_manifest_resolver(manifest_path, root_project=None):
+    """Get the session-wide ManifestResolver for a manifest.json path"""
+    key = os.path.abspath(manifest_path)
+    if key not in _manifest_resolvers:
+        _manifest_resolvers[key] = ManifestResolver(manifest_path, root_project=root_project)
+    return _manifest_resolvers[key]
@@ -0,0 +1,156 @@
+"""
+Metadata Cache Module for dbt-magics
+
+Keeps the metadata shown by the DataController browsers (projects, datasets,
+tables and columns) in a local SQLite file, so %athena, %snowflake, %bigquery
+and %sqlite open instantly from the cache instead of asking the data source on
+every dropdown change. Entries older than the TTL of their level are still
+shown, and refreshed in the background.
+
+Configuration:
+- MAGICS_CACHE_DIR: directory of metadata.sqlite (default ~/.cache/dbt_magics)
+- MAGICS_METADATA_TTL: TTL in minutes per level, e.g. "projects=1440,datasets=360,tables=60,columns=60"
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from time import time
+
+logger = logging.getLogger('dbt_magics')
+
+DB_FILE = 'metadata.sqlite'
+# Levels of the browser, top down
+LEVELS = ('projects', 'datasets', 'tables', 'columns')
+DEFAULT_TTL_MINUTES = dict(projects=24 * 60, datasets=6 * 60, tables=60, columns=60)
+
+
+def default_metadata_path():
+    directory = os.getenv('MAGICS_CACHE_DIR') or os.path.join(Path.home(), '.cache', 'dbt_magics')
+    return os.path.join(directory, DB_FILE)
+
+
+def default_ttl_minutes():
+    """TTL per level, DEFAULT_TTL_MINUTES overridden by MAGICS_METADATA_TTL"""
+    ttl = dict(DEFAULT_TTL_MINUTES)
+    for item in os.getenv('MAGICS_METADATA_TTL', '').split(','):
+        level, _, minutes = item.partition('=')
+        if level.strip() in ttl and minutes.strip():
+            try:
+                ttl[level.strip()] = float(minutes)
+            except ValueError:
+                logger.debug(f'Ignoring invalid MAGICS_METADATA_TTL entry: {item!r}')
+        elif item.strip():
+            logger.debug(f'Ignoring invalid MAGICS_METADATA_TTL entry: {item!r}')
+    return ttl
+
+
+def as_metadata(level, value):
+    """JSON-friendly copy of a get_* result: names as str, columns as [name, data_type]"""
+    if level == 'columns':
+        return [[str(name), str(data_type)] for name, data_type in (value if value is not None else [])]
+    return [str(item) for item in (value if value is not None else [])]
+
+
+class MetadataCache:
+    """SQLite-backed cache of browser metadata with a TTL per level"""
+
+    def __init__(self, path=None, ttl_minutes=None):
+        """
+        Parameters:
+        - path: SQLite file (default MAGICS_CACHE_DIR/metadata.sqlite), ':memory:' keeps the cache in memory
+        - ttl_minutes: dict of level -> minutes before an entry is refreshed (default MAGICS_METADATA_TTL)
+        """
+        self.path = path or default_metadata_path()
+        self.ttl_minutes = ttl_minutes or default_ttl_minutes()
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # Entries are written by the background refresh threads, access is serialized by self._lock
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            connection.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                namespace TEXT, level TEXT, scope TEXT, value TEXT, fetched REAL,
+                PRIMARY KEY (namespace, level, scope))""")
+            self._connection = connection
+        return self._connection
+
+    def get(self, namespace, level, scope=()):
+        """
+        Cached metadata of one level of a browser
+
+        Parameters:
+        - namespace: the browser's data source, e.g. 'athena/my_profile/dev'
+        - level: 'projects', 'datasets', 'tables' or 'columns'
+        - scope: selection the metadata belongs to, e.g. (project, dataset) for tables
+
+        Returns:
+        - (value, fresh): value is None if nothing is cached, fresh is False once the level's TTL has passed
+        """
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT value, fetched FROM metadata WHERE namespace = ? AND level = ? AND scope = ?",
+                    (namespace, level, json.dumps(list(scope)))).fetchone()
+        except sqlite3.Error as e:
+            logger.debug(f'Metadata cache unavailable: {e}')
+            return None, False
+        if row is None:
+            return None, False
+        return json.loads(row[0]), time() - row[1] <= self.ttl_minutes.get(level, 60) * 60
+
+    def put(self, namespace, level, scope, value):
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                                   (namespace, level, json.dumps(list(scope)), json.dumps(value), time()))
+                connection.commit()
+        except sqlite3.Error as e:
+            logger.debug(f'Metadata could not be cached: {e}')
+
+    def entries(self, namespace, level):
+        """(scope, value) of all cached entries of a level, e.g. the tables of every dataset seen"""
+        try:
+            with self._lock:
+                rows = self._connect().execute("SELECT scope, value FROM metadata WHERE namespace = ? AND level = ?",
+                                               (namespace, level)).fetchall()
+        except sqlite3.Error as e:
+            logger.debug(f'Metadata cache unavailable: {e}')
+            return []
+        return [(tuple(json.loads(scope)), json.loads(value)) for scope, value in rows]
+
+    def invalidate(self, namespace=None, level=None):
+        """Drop the cached metadata of a namespace (or of one level of it), everything if no namespace is given"""
+        conditions = {key: value for key, value in dict(namespace=namespace, level=level).items() if value is not None}
+        where = ' AND '.join(f'{key} = ?' for key in conditions) or '1 = 1'
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.execute(f"DELETE FROM metadata WHERE {where}", tuple(conditions.values()))
+                connection.commit()
+        except sqlite3.Error as e:
+            logger.debug(f'Metadata cache could not be cleared: {e}')
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+# Process-wide cache, created on first use so MAGICS_CACHE_DIR can be set in the notebook
+_metadata_cache = None
+
+def get_metadata_cache():
+    """Get the session-wide MetadataCache, recreated when MAGICS_CACHE_DIR changes"""
+    global _metadata_cache
+    if _metadata_cache is None or _metadata_cache.path != default_metadata_path():
+        _metadata_cache = MetadataCache()
+    return _metadata_cache
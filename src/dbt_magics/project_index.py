@@ -0,0 +1,306 @@
+"""
+Project Index Module for dbt-magics
+
+Keeps an in-memory index of the models, seeds and sources of a dbt project,
+so that ref() and source() are resolved with dict lookups instead of walking
+the whole project tree on every call.
+
+Files are only re-parsed when their mtime changes, and the index can be saved
+to disk so that a kernel restart reloads it instead of rescanning the project.
+"""
+
+import fnmatch
+import json
+import logging
+import os
+import re
+import threading
+from time import time
+
+import yaml
+
+logger = logging.getLogger('dbt_magics')
+
+INDEX_VERSION = 2
+INDEX_FILE_NAME = 'dbt_magics_index.json'
+
+# tags=... inside {{ config(...) }} of a model file
+CONFIG_TAGS_PATTERN = re.compile(r"config\s*\((?:[^()]|\([^()]*\))*?\btags\s*=\s*(\[[^\]]*\]|'[^']*'|\"[^\"]*\")", re.DOTALL)
+
+
+def _as_tags(value):
+    """Normalize a tags setting (string or list) to a list of tags"""
+    if not value:
+        return []
+    return [value] if isinstance(value, str) else [str(tag) for tag in value]
+
+
+class ProjectIndex:
+    """Index of the models, seeds and sources of one dbt project"""
+
+    def __init__(self, project_folder, model_paths, seed_paths, cache_path=None, refresh_interval=2.0):
+        """
+        Parameters:
+        - project_folder: path to the dbt project
+        - model_paths: list of model-paths from dbt_project.yml
+        - seed_paths: list of seed-paths from dbt_project.yml
+        - cache_path: file used to persist the index between sessions (optional)
+        - refresh_interval: seconds during which a refresh() is a no-op
+        """
+        self.project_folder = project_folder
+        self.model_paths = list(model_paths or [])
+        self.seed_paths = list(seed_paths or [])
+        self.cache_path = cache_path
+        self.refresh_interval = refresh_interval
+
+        # relative file path -> {'mtime': float, 'kind': str, 'data': dict}
+        self.files = {}
+        self.models = {}   # model name -> [folder, ...]
+        self.model_files = {}  # model name -> [path relative to the model path, ...]
+        self.tags = {}     # model name -> {tag, ...} from config() and schema files
+        self.sources = {}  # (source name, table name) -> source entry
+        self._source_entries = []
+        self._last_refresh = 0
+        # refresh() runs on the %dbt_sync worker threads too, while they render their models
+        self._lock = threading.Lock()
+
+        if cache_path:
+            self.load(cache_path)
+
+    #################### PARSING ####################
+
+    def _parse_file(self, kind, path, root_path):
+        if kind == 'model':
+            model_path = os.path.relpath(path, os.path.join(self.project_folder, root_path))
+            model = [i for i in os.path.normpath(model_path).split(os.path.sep) if i]
+            with open(path) as file:
+                match = CONFIG_TAGS_PATTERN.search(file.read())
+            tags = re.findall(r"['\"]([^'\"]+)['\"]", match.group(1)) if match else []
+            return {'name': model[-1].replace(".sql", ""), 'folder': model[0], 'path': '/'.join(model), 'tags': tags}
+
+        with open(path) as file:
+            content = yaml.safe_load(file) or {}
+        if kind == 'schema':
+            models = [{'name': model['name'], 'tags': _as_tags(model.get('tags')) + _as_tags((model.get('config') or {}).get('tags'))}
+                      for model in content.get("models", []) or [] if model.get('name')]
+            return {'sources': content.get("sources", []) or [], 'models': models}
+        return {'seeds': [seed['name'] for seed in content.get("seeds", []) or []]}
+
+    def _iter_project_files(self):
+        for mp in self.model_paths:
+            for root, dirs, files in os.walk(os.path.join(self.project_folder, mp)):
+                for f in files:
+                    if f.endswith(".yml"):
+                        yield 'schema', os.path.join(root, f), mp
+                    elif f.endswith(".sql"):
+                        yield 'model', os.path.join(root, f), mp
+        for sp in self.seed_paths:
+            for root, dirs, files in os.walk(os.path.join(self.project_folder, sp)):
+                for f in files:
+                    if f.endswith(".yml"):
+                        yield 'seed', os.path.join(root, f), sp
+
+    #################### REFRESH ####################
+
+    def refresh(self, force=False):
+        """
+        Re-scan the project and re-parse only the files that changed since the last scan.
+
+        Returns:
+        - True if the index changed, False otherwise
+        """
+        with self._lock:
+            if not force and time() - self._last_refresh < self.refresh_interval:
+                return False
+
+            changed = False
+            seen = set()
+            for kind, path, root_path in self._iter_project_files():
+                rel_path = os.path.relpath(path, self.project_folder)
+                seen.add(rel_path)
+                mtime = os.path.getmtime(path)
+                entry = self.files.get(rel_path)
+                if entry and entry['mtime'] == mtime and entry['kind'] == kind:
+                    continue
+                self.files[rel_path] = {'mtime': mtime, 'kind': kind, 'data': self._parse_file(kind, path, root_path)}
+                changed = True
+
+            for rel_path in set(self.files) - seen:
+                del self.files[rel_path]
+                changed = True
+
+            if changed or not self._last_refresh:
+                self._rebuild()
+            self._last_refresh = time()
+
+            if changed and self.cache_path:
+                self.save(self.cache_path)
+            return changed
+
+    def _rebuild(self):
+        models, model_files, tags, sources, source_entries = {}, {}, {}, {}, []
+        for rel_path in sorted(self.files):
+            entry = self.files[rel_path]
+            data = entry['data']
+            if entry['kind'] == 'model':
+                models.setdefault(data['name'], []).append(data['folder'])
+                model_files.setdefault(data['name'], []).append(data['path'])
+                tags.setdefault(data['name'], set()).update(data['tags'])
+            elif entry['kind'] == 'seed':
+                for seed in data['seeds']:
+                    models.setdefault(seed, []).append('seeds')
+            else:
+                for source in data['sources']:
+                    source_entries.append(source)
+                    for table in source.get('tables', []) or []:
+                        sources.setdefault((source.get('name'), table['name']), source)
+                for model in data.get('models', []):
+                    tags.setdefault(model['name'], set()).update(model['tags'])
+        self.models, self.model_files, self.tags = models, model_files, tags
+        self.sources, self._source_entries = sources, source_entries
+
+    @property
+    def latest_mtime(self):
+        """Latest mtime of all indexed project files"""
+        with self._lock:
+            return max([entry['mtime'] for entry in self.files.values()], default=0)
+
+    #################### LOOKUPS ####################
+
+    def model_entries(self):
+        """Models in the legacy format of dbtHelper._sources_and_models: [{table: schema}, ...]"""
+        return [{name: folder} for name, folders in self.models.items() for folder in folders]
+
+    def source_entries(self):
+        """Raw source entries from all schema files"""
+        return list(self._source_entries)
+
+    def find_model(self, name):
+        """Return the list of folders (or 'seeds') a model name is defined in"""
+        return self.models.get(name, [])
+
+    def find_source(self, source_name, table_name):
+        """Return the raw source entry defining source_name.table_name or None"""
+        return self.sources.get((source_name, table_name))
+
+    def model_tags(self, name, folder_tags=None):
+        """
+        Tags of a model from its config(), schema files and the +tags of its folders
+
+        Parameters:
+        - name: model name
+        - folder_tags: {folder path tuple: [tag, ...]} from dbt_project.yml, see folder_tags()
+        """
+        tags = set(self.tags.get(name, set()))
+        for path in self.model_files.get(name, []):
+            folders = tuple(path.split('/')[:-1])
+            for folder, folder_tag_list in (folder_tags or {}).items():
+                if folders[:len(folder)] == folder:
+                    tags.update(folder_tag_list)
+        return tags
+
+    def _matches(self, name, selector, folder_tags):
+        method, _, value = selector.rpartition(':')
+        if method == 'tag':
+            return value in self.model_tags(name, folder_tags)
+        if method == 'path':
+            value = value.strip('/')
+            paths = self.model_files.get(name, [])
+            # Paths are accepted relative to the project (models/staging) or to the model path (staging)
+            paths = paths + [f"{mp.strip('/')}/{path}" for mp in self.model_paths for path in paths]
+            return any(path == value or path.startswith(value + '/') or fnmatch.fnmatch(path, value) for path in paths)
+        if method:
+            raise BaseException(f"Unknown selector method '{method}:' in '{selector}'. Use a model name, tag: or path:")
+        return fnmatch.fnmatch(name, value)
+
+    def select_models(self, select, exclude=None, folder_tags=None):
+        """
+        Names of the models and seeds matching dbt-style selectors
+
+        Parameters:
+        - select: list of selectors whose matches are combined. A selector is a model name
+          (wildcards allowed), tag:<tag> or path:<folder>; selectors joined by ',' must all match
+        - exclude: list of selectors whose matches are removed
+        - folder_tags: {folder path tuple: [tag, ...]} from dbt_project.yml, see folder_tags()
+        """
+        def matches(name, selectors):
+            return any(all(self._matches(name, part, folder_tags) for part in selector.split(','))
+                       for selector in selectors)
+        return sorted(name for name in self.models
+                      if matches(name, select) and not matches(name, exclude or []))
+
+    #################### PERSISTENCE ####################
+
+    def save(self, path):
+        """Save the index to a JSON file"""
+        content = dict(version=INDEX_VERSION,
+                       project_folder=os.path.abspath(self.project_folder),
+                       model_paths=self.model_paths,
+                       seed_paths=self.seed_paths,
+                       files=self.files)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as file:
+                json.dump(content, file)
+        except (OSError, TypeError) as e:
+            logger.debug(f'Could not save project index to {path}: {e}')
+
+    def load(self, path):
+        """Load a previously saved index. Files are re-validated by mtime on the next refresh."""
+        try:
+            with open(path) as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return False
+        if (content.get('version') != INDEX_VERSION
+                or content.get('project_folder') != os.path.abspath(self.project_folder)
+                or content.get('model_paths') != self.model_paths
+                or content.get('seed_paths') != self.seed_paths):
+            return False
+        self.files = content.get('files', {})
+        self._rebuild()
+        logger.debug(f'Loaded project index with {len(self.files)} files from {path}')
+        return True
+
+
+def folder_tags(models_config):
+    """
+    +tags per folder from the models section of dbt_project.yml
+
+    Returns:
+    - {folder path tuple relative to the model path: [tag, ...]}, () for project wide tags
+    """
+    tags = {}
+
+    def walk(config, folders):
+        for key, value in (config or {}).items():
+            if key in ('+tags', 'tags') and value and not isinstance(value, dict):
+                tags.setdefault(folders, []).extend(_as_tags(value))
+            elif isinstance(value, dict) and not key.startswith('+'):
+                walk(value, folders + (key,))
+
+    # The first level of the models section is the project (or package) name
+    for project_config in (models_config or {}).values():
+        if isinstance(project_config, dict):
+            walk(project_config, ())
+    return tags
+
+
+# Process-wide indexes, one per project
+_project_indexes = {}
+
+def get_project_index(project_folder, dbt_project):
+    """
+    Get the session-wide ProjectIndex for a dbt project, creating it on first use.
+
+    Parameters:
+    - project_folder: path to the dbt project
+    - dbt_project: parsed dbt_project.yml
+    """
+    model_paths = dbt_project.get("model-paths") or []
+    seed_paths = dbt_project.get("seed-paths") or []
+    key = (os.path.abspath(project_folder), tuple(model_paths), tuple(seed_paths))
+    if key not in _project_indexes:
+        cache_path = os.path.join(project_folder, dbt_project.get("target-path", "target"), INDEX_FILE_NAME)
+        _project_indexes[key] = ProjectIndex(project_folder, model_paths, seed_paths, cache_path=cache_path)
+    return _project_indexes[key]
@@ -0,0 +1,43 @@
+"""
+Query History Module for dbt-magics
+
+Remembers the warehouse query id of every executed statement by the fingerprint
+of its rendered SQL, so that --reuse can fetch the results of a previous run
+through the warehouse's result reuse mechanism instead of executing again.
+"""
+
+import threading
+from time import time
+
+from dbt_magics.sql_helper import sql_fingerprint
+
+
+class QueryHistory:
+    """Last query id per (adapter, profile, target, rendered SQL)"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def key(self, adapter_name, profile_name, target, statement):
+        return sql_fingerprint(statement, adapter_name, profile_name, target)
+
+    def record(self, key, query_id, **details):
+        """Store the query id (and adapter specific details) of a successful run"""
+        with self._lock:
+            self._entries[key] = dict(details, query_id=query_id, executed_at=time())
+
+    def lookup(self, key, max_age_minutes):
+        """Return the last entry for a key if it is not older than max_age_minutes, otherwise None"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time() - entry['executed_at'] > max_age_minutes * 60:
+            return None
+        return entry
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+query_history = QueryHistory()
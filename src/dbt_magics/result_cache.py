@@ -0,0 +1,227 @@
+"""
+Result Cache Module for dbt-magics
+
+Stores query results as Parquet files in a local cache directory, so re-running
+a cell while iterating on the pandas code below it doesn't pay the warehouse
+round trip again.
+
+Entries are keyed by the normalized rendered statement, adapter, profile and
+target. The cache has a size cap; the least recently used entries are evicted
+first. Parquet files require pyarrow (pip install dbt_magics[arrow]).
+
+Configuration:
+- MAGICS_CACHE_DIR: cache directory (default ~/.cache/dbt_magics)
+- MAGICS_CACHE_SIZE_MB: size cap of the cache directory (default 1024)
+"""
+
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from time import time
+
+import pandas as pd
+from IPython.core import magic_arguments
+from IPython.core.magic import Magics, line_magic, magics_class
+
+from dbt_magics.arrow_helper import require_pyarrow
+from dbt_magics.datacontroller import prStyle
+from dbt_magics.sql_helper import normalize_sql, sql_fingerprint
+
+logger = logging.getLogger('dbt_magics')
+
+INDEX_FILE = 'index.json'
+
+
+def default_cache_dir():
+    return os.getenv('MAGICS_CACHE_DIR') or os.path.join(Path.home(), '.cache', 'dbt_magics')
+
+
+def default_max_bytes():
+    return int(float(os.getenv('MAGICS_CACHE_SIZE_MB', 1024)) * 1024 * 1024)
+
+
+class ResultCache:
+    """Parquet result cache with TTL and LRU eviction"""
+
+    def __init__(self, directory=None, max_bytes=None):
+        """
+        Parameters:
+        - directory: cache directory (default MAGICS_CACHE_DIR or ~/.cache/dbt_magics)
+        - max_bytes: size cap of all cached files (default MAGICS_CACHE_SIZE_MB)
+        """
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes if max_bytes is not None else default_max_bytes()
+        self.stats = dict(hits=0, misses=0, evicted=0)
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(index, file, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.parquet')
+
+    def _remove(self, index, key):
+        index.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def key(self, statement, adapter_name, profile_name, target):
+        return sql_fingerprint(statement, adapter_name, profile_name, target)
+
+    def get(self, key, ttl_minutes=None):
+        """
+        Cached DataFrame of a key, or None if it is missing or older than ttl_minutes.
+        A ttl of None or 0 never expires.
+        """
+        with self._lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry is not None and ttl_minutes and time() - entry['created'] > ttl_minutes * 60:
+                self._remove(index, key)
+                self._save_index(index)
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            try:
+                df = pd.read_parquet(self._path(key))
+            except Exception as e:
+                logger.debug(f'Dropping unreadable cache entry {key}: {e}')
+                self._remove(index, key)
+                self._save_index(index)
+                self.stats['misses'] += 1
+                return None
+            entry['last_used'] = time()
+            self._save_index(index)
+            self.stats['hits'] += 1
+            return df
+
+    def put(self, key, df, **details):
+        """Store a DataFrame under a key and evict least recently used entries above the size cap"""
+        require_pyarrow("--cache")
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        df.to_parquet(path, index=False)
+        with self._lock:
+            index = self._load_index()
+            index[key] = dict(details, rows=len(df), bytes=os.path.getsize(path), created=time(), last_used=time())
+            self._evict(index, keep=key)
+            self._save_index(index)
+
+    def _evict(self, index, keep=None):
+        total = sum(entry['bytes'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]['bytes']
+            self._remove(index, key)
+            self.stats['evicted'] += 1
+
+    def entries(self):
+        """DataFrame of the cached entries, most recently used first"""
+        index = self._load_index()
+        rows = [dict(key=key, **entry) for key, entry in index.items()]
+        df = pd.DataFrame(rows, columns=['key', 'adapter', 'profile', 'target', 'rows', 'bytes', 'created', 'last_used', 'statement'])
+        for column in ['created', 'last_used']:
+            df[column] = pd.to_datetime(df[column], unit='s')
+        return df.sort_values('last_used', ascending=False).reset_index(drop=True)
+
+    def purge(self, adapter_name=None, older_than_minutes=None):
+        """Remove all entries, or those of an adapter and/or older than older_than_minutes. Returns the number removed."""
+        with self._lock:
+            index = self._load_index()
+            keys = [key for key, entry in index.items()
+                    if (adapter_name is None or entry.get('adapter') == adapter_name)
+                    and (older_than_minutes is None or time() - entry['created'] > older_than_minutes * 60)]
+            for key in keys:
+                self._remove(index, key)
+            self._save_index(index)
+        return len(keys)
+
+    def cached(self, statement, adapter_name, profile_name, target, ttl_minutes, run):
+        """
+        Return the cached result of a statement, or call run() and cache the DataFrame it returns
+
+        Parameters:
+        - statement: rendered SQL statement
+        - adapter_name, profile_name, target: scope of the cache entry
+        - ttl_minutes: maximum age of a cached result (None or 0 never expires)
+        - run: callable executing the statement and returning a DataFrame (or None)
+        """
+        key = self.key(statement, adapter_name, profile_name, target)
+        start = time()
+        df = self.get(key, ttl_minutes)
+        if df is not None:
+            print(f"{prStyle.GREEN}{time()-start:.3f} sec. {prStyle.RESET}| {prStyle.BLUE}cache hit{prStyle.RESET} | {len(df)} rows")
+            return df
+
+        df = run()
+        if isinstance(df, pd.DataFrame):
+            try:
+                self.put(key, df, adapter=adapter_name, profile=profile_name, target=target,
+                         statement=normalize_sql(statement)[:200])
+                print(f"{prStyle.BLUE}cache miss{prStyle.RESET} | stored {len(df)} rows")
+            except Exception as e:
+                print(f"{prStyle.RED}cache miss | result could not be cached: {e}{prStyle.RESET}")
+        return df
+
+
+# Process-wide cache, created on first use so MAGICS_CACHE_DIR can be set in the notebook
+_result_cache = None
+
+def get_result_cache():
+    """Get the session-wide ResultCache, recreated when MAGICS_CACHE_DIR changes"""
+    global _result_cache
+    if _result_cache is None or _result_cache.directory != default_cache_dir():
+        _result_cache = ResultCache()
+    return _result_cache
+
+
+@magics_class
+class ResultCacheMagics(Magics):
+
+    @line_magic
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('--purge', action='store_true', help='Remove cached results.')
+    @magic_arguments.argument('--adapter', default=None, help='Only purge results of this adapter.')
+    @magic_arguments.argument('--older_than', default=None, type=float, help='Only purge results older than N minutes.')
+    def dbt_cache(self, line):
+        """
+        ---------------------------------------------------------------------------
+        %dbt_cache                                  # List cached results
+        %dbt_cache --purge                          # Remove all cached results
+        %dbt_cache --purge --adapter athena         # Remove cached Athena results
+        %dbt_cache --purge --older_than 1440        # Remove results older than a day
+        ---------------------------------------------------------------------------
+        """
+        args = magic_arguments.parse_argstring(self.dbt_cache, line)
+        cache = get_result_cache()
+        if args.purge:
+            removed = cache.purge(adapter_name=args.adapter, older_than_minutes=args.older_than)
+            print(f"{prStyle.GREEN}Removed {removed} cached results from {cache.directory}{prStyle.RESET}")
+            return None
+        entries = cache.entries()
+        print(f"{cache.directory} | {len(entries)} results | {entries['bytes'].sum()/1024/1024:.1f} of {cache.max_bytes/1024/1024:.0f} MB"
+              f" | session: {cache.stats['hits']} hits, {cache.stats['misses']} misses, {cache.stats['evicted']} evicted")
+        return entries
@@ -0,0 +1,175 @@
+"""
+Search Index Module for dbt-magics
+
+Global table search of the DataController browsers. The table names a browser
+has seen or harvested (kept in the metadata cache) are indexed by trigrams and
+by prefix, so a query finds tables across all projects and datasets of a data
+source, ranked by fuzzy match quality, within keystroke latency even for
+catalogs with 100k+ tables.
+"""
+
+import heapq
+import logging
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+logger = logging.getLogger('dbt_magics')
+
+# Share of the query's trigrams a fuzzy match must contain
+MIN_TRIGRAM_SHARE = 0.4
+MAX_PREFIX_MATCHES = 1000
+# Queries up to this length only match name prefixes, their trigrams are in most names
+SHORT_QUERY = 2
+
+
+def normalize_name(name):
+    """Lower case name with separators as spaces, the ' (t)'/' (v)' suffix of Snowflake tables removed"""
+    return re.sub(r'[^0-9a-z]+', ' ', name.split(' (')[0].lower()).strip()
+
+
+def trigrams(normalized, complete=True):
+    """
+    Trigrams of a normalized name, padded so that word starts weigh more
+
+    Parameters:
+    - complete: False for queries, which may end in the middle of a word
+    """
+    padded = f"  {normalized}{' ' if complete else ''}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TableSearchIndex:
+    """Trigram and prefix index of the tables of one data source"""
+
+    def __init__(self):
+        self.entries = []            # id -> (project, dataset, table), None once the dataset was re-indexed
+        self.loaded = False
+        self._names = []             # id -> normalized table name
+        self._gram_counts = array('I')
+        self._postings = {}          # trigram -> ids of the names containing it
+        self._datasets = {}          # (project, dataset) -> (tables, ids)
+        self._sorted = None          # [(name, id)] sorted by name, for prefix lookups
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(ids) for _, ids in self._datasets.values())
+
+    def add(self, project, dataset, tables):
+        """Index the tables of a dataset, replacing the tables indexed for it before"""
+        tables = list(tables)
+        with self._lock:
+            previous = self._datasets.get((project, dataset))
+            if previous is not None:
+                if previous[0] == tables:
+                    return
+                for id in previous[1]:
+                    self.entries[id] = None
+            self._index(project, dataset, tables)
+            self._sorted = None
+            if len(self.entries) > 2 * len(self) + 10000:
+                self._compact()
+
+    def _index(self, project, dataset, tables):
+        ids = []
+        for table in tables:
+            id = len(self.entries)
+            name = normalize_name(table)
+            grams = trigrams(name)
+            self.entries.append((project, dataset, table))
+            self._names.append(name)
+            self._gram_counts.append(len(grams))
+            for gram in grams:
+                self._postings.setdefault(gram, array('I')).append(id)
+            ids.append(id)
+        self._datasets[(project, dataset)] = (tables, ids)
+
+    def load(self, metadata, namespace):
+        """Index the tables of all datasets in the metadata cache of a data source (once)"""
+        if self.loaded:
+            return
+        self.loaded = True
+        for (project, dataset), tables in metadata.entries(namespace, 'tables'):
+            self.add(project, dataset, tables)
+        logger.debug(f'Search index of {namespace}: {len(self)} tables')
+
+    def _compact(self):
+        # Rebuild without the entries of re-indexed datasets
+        datasets = [(project, dataset, tables) for (project, dataset), (tables, _) in self._datasets.items()]
+        self.entries, self._names, self._gram_counts = [], [], array('I')
+        self._postings, self._datasets = {}, {}
+        for project, dataset, tables in datasets:
+            self._index(project, dataset, tables)
+
+    def _prefix_matches(self, prefix):
+        if self._sorted is None:
+            self._sorted = sorted((name, id) for id, name in enumerate(self._names) if self.entries[id] is not None)
+        start = bisect_left(self._sorted, (prefix,))
+        for name, id in self._sorted[start:start + MAX_PREFIX_MATCHES]:
+            if not name.startswith(prefix):
+                break
+            yield id
+
+    def search(self, query, limit=20):
+        """
+        Tables matching query, best match first
+
+        Names sharing few trigrams with the query are skipped. The rest are ranked by
+        trigram similarity, with a bonus for exact, prefix, word and substring matches.
+        Queries of one or two characters only match name prefixes, shortest names first.
+
+        Returns:
+        - list of (score, project, dataset, table)
+        """
+        query = normalize_name(query)
+        if not query:
+            return []
+        if len(query) <= SHORT_QUERY:
+            with self._lock:
+                scored = [(1.0 + len(query) / len(self._names[id]), -len(self._names[id]), id) for id in self._prefix_matches(query)]
+                best = heapq.nlargest(limit, scored)
+                return [(round(score, 3),) + self.entries[id] for score, _, id in best]
+        grams = trigrams(query, complete=False)
+        with self._lock:
+            hits = Counter()
+            for gram in grams:
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    hits.update(postings)
+            for id in self._prefix_matches(query):
+                hits[id] += 0
+            minimum = max(1, int(len(grams) * MIN_TRIGRAM_SHARE))
+            scored = []
+            for id, count in hits.items():
+                if self.entries[id] is None:
+                    continue
+                name = self._names[id]
+                prefix = name.startswith(query)
+                if count < minimum and not prefix:
+                    continue
+                score = count / (len(grams) + self._gram_counts[id] - count)
+                if name == query:
+                    score += 1.0
+                elif prefix:
+                    score += 0.5
+                elif f' {query}' in name:
+                    score += 0.4
+                elif query in name:
+                    score += 0.25
+                scored.append((score, -len(name), id))
+            best = heapq.nlargest(limit, scored)
+            return [(round(score, 3),) + self.entries[id] for score, _, id in best]
+
+
+# Process-wide indexes, one per data source (DataController cache_namespace)
+_search_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_search_index(namespace):
+    """Session-wide search index of a data source, filled by TableSearchIndex.load and the browsers"""
+    with _indexes_lock:
+        if namespace not in _search_indexes:
+            _search_indexes[namespace] = TableSearchIndex()
+        return _search_indexes[namespace]
@@ -1,10 +1,12 @@
 import io
+import logging
 import os
 from pathlib import Path
 from time import time
 
 
 #import snowflake.connector 
+from snowflake.connector.errors import NotSupportedError
 from snowflake.snowpark import Session
 from snowflake.core import Root
 from snowflake.core.database import Database
@@ -13,11 +15,21 @@ import duckdb
 from IPython import get_ipython
 from IPython.core import display, magic_arguments
 from IPython.core.magic import Magics, line_cell_magic, magics_class
-from jinja2 import Environment, Template, meta
 
+from dbt_magics.arrow_helper import arrow_to_pandas, pa, require_pyarrow
+from dbt_magics.background import background_jobs
+from dbt_magics.connections import connection_manager
 from dbt_magics.datacontroller import DataController, prStyle
 from dbt_magics.dbt_helper import dbtHelper
 from dbt_magics.duckdb_helper import DuckDBHelper
+from dbt_magics.query_history import query_history
+from dbt_magics.result_cache import ResultCacheMagics, get_result_cache
+from dbt_magics.sql_helper import execute_statements, is_read_only, split_statements
+from dbt_magics.sync import DbtSyncMagics, register_sync_adapter
+
+logger = logging.getLogger('dbt_magics')
+
+SNOWFLAKE_RESULT_RETENTION_MINUTES = 24 * 60
 
 """
 Implementation of the AthenaDataContoller class.
@@ -25,17 +37,9 @@ Implement abstract methods from DataController class.
 """
 class SnowflakeDataController(DataController):
     def __init__(self, target=None, profile_name=None):
-        self.dbt_helper = dbtHelperAdapter(adapter_name= 'snowflake', profile_name=profile_name, target=target)
-        connection_parameters= dict(user = self.dbt_helper.profile_config.get("user"),
-                               authenticator = self.dbt_helper.profile_config.get("authenticator"),
-                              role = self.dbt_helper.profile_config.get("role"),
-                              account = self.dbt_helper.profile_config.get("account"),
-                              warehouse = self.dbt_helper.profile_config.get("warehouse"),
-                              database = self.dbt_helper.profile_config.get("database"),
-                              schema = self.dbt_helper.profile_config.get("schema")
-                             )
-        self.root = self.get_metadata(connection_parameters)
-        super().__init__(r"%%snowflake")
+        self.dbt_helper = dbtHelperAdapter.get_or_create(adapter_name= 'snowflake', profile_name=profile_name, target=target)
+        self.root = self.get_metadata(self.dbt_helper.connection_parameters)
+        super().__init__(r"%%snowflake", cache_namespace=f"snowflake/{self.dbt_helper.profile_name}/{self.dbt_helper.target}")
 
     """
     Implemented Abstract methods
@@ -54,8 +58,11 @@ class SnowflakeDataController(DataController):
         
         
     def get_tables(self,schema):
-        tables = self.root.databases[self.wg_project.value].schemas[schema].tables.iter()
-        views = self.root.databases[self.wg_project.value].schemas[schema].views.iter()
+        return self.get_project_tables(self.wg_project.value, schema)
+
+    def get_project_tables(self, project, dataset):
+        tables = self.root.databases[project].schemas[dataset].tables.iter()
+        views = self.root.databases[project].schemas[dataset].views.iter()
         return [table.name+' (t)' for table in tables] + [view.name+' (v)' for view in views]
         
     def get_columns(self, table):
@@ -78,13 +85,19 @@ class dbtHelperAdapter(dbtHelper):
     
         
     def source(self, schema, table):
-        SOURCES, _ = self._sources_and_models()
+        relation = self._manifest_source(schema, table)
+        if relation:
+            return '{database}.{schema}.{identifier}'.format(**relation)
         default_database = [i for i in map(self.profile_config.get, ['dbname', 'database', 'dataset']) if i][0]
-        source = self._search_for_source_table(SOURCES, target_schema=schema, target_table=table, default_database=default_database)
+        source = self._find_source(target_schema=schema, target_table=table, default_database=default_database)
         return '{database}.{schema}.{table}'.format(database=source['database'], schema=source['schema'], table=source['table'])
 
 
-    def ref(self, table_name):
+    def ref(self, *args):
+        package_name, table_name = self._split_ref_args(args)
+        relation = self._manifest_ref(package_name, table_name)
+        if relation:
+            return '{database}.{schema}.{identifier}'.format(**relation)
         custom_schema = self._get_custom_schema(table_name)
         #print(f'custom_schema: value {custom_schema}')
         return (f'{custom_schema}.{table_name}')
@@ -106,26 +119,150 @@ class dbtHelperAdapter(dbtHelper):
         """Extract table name from dbt ref() function in SQL statement"""
         return self.duckdb_helper.extract_ref_table_name(sql_statement)
     
-    def export_to_duckdb(self, df, table_name, if_exists='replace'):
+    def export_to_duckdb(self, df, table_name, if_exists='replace', unique_key=None):
         """Export DataFrame to DuckDB using dbt naming conventions"""
-        return self.duckdb_helper.export_to_duckdb(df, table_name, if_exists)
+        return self.duckdb_helper.export_to_duckdb(df, table_name, if_exists, unique_key)
+
+    def export_stream_to_duckdb(self, batches, table_name, if_exists='replace', memory_limit=None, preview_rows=5, unique_key=None):
+        """Stream Arrow record batches into DuckDB using dbt naming conventions"""
+        return self.duckdb_helper.export_stream(batches, table_name, if_exists, memory_limit, preview_rows, unique_key)
     
     
     
-    def snowflake_connection_query_execution(self, connection_parameters,statement=None):
-        session = Session.builder.configs(connection_parameters).create()
-        root = Root(session)
+    @property
+    def connection_parameters(self):
+        return dict(user = self.profile_config.get("user"),
+                    authenticator = self.profile_config.get("authenticator"),
+                    role = self.profile_config.get("role"),
+                    account = self.profile_config.get("account"),
+                    warehouse = self.profile_config.get("warehouse"),
+                    database = self.profile_config.get("database"),
+                    schema = self.profile_config.get("schema")
+                   )
+
+    def connections(self, connection_parameters):
+        """Pool of warm Snowpark sessions for this profile and target"""
+        return connection_manager.pool(
+            ('snowflake', self.profile_name, self.target),
+            factory=lambda: Session.builder.configs(connection_parameters).create(),
+            signature=repr(connection_parameters),
+            health_check=lambda session: session.sql("SELECT 1").collect(),
+            close=lambda session: session.close(),
+        )
+
+    def _fetch_arrow(self, session, statement):
+        """
+        Run a statement on the session's connection and collect the result as Arrow batches
+
+        Returns:
+        - (pyarrow.Table, Snowflake query id)
+        """
+        cursor = session.connection.cursor()
+        try:
+            cursor.execute(statement)
+            try:
+                # Concatenating the batches is zero-copy, the table only references them
+                batches = list(cursor.fetch_arrow_batches())
+            except NotSupportedError:
+                # DDL/DML results (status, number of rows inserted, ...) aren't sent as Arrow
+                return self._fetch_rows(cursor), cursor.sfqid
+            if batches:
+                table = pa.concat_tables(batches)
+            else:
+                table = pa.table({column[0]: pa.array([], pa.null()) for column in cursor.description or []})
+            return table, cursor.sfqid
+        finally:
+            cursor.close()
+
+    def _fetch_rows(self, cursor):
+        """Arrow table of a result that isn't sent as Arrow, the row count if the statement returned no rows"""
+        if not cursor.description:
+            return pa.table({'number of rows affected': [cursor.rowcount]})
+        names = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+        if not rows:
+            return pa.table({name: pa.array([], pa.null()) for name in names})
+        return pa.Table.from_arrays([pa.array(column) for column in zip(*rows)], names=names)
+
+    def iter_arrow_batches(self, statement):
+        """Run a statement and yield its result as Arrow record batches as Snowflake delivers the result chunks"""
+        require_pyarrow("Streaming")
+        start_time = time()
+        with self.connections(self.connection_parameters).connection() as session:
+            cursor = session.connection.cursor()
+            try:
+                cursor.execute(statement)
+                print(f"{prStyle.GREEN}EXECUTION_TIME {time() - start_time:.3f} seconds{prStyle.RESET}")
+                empty = True
+                for table in cursor.fetch_arrow_batches():
+                    empty = False
+                    yield from table.to_batches()
+                if empty and cursor.description:
+                    # Empty result: Snowflake sends no batches, keep the columns as text
+                    yield pa.RecordBatch.from_pylist([], schema=pa.schema([(column[0], pa.string()) for column in cursor.description]))
+            finally:
+                cursor.close()
+
+    def _run_with_query_id(self, session, statement, arrow=False):
+        """
+        Run a statement and return (result, Snowflake query id)
+        The result is a pyarrow.Table if arrow is True, otherwise a DataFrame.
+        """
+        if pa is None:
+            with session.query_history() as history:
+                df = session.sql(statement).to_pandas()
+            return df, (history.queries[-1].query_id if history.queries else None)
+        table, query_id = self._fetch_arrow(session, statement)
+        if arrow:
+            return table, query_id
+        # self_destruct frees each Arrow column once it is converted, which keeps peak memory
+        # close to the size of the DataFrame instead of Arrow + pandas copies side by side
+        return arrow_to_pandas(table, self_destruct=True, split_blocks=True), query_id
+
+    def _reuse_previous_result(self, pool, reuse_key, reuse, arrow=False):
+        """Fetch the result of the last run of the same statement via RESULT_SCAN, or None"""
+        # Snowflake keeps query results for 24 hours
+        previous = query_history.lookup(reuse_key, min(reuse, SNOWFLAKE_RESULT_RETENTION_MINUTES))
+        if previous is None:
+            return None, None
+        try:
+            df, _ = pool.run(lambda session: self._run_with_query_id(session, f"SELECT * FROM TABLE(RESULT_SCAN('{previous['query_id']}'))", arrow), retry=True)
+        except Exception as e:
+            logger.debug(f"Result of query {previous['query_id']} can't be reused: {e}")
+            query_history.forget(reuse_key)
+            return None, None
+        return df, previous['query_id']
+
+    def run_statements(self, statements, concurrent=None, arrow=False):
+        """Run the statements of a cell in order on one session, or concurrently on up to `concurrent` pooled sessions"""
+        def execute(session, statement):
+            start_time = time()
+            df, _ = self._run_with_query_id(session, statement, arrow)
+            print(f"{prStyle.GREEN}EXECUTION_TIME {time() - start_time:.3f} seconds{prStyle.RESET}")
+            return df
+        return execute_statements(self.connections(self.connection_parameters), statements, execute, concurrent)
+
+    def snowflake_connection_query_execution(self, connection_parameters,statement=None, reuse=None, arrow=False):
+        pool = self.connections(connection_parameters)
         if statement==None:
-            return root
+            return Root(pool.shared())
         else:
             
             #------------------------------ start ----------------------------
             # 1. Run query
             try:
                 start_time = time()  # Start the timer
-                df = session.sql(statement).to_pandas()
+                df = query_id = None
+                if reuse:
+                    reuse_key = query_history.key(self.adapter_name, self.profile_name, self.target, statement)
+                    df, query_id = self._reuse_previous_result(pool, reuse_key, reuse, arrow)
+                reused_info = f" | {prStyle.BLUE}reused {query_id}{prStyle.RESET}" if query_id else ""
+                if df is None:
+                    df, query_id = pool.run(lambda session: self._run_with_query_id(session, statement, arrow), retry=is_read_only(statement))
+                    if reuse and query_id:
+                        query_history.record(reuse_key, query_id)
                 execution_time_seconds = time() - start_time  # Measure execution time
-                print(f"{prStyle.GREEN}EXECUTION_TIME {execution_time_seconds:.3f} seconds" )
+                print(f"{prStyle.GREEN}EXECUTION_TIME {execution_time_seconds:.3f} seconds{reused_info}" )
 
             except Exception as e:
                 print(f"{prStyle.RED}Not a SELECT statement.\n{e}")
@@ -149,7 +286,15 @@ class SnowflakeSQLMagics(Magics):
     @magic_arguments.argument('--profile', default='dbt_snowflake_dwh', help='')
     @magic_arguments.argument('--target', default='dev', help='')
     @magic_arguments.argument('--export_duckdb', '-ddb', action='store_true', help='Export DataFrame to DuckDB using table name from dbt ref().')
-    @magic_arguments.argument('--duckdb_mode', '-mode', default='replace', choices=['replace', 'append'], help='DuckDB export mode: replace (default) or append.')
+    @magic_arguments.argument('--duckdb_mode', '-mode', default='replace', choices=['replace', 'append', 'merge'], help='DuckDB export mode: replace (default), append or merge (upsert by --unique_key).')
+    @magic_arguments.argument('--unique_key', default=None, help='Comma separated key column(s) for --duckdb_mode merge, e.g. id or col1,col2.')
+    @magic_arguments.argument('--reuse', nargs='?', const=60, default=None, type=int, help='Reuse the results of the same statement run within the last N minutes (default 60, at most 24 hours).')
+    @magic_arguments.argument('--cache', nargs='?', const=60, default=None, type=int, help='Cache the result locally for N minutes (default 60, 0 never expires). See %%dbt_cache.')
+    @magic_arguments.argument('--arrow', action='store_true', help='Keep the result as a pyarrow.Table and only convert the displayed rows, without --cache (requires pyarrow).')
+    @magic_arguments.argument('--stream', action='store_true', help='With --export_duckdb: stream record batches into DuckDB without building a DataFrame (requires pyarrow).')
+    @magic_arguments.argument('--memory_limit', default=None, type=int, help='DuckDB memory limit in MB for --stream.')
+    @magic_arguments.argument('--concurrent', nargs='?', const=4, default=None, type=int, help='Run the statements of a multi-statement cell concurrently on up to N pooled connections (default 4). By default they run in order on one connection.')
+    @magic_arguments.argument('--background', '-bg', action='store_true', help='Run the query on a worker thread and return immediately. The result is stored in --dataframe when it finishes.')
     def snowflake(self, line, cell=None):
         """
         ---------------------------------------------------------------------------
@@ -174,6 +319,40 @@ class SnowflakeSQLMagics(Magics):
         %%snowflake --export_duckdb --duckdb_mode append
         SELECT * FROM {{ ref('my_model') }}
         
+        %%snowflake --export_duckdb --duckdb_mode merge --unique_key id
+        SELECT * FROM {{ ref('my_model') }}  # Upserts changed and new rows by id, unchanged rows are kept
+        
+        %%snowflake --export_duckdb --stream --memory_limit 2048
+        SELECT * FROM {{ ref('my_model') }}  # Streamed into DuckDB batch by batch, df is not created
+        
+        Result Reuse:
+        
+        %%snowflake --reuse
+        SELECT * FROM {{ ref('my_model') }}  # RESULT_SCAN of the same statement from the last 60 minutes
+        
+        %%snowflake --cache 120
+        SELECT * FROM {{ ref('my_model') }}  # Result is cached locally as Parquet for 120 minutes, see %dbt_cache
+        
+        Large Results:
+        
+        %%snowflake --arrow -n 10
+        SELECT * FROM {{ ref('my_big_model') }}  # df is a pyarrow.Table, only 10 rows are converted for display
+        
+        Multiple Statements:
+        
+        %%snowflake
+        CREATE TEMPORARY TABLE recent AS SELECT * FROM {{ ref('orders') }} WHERE day > current_date - 7;
+        SELECT count(*) FROM recent;  # Runs in order on one session, results in df_1, df_2 and df (the last)
+        
+        %%snowflake --concurrent
+        SELECT * FROM {{ ref('orders') }};
+        SELECT * FROM {{ ref('customers') }};  # Independent statements run at the same time
+        
+        Background Execution:
+        
+        %%snowflake --background -df orders
+        SELECT * FROM {{ ref('my_big_model') }}  # Returns a job handle at once, orders is set when the query finishes
+        
         Output Control:
         
         %%snowflake -n 10
@@ -197,62 +376,101 @@ class SnowflakeSQLMagics(Magics):
 
         args = magic_arguments.parse_argstring(self.snowflake, line)
         #print(args)
-        self.dbt_helper = dbtHelperAdapter('snowflake', args.profile, args.target) 
+        self.dbt_helper = dbtHelperAdapter.get_or_create('snowflake', args.profile, args.target) 
 
-        env = Environment()
         def ipython(variable):
             try: result = get_ipython().ev(variable)
             except: result = False
             return result
 
-        kwargs = {i:ipython(i) for i in meta.find_undeclared_variables(env.parse(cell)) if ipython(i)}
+        kwargs = {i:ipython(i) for i in self.dbt_helper.undeclared_variables(cell) if ipython(i)}
 
-        macros_txt = self.dbt_helper.macros_txt
-        jinja_statement = macros_txt+cell
-        statement = Template(jinja_statement).render(source=self.dbt_helper.source, ref=self.dbt_helper.ref, var=self.dbt_helper.var, **kwargs).strip()
+        statement = self.dbt_helper.render(cell, **kwargs)
         #print(f'statement of query {statement}')
 
         
         if args.parser:
+            macros = self.dbt_helper.required_macros(cell)
+            if macros:
+                print(f"-- macros: {', '.join(macros)}")
             print(statement)
         else:
+            if args.export_duckdb and args.duckdb_mode == 'merge' and not args.unique_key:
+                print(f"{prStyle.RED}--duckdb_mode merge requires --unique_key, e.g. --unique_key id or --unique_key col1,col2{prStyle.RESET}")
+                return None
+
             # Check DuckDB availability before executing query if export is requested
             if args.export_duckdb:
                 if not self.dbt_helper.check_duckdb_availability():
                     print(f"{prStyle.RED}Aborting query execution due to DuckDB unavailability.{prStyle.RESET}")
                     return None
-            
-            connection_parameters= dict(user = self.dbt_helper.profile_config.get("user"),
-                               authenticator = self.dbt_helper.profile_config.get("authenticator"),
-                              role = self.dbt_helper.profile_config.get("role"),
-                              account = self.dbt_helper.profile_config.get("account"),
-                              warehouse = self.dbt_helper.profile_config.get("warehouse"),
-                              database = self.dbt_helper.profile_config.get("database"),
-                              schema = self.dbt_helper.profile_config.get("schema")
-                             )
-            
-            df = self.dbt_helper.snowflake_connection_query_execution(connection_parameters,statement)
 
-            self.shell.user_ns[args.dataframe] = df
-            
-            # Export to DuckDB if requested
-            if args.export_duckdb and df is not None:
-                # Extract table name from ref() in the original cell content
+            # Background jobs keep their own reference, later cells may switch self.dbt_helper
+            dbt_helper = self.dbt_helper
+            statements = split_statements(statement)
+
+            # Stream straight into DuckDB without building a DataFrame
+            if args.stream:
                 table_name = self.dbt_helper.extract_ref_table_name(cell)
-                
-                if table_name:
-                    self.dbt_helper.export_to_duckdb(df, table_name, args.duckdb_mode)
+                if not args.export_duckdb or not table_name:
+                    print(f"{prStyle.RED}--stream requires --export_duckdb and a ref() to name the DuckDB table.{prStyle.RESET}")
+                    return None
+                if len(statements) > 1:
+                    print(f"{prStyle.RED}--stream runs a single statement, this cell contains {len(statements)}.{prStyle.RESET}")
+                    return None
+                batches = self.dbt_helper.iter_arrow_batches(statement)
+                export = lambda: dbt_helper.export_stream_to_duckdb(batches, table_name, args.duckdb_mode, args.memory_limit, preview_rows=int(args.n_output), unique_key=args.unique_key)
+                if args.background:
+                    return background_jobs.submit(f'%%snowflake --stream -> {table_name}', export)
+                df = export()
+                return df if int(args.n_output) else None
+            
+            if args.arrow:
+                require_pyarrow("--arrow")
+                if args.cache is not None:
+                    # The result cache stores and returns DataFrames
+                    print(f"{prStyle.YELLOW}--cache is ignored with --arrow, the query runs without the result cache.{prStyle.RESET}")
+
+            def execute():
+                run = lambda: dbt_helper.snowflake_connection_query_execution(dbt_helper.connection_parameters,statement, reuse=args.reuse, arrow=args.arrow)
+                if len(statements) > 1:
+                    results = dbt_helper.run_statements(statements, args.concurrent, args.arrow)
+                    for index, result in enumerate(results, 1):
+                        self.shell.user_ns[f'{args.dataframe}_{index}'] = result
+                    df = results[-1]
+                    print(f"{prStyle.BLUE}{len(results)} statements{prStyle.RESET} | results in {args.dataframe}_1 ... {args.dataframe}_{len(results)}, {args.dataframe} is the last one")
+                elif args.cache is not None and not args.arrow:
+                    df = get_result_cache().cached(statement, dbt_helper.adapter_name, dbt_helper.profile_name, dbt_helper.target, args.cache, run)
                 else:
-                    print(f"{prStyle.RED}No ref() function found in SQL. Please use ref('table_name') to specify the table for DuckDB export.{prStyle.RESET}")
+                    df = run()
+
+                self.shell.user_ns[args.dataframe] = df
+                
+                # Export to DuckDB if requested
+                if args.export_duckdb and df is not None:
+                    # Extract table name from ref() in the original cell content
+                    table_name = dbt_helper.extract_ref_table_name(cell)
+                    
+                    if table_name:
+                        dbt_helper.export_to_duckdb(df, table_name, args.duckdb_mode, args.unique_key)
+                    else:
+                        print(f"{prStyle.RED}No ref() function found in SQL. Please use ref('table_name') to specify the table for DuckDB export.{prStyle.RESET}")
+                return df
+
+            if args.background:
+                return background_jobs.submit(f'%%snowflake -> {args.dataframe}', execute)
+            df = execute()
             
             # Handle n_output behavior: if 0, don't display dataframe
             if int(args.n_output) == 0:
                 return None
+            elif args.arrow and df is not None:
+                return arrow_to_pandas(df.slice(0, int(args.n_output)))
             else:
                 df = df.head(int(args.n_output)) if type(df)==pd.DataFrame else None
                 return df 
         
-def export_dataframe_to_duckdb(df, table_name, profile_name=None, target=None, if_exists='replace'):
+def export_dataframe_to_duckdb(df, table_name, profile_name=None, target=None, if_exists='replace', unique_key=None):
     """
     Standalone function to export any DataFrame to DuckDB using dbt profile configuration
     
@@ -261,14 +479,16 @@ def export_dataframe_to_duckdb(df, table_name, profile_name=None, target=None, i
     - table_name: name of the table in DuckDB
     - profile_name: dbt profile name (optional)
     - target: dbt target (optional) 
-    - if_exists: 'replace' (default) or 'append'
+    - if_exists: 'replace' (default), 'append' or 'merge'
+    - unique_key: key column(s) for merge, e.g. 'id' or 'col1,col2'
     
     Usage:
     export_dataframe_to_duckdb(my_df, 'my_table')
     export_dataframe_to_duckdb(my_df, 'my_table', if_exists='append')
+    export_dataframe_to_duckdb(my_df, 'my_table', if_exists='merge', unique_key='id')
     """
-    helper = dbtHelperAdapter('snowflake', profile_name, target)
-    helper.export_to_duckdb(df, table_name, if_exists)
+    helper = dbtHelperAdapter.get_or_create('snowflake', profile_name, target)
+    helper.export_to_duckdb(df, table_name, if_exists, unique_key)
 
 
 def load_ipython_extension(ipython):
@@ -279,4 +499,7 @@ def load_ipython_extension(ipython):
     });
     """
     display.display_javascript(js, raw=True)
-    ipython.register_magics(SnowflakeSQLMagics)
\ No newline at end of file
+    ipython.register_magics(SnowflakeSQLMagics)
+    ipython.register_magics(ResultCacheMagics)
+    register_sync_adapter('snowflake', dbtHelperAdapter)
+    ipython.register_magics(DbtSyncMagics)
\ No newline at end of file
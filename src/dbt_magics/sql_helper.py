@@ -0,0 +1,225 @@
+"""
+SQL Helper Module for dbt-magics
+
+Quote- and comment-aware helpers for rendered SQL statements, and the execution
+of cells that contain several statements.
+"""
+
+import hashlib
+import re
+
+from dbt_magics.datacontroller import prStyle
+
+# Run of characters that can't start a quote, comment, whitespace or end a statement
+_CODE = re.compile(r"[^'\"`\s\-/;$]+|.")
+_WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+# BEGIN followed by these starts a transaction, not a block
+_TRANSACTION_WORDS = {'TRANSACTION', 'WORK', 'TRAN'}
+# BEGIN only opens a block where a statement starts: first in a statement, after ';' or a label ':' or after these words.
+# Anywhere else, e.g. after '.' or ',' in a select list, it is an identifier.
+_BLOCK_LEADS = {'THEN', 'DO', 'AS', 'ELSE', 'LOOP', 'REPEAT', 'BEGIN'}
+# Statements starting with these only read, unless one of _WRITE_WORDS appears (e.g. WITH ... INSERT)
+_READ_ONLY_WORDS = {'SELECT', 'WITH', 'SHOW', 'DESCRIBE', 'DESC', 'EXPLAIN', 'VALUES', 'LIST', 'LS'}
+_WRITE_WORDS = {'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'CREATE', 'DROP', 'ALTER', 'TRUNCATE', 'COPY', 'UNLOAD', 'CALL', 'EXECUTE', 'INTO', 'REPLACE'}
+# Scripting statements opening a block closed by END <word> (END IF, END LOOP, ...), in statement-leading position only:
+# IF(...) is a function, IF NOT EXISTS part of DDL, FOR UPDATE part of a query, WHILE ... LOOP a single block.
+_BLOCK_WORDS = {'IF', 'LOOP', 'WHILE', 'FOR', 'REPEAT'}
+
+
+def _scan(statement):
+    """
+    Yield (kind, text) tokens of a SQL statement.
+    kind is one of 'quoted', 'comment', 'space' or 'code'.
+    """
+    i, n = 0, len(statement)
+    while i < n:
+        char = statement[i]
+        if statement.startswith('$$', i):
+            # Dollar quoted bodies of Snowflake procedures and scripts
+            j = statement.find('$$', i + 2)
+            j = n if j == -1 else j + 2
+            yield 'quoted', statement[i:j]
+            i = j
+        elif char in ("'", '"', '`'):
+            j = i + 1
+            while j < n:
+                if statement[j] == char:
+                    # Doubled quotes escape the quote character
+                    if j + 1 < n and statement[j + 1] == char:
+                        j += 2
+                        continue
+                    break
+                if statement[j] == '\\' and char == "'":
+                    j += 1
+                j += 1
+            yield 'quoted', statement[i:j + 1]
+            i = j + 1
+        elif statement.startswith('--', i):
+            j = statement.find('\n', i)
+            j = n if j == -1 else j
+            yield 'comment', statement[i:j]
+            i = j
+        elif statement.startswith('/*', i):
+            j = statement.find('*/', i + 2)
+            j = n if j == -1 else j + 2
+            yield 'comment', statement[i:j]
+            i = j
+        elif char.isspace():
+            j = i
+            while j < n and statement[j].isspace():
+                j += 1
+            yield 'space', statement[i:j]
+            i = j
+        else:
+            match = _CODE.match(statement, i)
+            yield 'code', match.group(0)
+            i = match.end()
+
+
+def normalize_sql(statement):
+    """
+    Normalize a SQL statement so that whitespace and comment edits don't change it.
+    Comments are dropped, whitespace outside of quotes is collapsed and a trailing ';' removed.
+    """
+    parts = []
+    for kind, text in _scan(statement):
+        if kind in ('comment', 'space'):
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        else:
+            parts.append(text)
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def sql_fingerprint(statement, *scope):
+    """Stable hash of a normalized statement and its scope, e.g. (adapter, profile, target)"""
+    content = repr(scope) + '\n' + normalize_sql(statement)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def split_statements(statement):
+    """
+    Split rendered SQL into its statements.
+
+    Semicolons inside quotes, comments, $$ bodies, BEGIN ... END and CASE ... END blocks,
+    and IF/LOOP/WHILE/FOR/REPEAT ... END <word> scripting blocks don't end a statement.
+    BEGIN and the scripting words only open a block in statement-leading position, a
+    column named begin or an IF() function call doesn't. Empty statements and statements consisting only of
+    comments are dropped; the text of each statement is kept as written, without the ';'.
+    Scripts starting with DECLARE are kept as one statement, their variables only live
+    as long as the script.
+    """
+    statements, parts = [], []
+    depth, pending, has_sql = 0, None, False
+    last = None  # previous word (upper case) or punctuation character of the statement
+
+    def close_statement():
+        text = ''.join(parts).strip()
+        if has_sql and text:
+            statements.append(text)
+        parts.clear()
+
+    def resolve(word):
+        # Decide what the previous BEGIN or END meant once the next word (or ';') is known
+        nonlocal depth, pending
+        previous, pending = pending, None
+        if previous == 'BEGIN' and word not in _TRANSACTION_WORDS:
+            depth += 1
+        elif previous == 'END':
+            depth = max(depth - 1, 0)
+            # END CASE, END IF, ... close their statement, the word doesn't open a new one
+            return word == 'CASE' or word in _BLOCK_WORDS
+        return False
+
+    for kind, text in _scan(statement):
+        if kind == 'code' and text == ';':
+            if pending == 'BEGIN':
+                pending = None  # BEGIN; starts a transaction
+            elif pending:
+                resolve(';')
+            last = ';'
+            if depth == 0:
+                close_statement()
+                has_sql = False
+                last = None
+                continue
+        elif kind == 'code':
+            end = 0
+            for match in _WORD.finditer(text):
+                if match.start() > end:
+                    last = text[match.start() - 1]
+                end = match.end()
+                word, leading = match.group(0).upper(), last in (None, ';', ':') or last in _BLOCK_LEADS
+                last = word
+                if pending and resolve(word):
+                    continue
+                if word == 'END' or (word == 'BEGIN' and leading):
+                    pending = word
+                elif word == 'CASE' or (word in _BLOCK_WORDS and leading):
+                    depth += 1
+            if end < len(text):
+                last = text[-1]
+        elif kind == 'quoted':
+            last = text[0]
+        if kind in ('code', 'quoted'):
+            has_sql = True
+        parts.append(text)
+    if pending:
+        resolve(';')
+    close_statement()
+    if len(statements) > 1 and _first_word(statements[0]) == 'DECLARE':
+        return [statement.strip().rstrip(';').rstrip()]
+    return statements
+
+
+def is_read_only(statement):
+    """True if a statement only reads and can safely be run again, e.g. after a connection broke"""
+    words = [word.upper() for kind, text in _scan(statement) if kind == 'code' for word in _WORD.findall(text)]
+    return bool(words) and words[0] in _READ_ONLY_WORDS and not _WRITE_WORDS.intersection(words)
+
+
+def _first_word(statement):
+    for kind, text in _scan(statement):
+        if kind == 'code':
+            match = _WORD.match(text)
+            return match.group(0).upper() if match else None
+        if kind == 'quoted':
+            return None
+    return None
+
+
+def execute_statements(pool, statements, execute, concurrent=None):
+    """
+    Run the statements of a multi-statement cell on a ConnectionPool
+
+    Parameters:
+    - pool: ConnectionPool of the adapter
+    - statements: list of statements, see split_statements
+    - execute: callable(connection, statement) returning the result of one statement
+    - concurrent: None to run the statements in order on one connection, or the number
+      of pooled connections to run independent statements on at the same time
+
+    Returns:
+    - list with the result of each statement, None for failed and skipped statements.
+      In sequential mode the statements after a failed one are skipped, they may depend on it.
+    """
+    failed = []
+
+    def run(connection, index):
+        if failed and not concurrent:
+            print(f"{prStyle.YELLOW}Statement {index + 1} skipped.{prStyle.RESET}")
+            return None
+        try:
+            result = execute(connection, statements[index])
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except BaseException as e:
+            failed.append(index)
+            print(f"{prStyle.RED}Statement {index + 1} failed.\n{e}{prStyle.RESET}")
+            return None
+        rows = f" | {len(result)} rows" if result is not None else ""
+        print(f"{prStyle.BLUE}Statement {index + 1}/{len(statements)} done{prStyle.RESET}{rows}")
+        return result
+
+    return pool.run_many(run, range(len(statements)), concurrent=bool(concurrent), max_workers=concurrent or 1)
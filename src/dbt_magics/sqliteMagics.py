@@ -5,16 +5,22 @@ import pandas as pd
 from IPython.core import display, magic_arguments
 from IPython import get_ipython
 from IPython.core.magic import Magics, line_cell_magic, magics_class
-from jinja2 import Environment, Template, meta
 
+from dbt_magics.arrow_helper import pa, require_pyarrow
+from dbt_magics.background import background_jobs
+from dbt_magics.connections import connection_manager
 from dbt_magics.datacontroller import DataController, prStyle
 from dbt_magics.dbt_helper import dbtHelper
+from dbt_magics.duckdb_helper import DuckDBHelper
+from dbt_magics.result_cache import ResultCacheMagics, get_result_cache
+from dbt_magics.sql_helper import execute_statements, is_read_only, split_statements
+from dbt_magics.sync import DbtSyncMagics, register_sync_adapter
 
 
 class SQLiteDataController(DataController):
     def __init__(self):
-        self.dbt_helper = dbtHelperAdapter(profile_name=None, target='prod')
-        super().__init__(r"%%sqlity")
+        self.dbt_helper = dbtHelperAdapter.get_or_create(profile_name=None, target='prod')
+        super().__init__(r"%%sqlity", cache_namespace=f"sqlite/{self.dbt_helper.profile_name}/{self.dbt_helper.target}")
 
     """
     Implemented Abstract methods
@@ -58,7 +64,7 @@ class SQLiteDataController(DataController):
             if star:
                 cols = '*'
             else:
-                cols = "\n    , ".join([f(i.check.description, i.lab.value) for i in self.check_boxes if i.check.value])
+                cols = "\n    , ".join([f(name, dtype.upper()) for name, dtype in self.wg_check_boxes.selected()])
             
             output_string = f'{prStyle.RED}{self.lineMagicName}{prStyle.RESET}\n{prStyle.MAGENTA}SELECT{prStyle.RESET}\n    {cols} \n{prStyle.MAGENTA}FROM{prStyle.RESET} {prStyle.GREEN}"{self.wg_database.value}"."{self.wg_tables.value}"{prStyle.RESET}{part_string}'
 
@@ -71,6 +77,7 @@ class SQLiteDataController(DataController):
 class dbtHelperAdapter(dbtHelper):
     def __init__(self, adapter_name='sqlite', profile_name=None, target=None):
         super().__init__(adapter_name=adapter_name, profile_name=profile_name, target=target)
+        self.duckdb_helper = DuckDBHelper(self)
         
     def ref(self, table_name):
         return f'main."{table_name}"'
@@ -85,24 +92,115 @@ class dbtHelperAdapter(dbtHelper):
     
 
 
-    def run_query(self, sql_statement, main_database, extensions=[], schemas_and_paths=None, verbose=True):
-        with sql.connect(main_database) as conn:
-            cursor = conn.cursor()
-            conn.enable_load_extension(True)
-            for extension in extensions:
-                conn.load_extension(extension)
-            for key in schemas_and_paths.keys():
-                if key=='main':continue
-                query = f"""attach '{schemas_and_paths[key]}' as {key};"""
-                cursor.execute(query)
-
-            #---------------------- For Performance -----------------------#
-            sql_script = """pragma journal_mode = WAL;
-                            pragma synchronous = normal;
-                            pragma temp_store = memory;
-                            pragma mmap_size = 30000000000;"""
-            results = cursor.executescript(sql_script)
+    # DuckDB methods - delegated to DuckDBHelper
+    def check_duckdb_availability(self):
+        """Check if DuckDB database is available and not locked"""
+        return self.duckdb_helper.check_duckdb_availability()
+
+    def extract_ref_table_name(self, sql_statement):
+        """Extract table name from dbt ref() function in SQL statement"""
+        return self.duckdb_helper.extract_ref_table_name(sql_statement)
+
+    def export_to_duckdb(self, df, table_name, if_exists='replace', unique_key=None):
+        """Export DataFrame to DuckDB using dbt naming conventions"""
+        return self.duckdb_helper.export_to_duckdb(df, table_name, if_exists, unique_key)
+
+    def export_stream_to_duckdb(self, batches, table_name, if_exists='replace', memory_limit=None, preview_rows=5, unique_key=None):
+        """Stream Arrow record batches into DuckDB using dbt naming conventions"""
+        return self.duckdb_helper.export_stream(batches, table_name, if_exists, memory_limit, preview_rows, unique_key)
+
+    def _connect(self, main_database, extensions, schemas_and_paths):
+        # Connections may be used by background threads, access is serialized by the pool
+        conn = sql.connect(main_database, check_same_thread=False)
+        cursor = conn.cursor()
+        conn.enable_load_extension(True)
+        for extension in extensions:
+            conn.load_extension(extension)
+        for key in schemas_and_paths.keys():
+            if key=='main':continue
+            query = f"""attach '{schemas_and_paths[key]}' as {key};"""
+            cursor.execute(query)
+
+        #---------------------- For Performance -----------------------#
+        sql_script = """pragma journal_mode = WAL;
+                        pragma synchronous = normal;
+                        pragma temp_store = memory;
+                        pragma mmap_size = 30000000000;"""
+        cursor.executescript(sql_script)
+        return conn
+
+    @property
+    def query_parameters(self):
+        """Profile settings run_query() and iter_arrow_batches() need besides the statement"""
+        return dict(main_database=self.profile_config['schemas_and_paths']['main'],
+                    extensions=self.profile_config['extensions'],
+                    schemas_and_paths=self.profile_config['schemas_and_paths'])
+
+    def connections(self, main_database, extensions=[], schemas_and_paths=None):
+        """Pool of open SQLite connections with extensions loaded and schemas attached"""
+        schemas_and_paths = schemas_and_paths or {}
+        return connection_manager.pool(
+            ('sqlite', self.profile_name, self.target),
+            factory=lambda: self._connect(main_database, extensions, schemas_and_paths),
+            signature=repr((main_database, extensions, schemas_and_paths)),
+            health_check=lambda conn: conn.execute("select 1"),
+            close=lambda conn: conn.close(),
+        )
+
+    def iter_arrow_batches(self, sql_statement, main_database, extensions=[], schemas_and_paths=None, batch_size=100_000):
+        """Run a query and yield its result as Arrow record batches of batch_size rows"""
+        require_pyarrow("Streaming")
+        with self.connections(main_database, extensions, schemas_and_paths).connection() as conn:
+            cursor = conn.execute(sql_statement)
+            names = [column[0] for column in cursor.description or []]
+            schema = None
+            while names:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                # The first batch fixes the schema of the whole stream, every batch is converted to it
+                if schema is None:
+                    schema = pa.schema([(name, self._arrow_type(column)) for name, column in zip(names, columns)])
+                yield pa.RecordBatch.from_arrays([self._arrow_array(column, field) for column, field in zip(columns, schema)], schema=schema)
+            if names and schema is None:
+                # Empty result: SQLite has no column types without rows, keep the columns as text
+                yield pa.RecordBatch.from_pylist([], schema=pa.schema([(name, pa.string()) for name in names]))
+
+    def _arrow_type(self, values):
+        # SQLite columns can mix types, and a column that is all NULL has no type yet, use text for those
+        try:
+            data_type = pa.array(values).type
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.string()
+        return pa.string() if pa.types.is_null(data_type) else data_type
+
+    def _arrow_array(self, values, field):
+        if pa.types.is_string(field.type):
+            return pa.array([value if value is None or isinstance(value, str) else str(value) for value in values], pa.string())
+        try:
+            return pa.array(values, field.type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f"Column '{field.name}' changes its type after the first batch ({field.type}): {e}. "
+                             f"CAST it in the query to export it.") from e
+
+    def run_statements(self, statements, main_database, extensions=[], schemas_and_paths=None, concurrent=None):
+        """Run the statements of a cell in order on one connection, or concurrently on up to `concurrent` pooled connections"""
+        def execute(conn, statement):
+            start = time()
+            try:
+                cursor = conn.execute(statement)
+                # Statements without a result set (CREATE, INSERT, ...) return None
+                df = pd.DataFrame.from_records(cursor.fetchall(), columns=[column[0] for column in cursor.description]) if cursor.description else None
+            finally:
+                conn.commit()
+            duration = time()-start
+            print(f'{prStyle.GREEN}Execution time: {int(duration//60)} min. - {duration%60:.2f} sec.{prStyle.RESET}')
+            return df
+        return execute_statements(self.connections(main_database, extensions, schemas_and_paths), statements, execute, concurrent)
 
+    def run_query(self, sql_statement, main_database, extensions=[], schemas_and_paths=None, verbose=True):
+        def execute(conn):
             start = time()        
             try:
                 df = pd.read_sql(sql_statement, conn)
@@ -110,9 +208,12 @@ class dbtHelperAdapter(dbtHelper):
                 print(f"{prStyle.RED}Not a SELECT statement.\n{e}")
                 
                 df = None
+            finally:
+                conn.commit()
             duration = time()-start
             if verbose: print(f'{prStyle.GREEN}Execution time: {int(duration//60)} min. - {duration%60:.2f} sec.')
             return df
+        return self.connections(main_database, extensions, schemas_and_paths).run(execute, retry=is_read_only(sql_statement))
     
 
 @magics_class
@@ -126,6 +227,14 @@ class SQLiteSQLMagics(Magics):
     @magic_arguments.argument('--parser', '-p', action='store_true', help='Translate Jinja.')
     @magic_arguments.argument('--profile', default=None, help='')
     @magic_arguments.argument('--target', default='prod', help='')
+    @magic_arguments.argument('--cache', nargs='?', const=60, default=None, type=int, help='Cache the result locally for N minutes (default 60, 0 never expires). See %%dbt_cache.')
+    @magic_arguments.argument('--export_duckdb', '-ddb', action='store_true', help='Export DataFrame to DuckDB using table name from dbt ref().')
+    @magic_arguments.argument('--duckdb_mode', '-mode', default='replace', choices=['replace', 'append', 'merge'], help='DuckDB export mode: replace (default), append or merge (upsert by --unique_key).')
+    @magic_arguments.argument('--unique_key', default=None, help='Comma separated key column(s) for --duckdb_mode merge, e.g. id or col1,col2.')
+    @magic_arguments.argument('--stream', action='store_true', help='With --export_duckdb: stream record batches into DuckDB without building a DataFrame (requires pyarrow).')
+    @magic_arguments.argument('--memory_limit', default=None, type=int, help='DuckDB memory limit in MB for --stream.')
+    @magic_arguments.argument('--concurrent', nargs='?', const=4, default=None, type=int, help='Run the statements of a multi-statement cell concurrently on up to N pooled connections (default 4). By default they run in order on one connection.')
+    @magic_arguments.argument('--background', '-bg', action='store_true', help='Run the query on a worker thread and return immediately. The result is stored in --dataframe when it finishes.')
     def sqlity(self, line, cell=None):
         """
 ---------------------------------------------------------------------------
@@ -143,37 +252,118 @@ test_func = lambda x: x+1
 {{asdf.b, asdf.a}}
 SELECT * FROM {{ ref('table_in_dbt_project') }}
 ---------------------------------------------------------------------------
+---------------------------------------------------------------------------
+%%sqlity --export_duckdb --stream --memory_limit 2048
+SELECT * FROM {{ ref('table_in_dbt_project') }}  # Streamed into DuckDB batch by batch, df is not created
+---------------------------------------------------------------------------
+---------------------------------------------------------------------------
+%%sqlity
+CREATE TEMP TABLE recent AS SELECT * FROM {{ ref('table_in_dbt_project') }};
+SELECT count(*) FROM recent;  # Runs in order on one connection, results in df_1, df_2 and df (the last)
+---------------------------------------------------------------------------
+---------------------------------------------------------------------------
+%%sqlity --background -df orders
+SELECT * FROM {{ ref('table_in_dbt_project') }}  # Returns a job handle at once, orders is set when the query finishes
+---------------------------------------------------------------------------
 """
         if cell is None:
             dc = SQLiteDataController()
             return dc()
         else:        
             args = magic_arguments.parse_argstring(self.sqlity, line)
-            self.dbt_helper = dbtHelperAdapter(profile_name=args.profile, target=args.target)
-            env = Environment()
+            self.dbt_helper = dbtHelperAdapter.get_or_create(profile_name=args.profile, target=args.target)
             def ipython(variable):
                 try: result = get_ipython().ev(variable)
                 except: result = False
                 return result
 
-            kwargs = {i:ipython(i) for i in meta.find_undeclared_variables(env.parse(cell)) if ipython(i)}
+            kwargs = {i:ipython(i) for i in self.dbt_helper.undeclared_variables(cell) if ipython(i)}
 
-            macros_txt = self.dbt_helper.macros_txt
-            jinja_statement = macros_txt+cell
-            statement = Template(jinja_statement).render(source=self.dbt_helper.source, ref=self.dbt_helper.ref, var=self.dbt_helper.var, **kwargs).strip()
+            statement = self.dbt_helper.render(cell, **kwargs)
 
             if args.parser:
+                macros = self.dbt_helper.required_macros(cell)
+                if macros:
+                    print(f"-- macros: {', '.join(macros)}")
                 print(statement)
             else:
-                df = self.dbt_helper.run_query(
-                    sql_statement=statement,
-                    main_database=self.dbt_helper.profile_config['schemas_and_paths']['main'],
-                    extensions=self.dbt_helper.profile_config['extensions'],
-                    schemas_and_paths=self.dbt_helper.profile_config['schemas_and_paths'],
+                if args.export_duckdb and args.duckdb_mode == 'merge' and not args.unique_key:
+                    print(f"{prStyle.RED}--duckdb_mode merge requires --unique_key, e.g. --unique_key id or --unique_key col1,col2{prStyle.RESET}")
+                    return None
+
+                # Check DuckDB availability before executing query if export is requested
+                if args.export_duckdb:
+                    if not self.dbt_helper.check_duckdb_availability():
+                        print(f"{prStyle.RED}Aborting query execution due to DuckDB unavailability.{prStyle.RESET}")
+                        return None
+
+                # Background jobs keep their own reference, later cells may switch self.dbt_helper
+                dbt_helper = self.dbt_helper
+                statements = split_statements(statement)
+
+                # Stream straight into DuckDB without building a DataFrame
+                if args.stream:
+                    table_name = self.dbt_helper.extract_ref_table_name(cell)
+                    if not args.export_duckdb or not table_name:
+                        print(f"{prStyle.RED}--stream requires --export_duckdb and a ref() to name the DuckDB table.{prStyle.RESET}")
+                        return None
+                    if len(statements) > 1:
+                        print(f"{prStyle.RED}--stream runs a single statement, this cell contains {len(statements)}.{prStyle.RESET}")
+                        return None
+                    batches = self.dbt_helper.iter_arrow_batches(
+                        sql_statement=statement,
+                        main_database=self.dbt_helper.profile_config['schemas_and_paths']['main'],
+                        extensions=self.dbt_helper.profile_config['extensions'],
+                        schemas_and_paths=self.dbt_helper.profile_config['schemas_and_paths'],
+                        )
+                    export = lambda: dbt_helper.export_stream_to_duckdb(batches, table_name, args.duckdb_mode, args.memory_limit, preview_rows=int(args.n_output), unique_key=args.unique_key)
+                    if args.background:
+                        return background_jobs.submit(f'%%sqlity --stream -> {table_name}', export)
+                    df = export()
+                    return df if int(args.n_output) else None
+
+                def execute():
+                    run = lambda: dbt_helper.run_query(
+                        sql_statement=statement,
+                        main_database=dbt_helper.profile_config['schemas_and_paths']['main'],
+                        extensions=dbt_helper.profile_config['extensions'],
+                        schemas_and_paths=dbt_helper.profile_config['schemas_and_paths'],
+
+
+                    )
+                    if len(statements) > 1:
+                        results = dbt_helper.run_statements(
+                            statements,
+                            main_database=dbt_helper.profile_config['schemas_and_paths']['main'],
+                            extensions=dbt_helper.profile_config['extensions'],
+                            schemas_and_paths=dbt_helper.profile_config['schemas_and_paths'],
+                            concurrent=args.concurrent,
+                            )
+                        for index, result in enumerate(results, 1):
+                            self.shell.user_ns[f'{args.dataframe}_{index}'] = result
+                        df = results[-1]
+                        print(f"{prStyle.BLUE}{len(results)} statements{prStyle.RESET} | results in {args.dataframe}_1 ... {args.dataframe}_{len(results)}, {args.dataframe} is the last one")
+                    elif args.cache is not None:
+                        df = get_result_cache().cached(statement, dbt_helper.adapter_name, dbt_helper.profile_name, dbt_helper.target, args.cache, run)
+                    else:
+                        df = run()
+                    self.shell.user_ns[args.dataframe] = df
+
+                    # Export to DuckDB if requested
+                    if args.export_duckdb and df is not None:
+                        # Extract table name from ref() in the original cell content
+                        table_name = dbt_helper.extract_ref_table_name(cell)
+
+                        if table_name:
+                            dbt_helper.export_to_duckdb(df, table_name, args.duckdb_mode, args.unique_key)
+                        else:
+                            print(f"{prStyle.RED}No ref() function found in SQL. Please use ref('table_name') to specify the table for DuckDB export.{prStyle.RESET}")
+                    return df
 
+                if args.background:
+                    return background_jobs.submit(f'%%sqlity -> {args.dataframe}', execute)
+                df = execute()
 
-                )
-                self.shell.user_ns[args.dataframe] = df
                 df = df.head(int(args.n_output)) if type(df)==pd.DataFrame else None
                 return df
 
@@ -188,3 +378,6 @@ def load_ipython_extension(ipython):
     """
     display.display_javascript(js, raw=True)
     ipython.register_magics(SQLiteSQLMagics)
+    ipython.register_magics(ResultCacheMagics)
+    register_sync_adapter('sqlite', dbtHelperAdapter)
+    ipython.register_magics(DbtSyncMagics)
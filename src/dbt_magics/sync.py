@@ -0,0 +1,163 @@
+"""
+Sync Module for dbt-magics
+
+%dbt_sync mirrors many dbt models into the local DuckDB database in one go.
+Models are picked with dbt-style selectors, fetched from the warehouse as Arrow
+record batches and streamed into DuckDB on a bounded thread pool. A failed model
+is retried on its own while the rest of the batch keeps going.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import sleep, time
+
+import pandas as pd
+from IPython.core import magic_arguments
+from IPython.core.magic import Magics, line_magic, magics_class
+
+from dbt_magics.arrow_helper import require_pyarrow
+from dbt_magics.datacontroller import prStyle
+
+logger = logging.getLogger('dbt_magics')
+
+# Adapter name -> dbtHelperAdapter class, registered by the adapters' load_ipython_extension
+_sync_adapters = {}
+
+def register_sync_adapter(adapter_name, helper_class):
+    _sync_adapters[adapter_name] = helper_class
+
+
+class ModelSync:
+    """Fetch dbt models from the warehouse and stream them into DuckDB"""
+
+    def __init__(self, helper, threads=4, retries=2, retry_delay=2.0, limit=None):
+        """
+        Parameters:
+        - helper: dbtHelperAdapter of the warehouse, with iter_arrow_batches() and a duckdb_helper
+        - threads: number of models synced at the same time
+        - retries: retries per failed model
+        - retry_delay: seconds before the first retry, doubled for every further retry
+        - limit: only fetch the first N rows of each model (optional)
+        """
+        self.helper = helper
+        self.threads = threads
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.limit = limit
+
+    def statement(self, model):
+        statement = self.helper.render(f"SELECT * FROM {{{{ ref('{model}') }}}}")
+        return statement + (f"\nLIMIT {int(self.limit)}" if self.limit else "")
+
+    def _batches(self, model, counter):
+        # Athena and SQLite need the query settings of the profile besides the statement
+        parameters = getattr(self.helper, 'query_parameters', {})
+        for batch in self.helper.iter_arrow_batches(self.statement(model), **parameters):
+            counter['rows'] += batch.num_rows
+            counter['bytes'] += batch.nbytes
+            yield batch
+
+    def sync_model(self, model):
+        """Sync one model, retrying failures. Returns its report row."""
+        start = time()
+        for attempt in range(1, self.retries + 2):
+            counter = dict(rows=0, bytes=0)
+            try:
+                self.helper.duckdb_helper.export_stream(self._batches(model, counter), model, preview_rows=0, verbose=False, raise_errors=True)
+                error = None
+                break
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except BaseException as e:
+                error = e
+                if attempt > self.retries:
+                    break
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                print(f"{prStyle.YELLOW}{model}: attempt {attempt} failed, retrying in {delay:.0f} sec. ({e}){prStyle.RESET}")
+                sleep(delay)
+        status = 'failed' if error else self._check(model, counter['rows'])
+        if status == 'stale':
+            error = f"DuckDB table doesn't match the {counter['rows']} rows fetched"
+        return dict(model=model, status=status, rows=counter['rows'],
+                    mb=round(counter['bytes'] / 1024 / 1024, 2), seconds=round(time() - start, 2),
+                    attempts=attempt, error=str(error) if error else None)
+
+    def _check(self, model, rows):
+        """Status of a synced model: 'ok', 'empty' if the model has no rows, 'stale' if DuckDB still holds other rows"""
+        if self.helper.duckdb_helper.count_rows(model) != rows:
+            return 'stale'
+        return 'ok' if rows else 'empty'
+
+    def run(self, models):
+        """Sync models on the thread pool and return the report as a DataFrame in the order of models"""
+        reports = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.threads), thread_name_prefix='dbt_magics') as executor:
+            futures = {executor.submit(self.sync_model, model): model for model in models}
+            for future in as_completed(futures):
+                report = reports[futures[future]] = future.result()
+                color = dict(ok=prStyle.GREEN, empty=prStyle.YELLOW).get(report['status'], prStyle.RED)
+                details = report['error'] if report['error'] else f"{report['rows']} rows | {report['mb']:.1f} MB"
+                print(f"{color}[{len(reports)}/{len(models)}] {report['model']}{prStyle.RESET} | {details} | {report['seconds']:.2f} sec.")
+        return pd.DataFrame([reports[model] for model in models],
+                            columns=['model', 'status', 'rows', 'mb', 'seconds', 'attempts', 'error'])
+
+
+@magics_class
+class DbtSyncMagics(Magics):
+
+    @line_magic
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument('select', nargs='*', help='Models to sync: names (wildcards allowed), tag:<tag> or path:<folder>. Selectors joined by , must all match.')
+    @magic_arguments.argument('--exclude', nargs='+', default=None, help='Selectors of models to skip.')
+    @magic_arguments.argument('--adapter', default=None, help='Adapter fetching the models, e.g. snowflake (default: the only loaded adapter).')
+    @magic_arguments.argument('--profile', default=None, help='')
+    @magic_arguments.argument('--target', default=None, help='')
+    @magic_arguments.argument('--threads', default=None, type=int, help='Models synced at the same time (default: threads of the profile, or 4).')
+    @magic_arguments.argument('--retries', default=2, type=int, help='Retries per failed model (default 2).')
+    @magic_arguments.argument('--limit', default=None, type=int, help='Only fetch the first N rows of each model.')
+    @magic_arguments.argument('--dry_run', action='store_true', help='Only list the selected models.')
+    def dbt_sync(self, line):
+        """
+        ---------------------------------------------------------------------------
+        %dbt_sync stg_orders stg_customers          # Mirror models into DuckDB
+        %dbt_sync tag:daily --threads 8             # All models tagged daily, 8 at a time
+        %dbt_sync path:marts --exclude fct_big      # All models in models/marts but fct_big
+        %dbt_sync tag:core,path:staging --limit 1000  # Staging models tagged core, 1000 rows each
+        %dbt_sync tag:daily --dry_run               # List the selected models
+        ---------------------------------------------------------------------------
+        Models are written as schema.model with the duckdb settings of the profile,
+        like --export_duckdb. Returns a report with rows, MB and seconds per model;
+        status is ok, empty (the model has no rows), failed or stale (DuckDB rows
+        don't match the rows fetched).
+        """
+        args = magic_arguments.parse_argstring(self.dbt_sync, line)
+        if not args.select:
+            print(f"{prStyle.RED}Select models to sync, e.g. %dbt_sync tag:daily or %dbt_sync path:staging{prStyle.RESET}")
+            return None
+
+        adapter_name = args.adapter or (list(_sync_adapters)[0] if len(_sync_adapters) == 1 else None)
+        if adapter_name not in _sync_adapters:
+            print(f"{prStyle.RED}Use --adapter to choose one of the loaded adapters: {', '.join(_sync_adapters) or 'none, load e.g. %load_ext dbt_magics.snowflakeMagics'}{prStyle.RESET}")
+            return None
+        kwargs = {key: value for key, value in dict(profile_name=args.profile, target=args.target).items() if value}
+        helper = _sync_adapters[adapter_name].get_or_create(**kwargs)
+
+        models = helper.select_models(args.select, args.exclude)
+        print(f"{prStyle.BLUE}{len(models)} models selected{prStyle.RESET}" + (f": {', '.join(models)}" if models else ""))
+        if args.dry_run or not models:
+            return None
+
+        require_pyarrow("%dbt_sync")
+        if not helper.check_duckdb_availability():
+            print(f"{prStyle.RED}Aborting sync due to DuckDB unavailability.{prStyle.RESET}")
+            return None
+
+        threads = args.threads or int(helper.profile_config.get('threads') or 4)
+        start = time()
+        report = ModelSync(helper, threads=threads, retries=args.retries, limit=args.limit).run(models)
+        failed = report['status'].isin(['failed', 'stale']).sum()
+        empty = (report['status'] == 'empty').sum()
+        color = prStyle.RED if failed else prStyle.GREEN
+        print(f"{color}Synced {len(report) - failed} of {len(report)} models{prStyle.RESET}{f' ({empty} empty)' if empty else ''} | "
+              f"{report['rows'].sum()} rows | {report['mb'].sum():.1f} MB | {time() - start:.2f} sec. with {threads} threads")
+        return report
@@ -0,0 +1,212 @@
+"""
+Templating Module for dbt-magics
+
+Keeps one jinja2.Environment per dbt project. The project's macro files are
+compiled once into an importable module and only recompiled when a file
+changes on disk. Cell templates are compiled on their own and kept in an
+LRU cache keyed by the hash of their source.
+
+A MacroIndex maps every macro to its defining file and the macros it calls,
+so a cell only loads the transitive closure of the macros it references.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+from jinja2 import BaseLoader, Environment, TemplateNotFound, meta, nodes
+
+# Name under which the macro library can be imported, e.g. {% import '__dbt_macros__' as m %}
+MACRO_LIBRARY = '__dbt_macros__'
+# Prefix of templates holding a subset of the macro files, e.g. '__dbt_macros__:macros/a.sql|macros/b.sql'
+MACRO_SUBSET_PREFIX = MACRO_LIBRARY + ':'
+
+
+class MacroLoader(BaseLoader):
+    """Jinja loader serving the macro files of a dbt project as one template, or a subset of them"""
+
+    def __init__(self, project_folder, macro_paths):
+        self.project_folder = project_folder
+        self.macro_paths = list(macro_paths or [])
+
+    def macro_files(self):
+        macro_files = []
+        for mp in self.macro_paths:
+            for top, dirs, files in os.walk(os.path.join(self.project_folder, mp)):
+                for nm in files:
+                    if nm.endswith(".sql"):
+                        macro_files.append(os.path.join(top, nm))
+        return sorted(macro_files)
+
+    def _mtimes(self, files):
+        return {f: os.path.getmtime(f) for f in files}
+
+    def get_source(self, environment, template):
+        if template == MACRO_LIBRARY:
+            files = self.macro_files()
+        elif template.startswith(MACRO_SUBSET_PREFIX):
+            files = [os.path.join(self.project_folder, f) for f in template[len(MACRO_SUBSET_PREFIX):].split('|')]
+        else:
+            raise TemplateNotFound(template)
+        try:
+            mtimes = self._mtimes(files)
+        except OSError:
+            raise TemplateNotFound(template)
+        parts = []
+        for mf in files:
+            with open(mf, encoding='utf-8') as file:
+                parts.append(file.read())
+        source = "\n".join(parts)
+
+        def uptodate():
+            try:
+                current = self.macro_files() if template == MACRO_LIBRARY else files
+                return self._mtimes(current) == mtimes
+            except OSError:
+                return False
+        return source, None, uptodate
+
+
+class MacroIndex:
+    """Index of macro name -> defining file and the macros each macro file calls"""
+
+    def __init__(self, environment, loader, refresh_interval=2.0):
+        self.environment = environment
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        # relative file path -> {'mtime': float, 'calls': {macro name: [referenced names]}}
+        self.files = {}
+        self.macros = {}  # macro name -> relative file path
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def _parse_file(self, path):
+        with open(path, encoding='utf-8') as file:
+            ast = self.environment.parse(file.read())
+        # macro name -> names referenced in its body, filtered down to macros in closure()
+        return {macro.name: sorted({name.name for name in macro.find_all(nodes.Name) if name.ctx == 'load'})
+                for macro in ast.find_all(nodes.Macro)}
+
+    def refresh(self, force=False):
+        """Re-parse macro files whose mtime changed since the last refresh"""
+        with self._lock:
+            if not force and time() - self._last_refresh < self.refresh_interval:
+                return
+            files = {}
+            for path in self.loader.macro_files():
+                rel_path = os.path.relpath(path, self.loader.project_folder)
+                mtime = os.path.getmtime(path)
+                entry = self.files.get(rel_path)
+                if not entry or entry['mtime'] != mtime:
+                    entry = {'mtime': mtime, 'calls': self._parse_file(path)}
+                files[rel_path] = entry
+
+            macros = {}
+            for rel_path in sorted(files):
+                # Later files override earlier ones, like in the concatenated macro library
+                for name in files[rel_path]['calls']:
+                    macros[name] = rel_path
+            self.files, self.macros = files, macros
+            self._last_refresh = time()
+
+    def closure(self, names):
+        """
+        Resolve the macros needed by a set of referenced names
+
+        Returns:
+        - (sorted list of macro files to load, sorted list of macro names pulled in)
+        """
+        self.refresh()
+        pending = [name for name in names if name in self.macros]
+        pulled = set()
+        while pending:
+            name = pending.pop()
+            if name in pulled:
+                continue
+            pulled.add(name)
+            calls = self.files[self.macros[name]]['calls'][name]
+            pending += [call for call in calls if call in self.macros]
+        return sorted({self.macros[name] for name in pulled}), sorted(pulled)
+
+
+class TemplateRenderer:
+    """Shared Jinja environment of a dbt project with a compiled macro library and cached cell templates"""
+
+    def __init__(self, project_folder, macro_paths, cache_size=128):
+        """
+        Parameters:
+        - project_folder: path to the dbt project
+        - macro_paths: list of macro-paths from dbt_project.yml
+        - cache_size: number of compiled cell templates to keep
+        """
+        loader = MacroLoader(project_folder, macro_paths)
+        self.environment = Environment(loader=loader, auto_reload=True)
+        self.macro_index = MacroIndex(self.environment, loader)
+        self.cache_size = cache_size
+        self._cell_cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, cell):
+        """
+        Compile a cell template, reusing the cached template if the same source was compiled before
+
+        Returns:
+        - (jinja2.Template, set of undeclared variable names)
+        """
+        key = hashlib.sha256(cell.encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._cell_cache:
+                self._cell_cache.move_to_end(key)
+                return self._cell_cache[key]
+
+        ast = self.environment.parse(cell)
+        entry = (self.environment.from_string(ast), meta.find_undeclared_variables(ast))
+        with self._lock:
+            self._cell_cache[key] = entry
+            while len(self._cell_cache) > self.cache_size:
+                self._cell_cache.popitem(last=False)
+        return entry
+
+    def undeclared_variables(self, cell):
+        """Names used in the cell that are neither defined in the cell nor passed by dbt-magics"""
+        return self.compile(cell)[1]
+
+    def required_macros(self, cell):
+        """Names of the macros a cell pulls in, including macros called by those macros"""
+        return self.macro_index.closure(self.undeclared_variables(cell))[1]
+
+    def macros(self, context, files=None):
+        """
+        Instantiate the compiled macro library with the render context and return its exported macros
+
+        Parameters:
+        - context: render context (source, ref, var, notebook variables)
+        - files: relative paths of the macro files to load, all macro files if None
+        """
+        if files is None:
+            name = MACRO_LIBRARY
+        elif files:
+            name = MACRO_SUBSET_PREFIX + '|'.join(files)
+        else:
+            return {}
+        module = self.environment.get_template(name).make_module(context)
+        return {name: value for name, value in vars(module).items() if not name.startswith('_')}
+
+    def render(self, cell, **context):
+        """Render a cell, loading only the macro files it needs"""
+        template, variables = self.compile(cell)
+        files, _ = self.macro_index.closure(variables)
+        return template.render(**{**context, **self.macros(context, files)})
+
+
+# Process-wide renderers, one per project
+_renderers = {}
+
+def get_template_renderer(project_folder, macro_paths):
+    """Get the session-wide TemplateRenderer of a dbt project"""
+    key = (os.path.abspath(project_folder), tuple(macro_paths or []))
+    if key not in _renderers:
+        _renderers[key] = TemplateRenderer(project_folder, macro_paths)
+    return _renderers[key]